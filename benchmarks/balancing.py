@@ -0,0 +1,96 @@
+"""
+Compares the tail latency of the balancing strategies in a simulation of a
+service with one slow instance. Each instance handles a fixed number of
+requests concurrently and queues the rest, requests arrive at random at a
+fixed fraction of the total capacity.
+
+Usage: python benchmarks/balancing.py [count]
+"""
+from __future__ import division, print_function
+
+import collections
+import heapq
+import random
+import sys
+
+from lymph.core.balancing import balancers
+from lymph.core.connection import RESPONSIVE
+from lymph.utils import EWMA
+
+
+INSTANCES = 10
+CONCURRENCY = 4
+SERVICE_TIME = .010
+SLOWDOWN = 10
+LOAD = .7
+
+
+class SimulatedConnection(object):
+    def __init__(self):
+        self.status = RESPONSIVE
+        self.in_flight = 0
+        self.latency = EWMA(factor=1000)
+
+
+class SimulatedInstance(object):
+    def __init__(self, service_time, weight=1):
+        self.service_time = service_time
+        self.weight = weight
+        self.connection = SimulatedConnection()
+        self.busy = 0
+        self.queue = collections.deque()
+
+    def is_alive(self):
+        return True
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def simulate(balancer_cls, count, seed=42):
+    rng = random.Random(seed)
+    instances = [SimulatedInstance(SERVICE_TIME) for i in range(INSTANCES)]
+    instances[0].service_time *= SLOWDOWN
+    capacity = sum(CONCURRENCY / instance.service_time for instance in instances)
+    balancer = balancer_cls(instances)
+
+    events = []
+    latencies = []
+    now = 0
+
+    def start(instance, sent_at, started_at):
+        instance.busy += 1
+        done_at = started_at + rng.expovariate(1 / instance.service_time)
+        heapq.heappush(events, (done_at, id(instance), instance, sent_at))
+
+    for i in range(count):
+        now += rng.expovariate(capacity * LOAD)
+        while events and events[0][0] <= now:
+            done_at, key, instance, sent_at = heapq.heappop(events)
+            instance.busy -= 1
+            instance.connection.in_flight -= 1
+            instance.connection.latency.add(done_at - sent_at)
+            latencies.append(done_at - sent_at)
+            if instance.queue:
+                start(instance, instance.queue.popleft(), done_at)
+        instance = balancer.select()
+        instance.connection.in_flight += 1
+        if instance.busy < CONCURRENCY:
+            start(instance, now, now)
+        else:
+            instance.queue.append(now)
+    latencies.sort()
+    return [1000 * percentile(latencies, p) for p in (.5, .99, .999)]
+
+
+def main():
+    count = int(float(sys.argv[1]) if len(sys.argv) > 1 else 200000)
+    print('%d instances, one of them %dx slower, %d%% load' % (INSTANCES, SLOWDOWN, LOAD * 100))
+    for name, cls in sorted(balancers.items()):
+        p50, p99, p999 = simulate(cls, count)
+        print('%-18s p50: %7.1f ms  p99: %7.1f ms  p99.9: %7.1f ms' % (name, p50, p99, p999))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compares the legacy two-call send path (identity with SNDMORE, then the
+message frames) with the single-call path of ServiceContainer.send_to(). Both
+send the v2 wire format, like send_to() does once the peer speaks it.
+
+Usage: python benchmarks/send_message.py [count]
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+import zmq
+
+from lymph.core.messages import Message
+from lymph.utils.sockets import send_zmq_frames
+
+
+PAYLOADS = [
+    ('small', 'x' * 100, 100000),
+    ('large', b'x' * (1024 * 1024), 2000),
+]
+
+
+def create_pair(ctx, endpoint):
+    recv_sock = ctx.socket(zmq.ROUTER)
+    recv_sock.setsockopt(zmq.IDENTITY, b'receiver')
+    recv_sock.setsockopt(zmq.RCVHWM, 0)
+    recv_sock.bind(endpoint)
+    send_sock = ctx.socket(zmq.ROUTER)
+    send_sock.setsockopt(zmq.IDENTITY, b'sender')
+    send_sock.setsockopt(zmq.SNDHWM, 0)
+    send_sock.connect(endpoint)
+    time.sleep(.1)
+    return send_sock, recv_sock
+
+
+def legacy_send(sock, msg):
+    sock.send(b'receiver', flags=zmq.SNDMORE)
+    sock.send_multipart(msg.pack_frames(2))
+
+
+def single_call_send(sock, msg):
+    send_zmq_frames(sock, msg.pack_frames(2, identity=b'receiver'))
+
+
+def run(send, body, count, endpoint):
+    ctx = zmq.Context()
+    send_sock, recv_sock = create_pair(ctx, endpoint)
+    msg = Message(Message.REQ, 'bench.echo', body=body, headers={'trace_id': 'x' * 32})
+    msg.packed_body
+    start = time.time()
+    for i in range(count):
+        send(send_sock, msg)
+    for i in range(count):
+        recv_sock.recv_multipart(copy=False)
+    elapsed = time.time() - start
+    send_sock.close(linger=0)
+    recv_sock.close(linger=0)
+    ctx.term()
+    return count / elapsed
+
+
+def main():
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+    for transport, endpoint in [('inproc', 'inproc://bench'), ('tcp', 'tcp://127.0.0.1:47123')]:
+        for name, body, count in PAYLOADS:
+            count = int(count * scale)
+            legacy = run(legacy_send, body, count, endpoint)
+            single = run(single_call_send, body, count, endpoint)
+            print('%-6s %-6s legacy: %10.0f msg/s  single call: %10.0f msg/s  (%+.1f%%)' % (
+                transport, name, legacy, single, 100 * (single / legacy - 1)))
+
+
+if __name__ == '__main__':
+    main()
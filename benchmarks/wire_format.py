@@ -0,0 +1,58 @@
+"""
+Compares the size and the packing/unpacking time of typical messages in the
+v1 and v2 wire formats.
+
+Usage: python benchmarks/wire_format.py [count]
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from lymph.core.messages import Message, hash_subject
+from lymph.utils import make_id
+
+
+SOURCE = b'tcp://127.0.0.1:12345'
+SUBJECTS = {hash_subject('geocoder.geocode'): 'geocoder.geocode'}
+
+
+def create_messages():
+    trace_id = make_id()
+    request = Message(Message.REQ, 'geocoder.geocode', body={'address': 'Alexanderplatz 1'}, headers={
+        'trace_id': trace_id,
+        'deadline': time.time() + 1,
+    })
+    reply = Message(Message.REP, request.id, body={'lat': 52.52, 'lng': 13.41}, headers={
+        'trace_id': trace_id,
+    })
+    ping = Message(Message.REQ, 'lymph.ping', body={'payload': ''}, headers={'trace_id': trace_id})
+    return [('request', request), ('reply', reply), ('ping', ping)]
+
+
+def measure(msg, version, count):
+    frames = [SOURCE] + msg.pack_frames(version)
+    size = sum(len(frame) for frame in frames[1:])
+    start = time.time()
+    for i in range(count):
+        msg.pack_frames(version)
+    pack = (time.time() - start) / count
+    start = time.time()
+    for i in range(count):
+        # the receive loop always decodes the headers
+        Message.unpack_frames(frames, subjects=SUBJECTS).headers
+    unpack = (time.time() - start) / count
+    return size, pack, unpack
+
+
+def main():
+    count = int(float(sys.argv[1]) * 100000) if len(sys.argv) > 1 else 100000
+    for name, msg in create_messages():
+        for version in (1, 2):
+            size, pack, unpack = measure(msg, version, count)
+            print('%-8s v%s  %4d bytes  pack: %6.2f us  unpack: %6.2f us' % (
+                name, version, size, pack * 1e6, unpack * 1e6))
+
+
+if __name__ == '__main__':
+    main()
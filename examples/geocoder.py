@@ -4,9 +4,10 @@ from geopy.geocoders import GoogleV3
 
 class Geocoder(lymph.Interface):
     def on_start(self):
+        super(Geocoder, self).on_start()
         self.geolocator = GoogleV3()
 
-    @lymph.rpc()
+    @lymph.rpc(cache={'maxsize': 10000, 'ttl': 3600})
     def geocode(self, address):
         matched_address, (lat, lng) = self.geolocator.geocode(address)
         return {
@@ -30,6 +30,8 @@ def install_interfaces(container, interfaces):
             sys.exit(1)
         cls = import_object(cls_name)
         instance = container.install(cls, interface_name=interface_name)
+        if 'max_concurrent_requests' in instance_config:
+            instance.max_concurrent_requests = instance_config['max_concurrent_requests']
         instance.apply_config(instance_config)
 
 
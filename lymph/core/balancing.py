@@ -0,0 +1,217 @@
+from __future__ import division
+
+import bisect
+import hashlib
+import logging
+import random
+import struct
+
+import six
+
+from lymph.utils import import_object
+
+
+logger = logging.getLogger(__name__)
+
+
+class Balancer(object):
+    """
+    Picks the instance of a :class:`Service` that receives the next request.
+    :meth:`update` is called whenever the instances of the service change,
+    :meth:`select` must not look at more than a few instances.
+    """
+    def __init__(self, service):
+        self.service = service
+        self.instances = []
+        self.update()
+
+    def update(self):
+        self.instances = list(self.service)
+
+    def select(self):
+        raise NotImplementedError
+
+    def select_other(self, instance):
+        """
+        Returns a live instance other than `instance`, or None.
+        """
+        for i in six.moves.range(3):
+            other = self.select()
+            if other is None:
+                return None
+            if other is not instance and other.is_alive():
+                return other
+        others = [other for other in self.instances if other is not instance and other.is_alive()]
+        if not others:
+            return None
+        return random.choice(others)
+
+    def sample(self, k):
+        """
+        Returns the live instances among `k` randomly chosen ones.
+        """
+        instances = random.sample(self.instances, min(k, len(self.instances)))
+        return [instance for instance in instances if instance.is_alive()]
+
+    def fallback(self):
+        """
+        Returns a random live instance, or any instance if none is alive.
+        """
+        choices = [instance for instance in self.instances if instance.is_alive()]
+        if not choices:
+            logger.info("no live instance for %s", getattr(self.service, 'name', None))
+            choices = self.instances
+        if not choices:
+            return None
+        return random.choice(choices)
+
+
+class RandomBalancer(Balancer):
+    sample_size = 3
+
+    def select(self):
+        live = self.sample(self.sample_size)
+        if live:
+            return live[0]
+        return self.fallback()
+
+
+class LeastOutstandingBalancer(Balancer):
+    """
+    Power of two choices: picks the instance with fewer requests in flight
+    out of two random live instances.
+    """
+    def load(self, instance):
+        connection = instance.connection
+        if connection is None:
+            return 0
+        return connection.in_flight
+
+    def select(self):
+        live = self.sample(2)
+        if not live:
+            return self.fallback()
+        return min(live, key=self.load)
+
+
+class EWMABalancer(LeastOutstandingBalancer):
+    """
+    Power of two choices on the moving average of the request latency,
+    weighted by the number of requests in flight. Instances without latency
+    samples are preferred so that they get some.
+    """
+    def load(self, instance):
+        connection = instance.connection
+        if connection is None or connection.latency.value is None:
+            return 0
+        return connection.latency.value * (connection.in_flight + 1)
+
+
+class WeightedRoundRobinBalancer(Balancer):
+    """
+    Smooth weighted round-robin over the instances according to their
+    `weight`. The schedule is computed when the instances change, instances
+    that aren't alive are skipped.
+    """
+    def update(self):
+        super(WeightedRoundRobinBalancer, self).update()
+        weights = [max(int(instance.weight), 0) for instance in self.instances]
+        total = sum(weights)
+        current = [0] * len(weights)
+        schedule = []
+        for i in six.moves.range(total):
+            for j, weight in enumerate(weights):
+                current[j] += weight
+            best = current.index(max(current))
+            current[best] -= total
+            schedule.append(self.instances[best])
+        self.schedule = schedule
+        # start at a random position so that clients don't move in lockstep
+        self.position = random.randrange(total) if total else 0
+
+    def select(self):
+        schedule = self.schedule
+        for i in six.moves.range(len(schedule)):
+            self.position = (self.position + 1) % len(schedule)
+            instance = schedule[self.position]
+            if instance.is_alive():
+                return instance
+        return self.fallback()
+
+
+balancers = {
+    'random': RandomBalancer,
+    'least_outstanding': LeastOutstandingBalancer,
+    'ewma': EWMABalancer,
+    'round_robin': WeightedRoundRobinBalancer,
+}
+
+
+def get_balancer(name):
+    """
+    Returns the balancer class registered as `name`, or imports it if `name`
+    is of the form ``module:Class``.
+    """
+    if isinstance(name, type):
+        return name
+    try:
+        return balancers[name]
+    except KeyError:
+        return import_object(name)
+
+
+def hash_key(key):
+    if not isinstance(key, bytes):
+        key = six.text_type(key).encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0]
+
+
+class HashRing(object):
+    """
+    A consistent hash ring with `replicas` virtual nodes per instance.
+    Adding or removing an instance only moves the keys of that instance.
+    """
+    def __init__(self, instances=(), replicas=100):
+        self.replicas = replicas
+        self.points = []
+        self.nodes = []
+        for instance in instances:
+            self.add(instance)
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, instance):
+        for i in six.moves.range(self.replicas):
+            point = hash_key('%s#%s' % (instance.identity, i))
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.nodes.insert(index, instance)
+
+    def remove(self, instance):
+        kept = [(point, node) for point, node in zip(self.points, self.nodes) if node is not instance]
+        self.points = [point for point, node in kept]
+        self.nodes = [node for point, node in kept]
+
+    def get(self, key, exclude=None):
+        """
+        Returns the instance that owns `key`. If it isn't alive, the next
+        live instance on the ring is returned, or the owner if there is none.
+        The instance `exclude` is never returned.
+        """
+        nodes = self.nodes
+        if not nodes:
+            return None
+        start = bisect.bisect(self.points, hash_key(key)) % len(nodes)
+        owner = nodes[start]
+        if owner is not exclude and owner.is_alive():
+            return owner
+        seen = set([owner, exclude])
+        for i in six.moves.range(1, len(nodes)):
+            node = nodes[(start + i) % len(nodes)]
+            if node in seen:
+                continue
+            if node.is_alive():
+                return node
+            seen.add(node)
+        return owner if owner is not exclude else None
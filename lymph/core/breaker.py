@@ -0,0 +1,104 @@
+import time
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def is_guarded(request):
+    """
+    Returns True if circuit breakers apply to `request`. Requests to the
+    built-in `lymph` interface, e.g. heartbeats and batches, bypass them.
+    """
+    return not request.subject.startswith('lymph.')
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to an instance after `failure_threshold` consecutive
+    failures. After `reset_timeout` seconds the breaker lets up to
+    `half_open_requests` requests through: it closes again if one of them
+    succeeds, and opens again if one of them fails. The outcomes of other
+    requests, e.g. of those that were sent before the breaker opened, don't
+    change the state of an open or half-open breaker.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=5, half_open_requests=1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_requests = half_open_requests
+        self._state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+        self.open_count = 0
+
+    @property
+    def state(self):
+        if self._state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self.probes = 0
+        return self._state
+
+    def is_available(self):
+        state = self.state
+        if state == HALF_OPEN:
+            return self.probes < self.half_open_requests
+        return state == CLOSED
+
+    def is_pristine(self):
+        """
+        Returns True if the breaker is closed and hasn't seen a failure since
+        it was last reset.
+        """
+        return self.state == CLOSED and not self.failures
+
+    def on_request(self):
+        """
+        Called for every request that is sent while the breaker is
+        available. Returns True if the request is a probe of a half-open
+        breaker.
+        """
+        if self.state == HALF_OPEN:
+            self.probes += 1
+            return True
+        return False
+
+    def record(self, failed, probe=False):
+        """
+        Records the outcome of a request: True if it failed, False if it
+        succeeded, or None if it was abandoned. `probe` is the return value
+        of :meth:`on_request` for the request.
+        """
+        if self._state == CLOSED:
+            if failed:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.open()
+            elif failed is not None:
+                self.failures = 0
+        elif self._state == HALF_OPEN and probe:
+            if failed is None:
+                self.probes -= 1
+            elif failed:
+                self.open()
+            else:
+                self.close()
+
+    def open(self):
+        self._state = OPEN
+        self.opened_at = time.monotonic()
+        self.failures = 0
+        self.open_count += 1
+
+    def close(self):
+        self._state = CLOSED
+        self.failures = 0
+        self.probes = 0
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opened': self.open_count,
+        }
@@ -0,0 +1,149 @@
+import collections
+import logging
+import time
+
+import gevent.event
+import six
+
+from lymph.core.events import EventHandler
+from lymph.core.interfaces import Component
+
+
+logger = logging.getLogger(__name__)
+
+_RETRY = object()
+
+
+def make_key(value):
+    """
+    Returns a hashable key for a request body. Each value is tagged with its
+    type, so that e.g. ``1``, ``1.0`` and ``True`` don't share a key, and dicts
+    are sorted by key, so that bodies that only differ in the order of their
+    keys do.
+    """
+    if isinstance(value, dict):
+        items = ((make_key(k), make_key(v)) for k, v in six.iteritems(value))
+        return dict, tuple(sorted(items, key=repr))
+    if isinstance(value, (list, tuple)):
+        return list, tuple(make_key(v) for v in value)
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes, bytes(value)
+    return type(value), value
+
+
+class RpcCache(Component):
+    """
+    Caches the results of an rpc method of `interface`. At most `maxsize`
+    results are kept, the least recently used are evicted first, and results
+    expire after `ttl` seconds (None: never). Identical calls that arrive
+    while the method is running wait for its result instead of running it
+    again. Events of the types in `invalidate_on` clear the cache.
+    """
+    def __init__(self, interface, func_name, maxsize=1000, ttl=60, invalidate_on=()):
+        self.interface = interface
+        self.func_name = func_name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.invalidate_on = invalidate_on
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+        self.hit_count = 0
+        self.miss_count = 0
+        self.coalesced_count = 0
+        self.eviction_count = 0
+        self.expired_count = 0
+        self.invalidation_count = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def on_start(self):
+        if not self.invalidate_on:
+            return
+        # every instance keeps its own cache, so every instance needs every event
+        handler = EventHandler(
+            self.interface, self.on_invalidate_event, self.invalidate_on,
+            queue_name='%s-cache' % self.func_name, broadcast=True)
+        self.interface.container.subscribe(handler)
+
+    def on_invalidate_event(self, interface, event):
+        logger.debug('clearing cache of %s.%s on %s', interface.name, self.func_name, event)
+        self.clear()
+
+    def get(self, key):
+        expires_at, value = self.entries.pop(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.expired_count += 1
+            raise KeyError(key)
+        self.entries[key] = expires_at, value
+        return value
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        self.entries[key] = expires_at, value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.eviction_count += 1
+
+    def call(self, func, kwargs):
+        """
+        Returns the cached result of ``func(**kwargs)``, or calls it.
+        """
+        try:
+            key = make_key(kwargs)
+            value = self.get(key)
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable arguments, e.g. numpy arrays, are never cached
+            return func(**kwargs)
+        else:
+            self.hit_count += 1
+            return value
+        pending = self.pending.get(key)
+        if pending is not None:
+            self.coalesced_count += 1
+            value = pending.get()
+            if value is not _RETRY:
+                return value
+            return self.call(func, kwargs)
+        self.miss_count += 1
+        result = self.pending[key] = gevent.event.AsyncResult()
+        try:
+            value = func(**kwargs)
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        except BaseException:
+            # e.g. GreenletExit: the call was aborted, but didn't fail
+            result.set(_RETRY)
+            raise
+        else:
+            self.set(key, value)
+            result.set(value)
+            return value
+        finally:
+            del self.pending[key]
+
+    def invalidate(self, **kwargs):
+        """
+        Drops the cached result for the given arguments.
+        """
+        if self.entries.pop(make_key(kwargs), None) is not None:
+            self.invalidation_count += 1
+
+    def clear(self):
+        self.invalidation_count += len(self.entries)
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'hits': self.hit_count,
+            'misses': self.miss_count,
+            'coalesced': self.coalesced_count,
+            'evictions': self.eviction_count,
+            'expired': self.expired_count,
+            'invalidations': self.invalidation_count,
+        }
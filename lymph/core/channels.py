@@ -1,8 +1,30 @@
+import time
+
 import gevent
+import gevent.event
 import gevent.queue
 
-from lymph.exceptions import Timeout, Nack, RemoteError
+from lymph.exceptions import Timeout, Nack, Overloaded, Cancelled, RemoteError
+from lymph.core.breaker import is_guarded
 from lymph.core.messages import Message
+from lymph.utils.timerwheel import TimerWheel
+
+
+DEFAULT_STREAM_WINDOW = 16
+STREAM_CREDIT_TIMEOUT = 30
+
+
+def get_reply_error(request, msg):
+    """
+    Returns the exception that corresponds to the reply `msg`, or None if
+    `msg` isn't an error reply.
+    """
+    if msg.type == Message.OVERLOADED:
+        return Overloaded(request)
+    elif msg.type == Message.NACK:
+        return Nack(request)
+    elif msg.type == Message.ERROR:
+        return RemoteError.from_reply(request, msg)
 
 
 class Channel(object):
@@ -11,53 +33,356 @@ class Channel(object):
         self.container = container
 
 
+class PendingRequests(object):
+    """
+    The request channels that wait for a reply, keyed by request id. Entries
+    are kept in a :class:`TimerWheel` and expire shortly after the deadline
+    of their request, or after `ttl` seconds if it has no deadline.
+    """
+    def __init__(self, container, ttl=60, tick=.1):
+        self.container = container
+        self.ttl = ttl
+        self.wheel = TimerWheel(tick=tick)
+        self.expired_count = 0
+        self.loop_greenlet = None
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def add(self, channel):
+        deadline = channel.request.deadline
+        if deadline is None:
+            timeout = self.ttl
+        else:
+            timeout = deadline - time.time() + self.wheel.tick
+        self.wheel.add(channel.request.id, channel, timeout)
+
+    def touch(self, channel):
+        if channel.request.id in self.wheel:
+            self.wheel.add(channel.request.id, channel, self.ttl)
+
+    def get(self, request_id):
+        return self.wheel.get(request_id)
+
+    def remove(self, request_id):
+        return self.wheel.remove(request_id)
+
+    def start(self):
+        self.loop_greenlet = self.container.spawn(self.loop)
+
+    def stop(self):
+        if self.loop_greenlet:
+            self.loop_greenlet.kill()
+
+    def loop(self):
+        tick = self.wheel.tick
+        last_tick = time.monotonic()
+        while True:
+            gevent.sleep(tick)
+            now = time.monotonic()
+            while last_tick + tick <= now:
+                last_tick += tick
+                for request_id, channel in self.wheel.advance():
+                    self.expired_count += 1
+                    channel.expire()
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'expired': self.expired_count,
+        }
+
+
 class RequestChannel(Channel):
     def __init__(self, request, container):
         super(RequestChannel, self).__init__(request, container)
-        self.queue = gevent.queue.Queue()
+        self.connection = None
+        # tells when libzmq has released the buffers of a zero-copy send
+        self.tracker = None
+        self.sent_at = None
+        self.finished = False
+        self.breaker = None
+        self.probe = False
+        self.result = gevent.event.AsyncResult()
+        self.queue = None
+        if request.headers.get('stream_window'):
+            self.queue = gevent.queue.Queue()
+
+    def set_connection(self, connection):
+        """
+        Records that the request was sent over `connection`, which counts it
+        as in flight until it's finished. The outcome of requests to
+        interfaces other than the built-in `lymph` interface is reported to
+        the circuit breaker of the connection.
+        """
+        self.connection = connection
+        if connection is not None and not self.finished:
+            self.sent_at = time.monotonic()
+            connection.start_request()
+            if is_guarded(self.request):
+                self.breaker = getattr(connection, 'breaker', None)
+            if self.breaker is not None:
+                self.probe = self.breaker.on_request()
+
+    def finish(self, failed=None):
+        """
+        Called when the request was answered, has failed (`failed` is True
+        after timeouts and NACK or OVERLOADED replies), or was abandoned
+        (`failed` is None).
+        """
+        self.finished = True
+        if self.sent_at is None:
+            return
+        self.connection.finish_request(time.monotonic() - self.sent_at)
+        self.sent_at = None
+        if self.breaker is not None:
+            self.breaker.record(failed, self.probe)
 
     def recv(self, msg):
-        self.queue.put(msg)
+        if msg.type != Message.CHUNK:
+            self.finish(failed=msg.type in (Message.NACK, Message.OVERLOADED))
+        if self.queue is not None:
+            self.queue.put(msg)
+            self.container.channels.touch(self)
+        elif not self.result.ready():
+            self.result.set(msg)
+
+    def expire(self):
+        """
+        Called when the channel has been dropped from the pending request
+        table without a reply.
+        """
+        self.finish(failed=True)
+        if self.queue is not None:
+            self.queue.put(None)
+        elif not self.result.ready():
+            self.result.set_exception(Timeout(self.request))
 
     def get(self, timeout=1):
+        deadline = self.request.deadline
+        if deadline is not None:
+            remaining = max(deadline - time.time(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
         try:
-            msg = self.queue.get(timeout=timeout)
-            self.close()
-            if msg.type == Message.NACK:
-                raise Nack(self.request)
-            elif msg.type == Message.ERROR:
-                raise RemoteError.from_reply(self.request, msg)
-            return msg
-        except gevent.queue.Empty:
+            self.result.wait(timeout=timeout)
+        except gevent.GreenletExit:
+            self.cancel()
+            raise
+        if not self.result.ready():
+            self.finish(failed=True)
+            self.cancel()
             raise Timeout(self.request)
+        msg = self.result.get()
+        self.close()
+        error = get_reply_error(self.request, msg)
+        if error:
+            raise error
+        return msg
+
+    def stream(self, timeout=1):
+        """
+        Yields the body of each chunk of a streaming reply. The request must
+        have been sent with a `stream_window`. `timeout` applies to each chunk.
+        """
+        window = self.request.headers.get('stream_window')
+        if not window:
+            raise TypeError('request was not sent with a stream_window')
+        consumed = 0
+        finished = False
+        try:
+            while True:
+                try:
+                    msg = self.queue.get(timeout=timeout)
+                except gevent.queue.Empty:
+                    self.finish(failed=True)
+                    raise Timeout(self.request)
+                if msg is None:
+                    finished = True
+                    raise Timeout(self.request)
+                if msg.type != Message.CHUNK:
+                    finished = True
+                    error = get_reply_error(self.request, msg)
+                    if error:
+                        raise error
+                    return
+                yield msg.body
+                consumed += 1
+                if 2 * consumed >= window:
+                    self.container.send_credit(msg.source, self.request, consumed)
+                    consumed = 0
+        finally:
+            if finished:
+                self.close()
+            else:
+                self.cancel()
 
     def close(self):
-        del self.container.channels[self.request.id]
+        self.finish()
+        self.container.channels.remove(self.request.id)
+
+    def cancel(self):
+        """
+        Abandons the request and tells the service to stop working on it.
+        """
+        self.close()
+        self.container.send_cancel(self)
+
+
+class BatchRequestChannel(RequestChannel):
+    def __init__(self, request, container, requests):
+        super(BatchRequestChannel, self).__init__(request, container)
+        self.requests = requests
+
+    def get(self, timeout=1):
+        """
+        Returns a list with one entry per request of the batch: either the
+        reply message or the :class:`RpcError` that :meth:`RequestChannel.get`
+        would have raised for it.
+        """
+        msg = super(BatchRequestChannel, self).get(timeout=timeout)
+        results = []
+        for request, (msg_type, body) in zip(self.requests, msg.body):
+            reply = Message(
+                msg_type=msg_type.encode('ascii'),
+                subject=request.id,
+                body=body,
+                source=msg.source,
+                headers=msg.headers,
+                lazy=True,
+            )
+            results.append(get_reply_error(request, reply) or reply)
+        return results
 
 
 class ReplyChannel(Channel):
     def __init__(self, request, container):
         super(ReplyChannel, self).__init__(request, container)
         self._sent_reply = False
+        self._chunks = []
+        self._credits = request.headers.get('stream_window', 0)
+        self._credit_event = None
+        self._cancelled = False
 
-    def reply(self, body):
-        self.container.send_reply(self.request, body)
+    def _send_reply(self, body, msg_type=Message.REP):
+        self.container.send_reply(self.request, body, msg_type=msg_type)
         self._sent_reply = True
 
+    def reply(self, body):
+        self._send_reply(body)
+
     def ack(self, unless_reply_sent=False):
         if unless_reply_sent and self._sent_reply:
             return
-        self.container.send_reply(self.request, None, msg_type=Message.ACK)
-        self._sent_reply = True
+        self._send_reply(None, msg_type=Message.ACK)
 
     def nack(self, unless_reply_sent=False):
         if unless_reply_sent and self._sent_reply:
             return
-        self.container.send_reply(self.request, None, msg_type=Message.NACK)
-        self._sent_reply = True
+        self._send_reply(None, msg_type=Message.NACK)
 
     def error(self, **body):
-        self.container.send_reply(self.request, body, msg_type=Message.ERROR)
+        self._send_reply(body, msg_type=Message.ERROR)
+
+    def send_chunk(self, body):
+        """
+        Sends `body` as the next chunk of a streaming reply, which must be
+        finished with :meth:`end_stream`. Blocks while the client hasn't
+        granted credit for another chunk.
+
+        If the client didn't ask for a streaming reply, chunks are collected
+        and :meth:`end_stream` replies with the list of all chunks.
+        """
+        if not self.request.headers.get('stream_window'):
+            self._chunks.append(body)
+            return
+        if self._credit_event is None:
+            self._credit_event = gevent.event.Event()
+        while self._credits <= 0 and not self._cancelled:
+            self._credit_event.clear()
+            if not self._credit_event.wait(timeout=STREAM_CREDIT_TIMEOUT):
+                raise Timeout(self.request)
+        if self._cancelled:
+            raise Cancelled(self.request)
+        self._credits -= 1
+        self.container.send_reply(self.request, body, msg_type=Message.CHUNK)
+
+    def end_stream(self):
+        if self.request.headers.get('stream_window'):
+            self.reply(None)
+        else:
+            self.reply(self._chunks)
+
+    def add_credit(self, n):
+        self._credits += n
+        if self._credit_event is not None:
+            self._credit_event.set()
+
+    def cancel(self):
+        self._cancelled = True
+        if self._credit_event is not None:
+            self._credit_event.set()
+        self.container.executor.cancel(self)
+
+    def is_cancelled(self):
+        """
+        Returns True if the client has abandoned the request. Long running
+        handlers should check this and stop early.
+        """
+        return self._cancelled
+
+    def close(self):
+        self.container.reply_channels.pop(self.request.id, None)
+
+    def drop(self):
+        """
+        Called instead of running the request, e.g. because it expired or
+        was cancelled.
+        """
+        self.close()
+
+
+class BatchReplyChannel(Channel):
+    """
+    Collects the replies to the requests of a batch and sends them as a
+    single reply once every request has been answered.
+    """
+    def __init__(self, request, container):
+        super(BatchReplyChannel, self).__init__(request, container)
+        self.results = [None] * len(request.body)
+        self.remaining = len(self.results)
+        self.items = []
+        self.cancelled = False
+
+    def add_result(self, index, body, msg_type=Message.REP):
+        if self.results[index] is not None:
+            return
+        self.results[index] = (msg_type.decode('ascii'), body)
+        self.remaining -= 1
+        if not self.remaining:
+            self.close()
+            if not self.cancelled:
+                self.container.send_reply(self.request, self.results)
+
+    def cancel(self):
+        self.cancelled = True
+        self.close()
+        for item in self.items:
+            item.cancel()
 
     def close(self):
-        pass
+        self.container.reply_channels.pop(self.request.id, None)
+
+
+class BatchItemChannel(ReplyChannel):
+    def __init__(self, request, container, batch, index):
+        super(BatchItemChannel, self).__init__(request, container)
+        self.batch = batch
+        self.index = index
+
+    def _send_reply(self, body, msg_type=Message.REP):
+        self.batch.add_result(self.index, body, msg_type=msg_type)
+        self._sent_reply = True
+
+    def drop(self):
+        # the batch is only answered once every item has a result
+        self.nack(True)
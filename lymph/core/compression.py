@@ -0,0 +1,125 @@
+import collections
+import logging
+import zlib
+
+import six
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+
+#: compressed bodies smaller than this aren't worth the CPU time
+DEFAULT_THRESHOLD = 16 * 1024
+
+
+class Codec(object):
+    def __init__(self, name, code, compress, decompress, errors=()):
+        self.name = name
+        self.code = code
+        self.prefix = six.int2byte(code)
+        self._compress = compress
+        self._decompress = decompress
+        self.errors = errors
+
+    def __repr__(self):
+        return '<Codec %s>' % self.name
+
+    def compress(self, data):
+        return self.prefix + self._compress(data)
+
+    def decompress(self, data):
+        try:
+            return self._decompress(data)
+        except self.errors as e:
+            raise ValueError('cannot decompress %s data: %s' % (self.name, e))
+
+
+codecs = collections.OrderedDict()
+
+
+def register_codec(codec):
+    codecs[codec.name] = codec
+
+
+if zstandard is not None:
+    register_codec(Codec(
+        'zstd', 3,
+        zstandard.ZstdCompressor(level=1).compress,
+        zstandard.ZstdDecompressor().decompress,
+        errors=(zstandard.ZstdError,),
+    ))
+
+if lz4 is not None:
+    register_codec(Codec('lz4', 2, lz4.frame.compress, lz4.frame.decompress, errors=(RuntimeError,)))
+
+register_codec(Codec('zlib', 1, lambda data: zlib.compress(data, 1), zlib.decompress, errors=(zlib.error,)))
+
+_codecs_by_code = {codec.code: codec for codec in codecs.values()}
+
+
+def get_codecs(names=None):
+    """
+    Returns the names of the available codecs among `names`, in order of
+    preference. All available codecs are returned if `names` is True, none
+    if it is None or False.
+    """
+    if names is True:
+        return list(codecs)
+    available = []
+    for name in names or ():
+        if name in codecs:
+            available.append(name)
+        else:
+            logger.warning('compression codec %s is not available', name)
+    return available
+
+
+def decompress(data):
+    """
+    Decompresses `data` that was returned by :meth:`Codec.compress`.
+    """
+    code = six.indexbytes(data, 0)
+    try:
+        codec = _codecs_by_code[code]
+    except KeyError:
+        raise ValueError('unknown compression codec: %s' % code)
+    return codec.decompress(memoryview(data)[1:])
+
+
+class CompressionCounter(object):
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.time = 0
+
+    def add(self, size, compressed_size, elapsed):
+        self.count += 1
+        self.size += size
+        self.compressed_size += compressed_size
+        self.time += elapsed
+
+    @property
+    def ratio(self):
+        if not self.compressed_size:
+            return None
+        return self.size / float(self.compressed_size)
+
+    def stats(self):
+        return {
+            'messages': self.count,
+            'bytes': self.size,
+            'compressed_bytes': self.compressed_size,
+            'ratio': self.ratio,
+            'time': self.time * 1000,  # milliseconds
+        }
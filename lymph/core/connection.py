@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import division, unicode_literals
 
+import collections
 import gevent
 import math
 import os
 import time
 import logging
 
-from lymph.utils import SampleWindow
-from lymph.exceptions import RpcError
+from lymph.core import trace
+from lymph.core.breaker import CircuitBreaker
+from lymph.core.compression import codecs, CompressionCounter
+from lymph.utils import EWMA, SampleWindow
+from lymph.utils.timerwheel import TimerWheel
 
 
 UNKNOWN = 'unknown'
@@ -17,16 +21,20 @@ UNRESPONSIVE = 'unresponsive'
 CLOSED = 'closed'
 IDLE = 'idle'
 
-MIN_HEARTBEAT_INTERVAL = .01
+logger = logging.getLogger(__name__)
 
 
-logger = logging.getLogger(__name__)
+def result_successful(result):
+    return result.ready() and result.successful()
 
 
 class Connection(object):
-    def __init__(self, container, endpoint, heartbeat_interval=1, timeout=1, idle_timeout=10, unresponsive_disconnect=30, idle_disconnect=60):
+    def __init__(self, container, endpoint, transport_endpoint=None, heartbeat_interval=1, timeout=1, idle_timeout=10, unresponsive_disconnect=30, idle_disconnect=60, breaker=None):
         self.container = container
         self.endpoint = endpoint
+        # the routing id of the peer on our ROUTER socket
+        self.identity = endpoint.encode('utf-8')
+        self.transport_endpoint = transport_endpoint or endpoint
         self.timeout = timeout
         self.heartbeat_interval = heartbeat_interval
         self.idle_timeout = idle_timeout
@@ -35,19 +43,32 @@ class Connection(object):
 
         now = time.monotonic()
         self.last_seen = 0
+        self.last_received = 0
         self.idle_since = 0
         self.last_message = now
         self.created_at = now
         self.heartbeat_samples = SampleWindow(100, factor=1000)  # milliseconds
         self.roundtrip_samples = SampleWindow(100, factor=1000)  # milliseconds
+        self.latency = EWMA(factor=1000)  # milliseconds
+        self.in_flight = 0
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
         self.explicit_heartbeat_count = 0
+        self.skipped_heartbeat_count = 0
+        self.last_ping = 0
+        self.ping_id = None
         self.status = UNKNOWN
+        self.wire_version = 1
+        # the request subjects the peer confirmed it knows by their hash
+        self.hashed_subjects = set()
+        self.codec = None
+        self.compressed = CompressionCounter()
+        self.decompressed = CompressionCounter()
 
         self.received_message_count = 0
         self.sent_message_count = 0
+        self.send_queue = collections.deque()
 
-        self.heartbeat_loop_greenlet = self.container.spawn(self.heartbeat_loop)
-        self.live_check_loop_greenlet = self.container.spawn(self.live_check_loop)
+        self.container.heartbeats.add(self)
 
     def __str__(self):
         return "connection to=%s last_seen=%s" % (self.endpoint, self._dt())
@@ -65,30 +86,48 @@ class Connection(object):
     def set_status(self, status):
         self.status = status
 
-    def heartbeat_loop(self):
-        while True:
-            start = time.monotonic()
-            channel = self.container.ping(self.endpoint)
-            try:
-                channel.get(timeout=self.heartbeat_interval)
-            except RpcError:
-                pass
-            else:
-                self.roundtrip_samples.add(time.monotonic() - start)
-                self.explicit_heartbeat_count += 1
-            gevent.sleep(max(self.heartbeat_interval - .001 * self.roundtrip_samples.mean, MIN_HEARTBEAT_INTERVAL))
-
-    def live_check_loop(self):
-        while True:
-            if self.last_seen:
-                now = time.monotonic()
-                if now - self.last_seen >= self.timeout:
-                    self.set_status(UNRESPONSIVE)
-                elif now - self.last_message >= self.idle_timeout:
-                    self.set_status(IDLE)
-                    self.idle_since = now
-                else:
-                    self.set_status(RESPONSIVE)
+    def heartbeat(self):
+        """
+        Called by the :class:`HeartbeatScheduler` every `heartbeat_interval`
+        seconds. Updates the status and pings the peer unless it sent us a
+        message other than a heartbeat recently. Connections past
+        `idle_disconnect` or
+        `unresponsive_disconnect` are closed instead.
+        """
+        now = time.monotonic()
+        self.check_status(now)
+        reason = self.get_disconnect_reason(now)
+        if reason:
+            self.container.reap_connection(self, reason)
+            return
+        if now - self.last_received < self.heartbeat_interval and now - self.last_ping < self.idle_timeout:
+            self.skipped_heartbeat_count += 1
+            return
+        self.last_ping = now
+        channel = self.container.ping(self.endpoint, timeout=self.heartbeat_interval)
+        self.ping_id = channel.request.id
+        channel.result.rawlink(lambda result: self.on_pong(channel, now))
+
+    def on_pong(self, channel, sent_at):
+        channel.close()
+        if result_successful(channel.result):
+            self.roundtrip_samples.add(time.monotonic() - sent_at)
+            self.explicit_heartbeat_count += 1
+
+    def check_status(self, now):
+        if not self.last_seen:
+            # peers that never answered are unresponsive after a grace period
+            if now - self.created_at >= self.timeout:
+                self.set_status(UNRESPONSIVE)
+        elif now - self.last_seen >= self.timeout:
+            self.set_status(UNRESPONSIVE)
+        elif now - self.last_message >= self.idle_timeout:
+            if self.status != IDLE:
+                self.idle_since = now
+            self.set_status(IDLE)
+        else:
+            self.set_status(RESPONSIVE)
+        if logger.isEnabledFor(logging.DEBUG):
             heartbeat_stats = 'window (mean ♡ = {mean:.1f} ms; stddev ♡ = {stddev:.1f})'.format(**self.heartbeat_samples.stats)
             heartbeat_total_stats = 'total (mean ♡ = {mean:.1f} ms; stddev ♡ = {stddev:.1f})'.format(**self.heartbeat_samples.total.stats)
             roundtrip_stats = 'mean rtt = {mean:.3f} ms; stddev rtt = {stddev:.3f}'.format(**self.roundtrip_samples.stats)
@@ -98,17 +137,30 @@ class Connection(object):
                 heartbeat_stats,
                 heartbeat_total_stats,
                 self.phi,
-                self.explicit_heartbeat_count / (time.monotonic() - self.created_at),
+                self.explicit_heartbeat_count / (now - self.created_at),
                 self.status,
             ))
-            gevent.sleep(self.timeout)
+
+    def get_disconnect_reason(self, now):
+        """
+        Returns why this connection should be closed, or None. Peers that
+        never replied count as unresponsive since the connection was created.
+        A timeout of None disables the corresponding check.
+        """
+        if self.status == IDLE:
+            if self.idle_disconnect is not None and now - self.idle_since >= self.idle_disconnect:
+                return IDLE
+        elif self.status == UNRESPONSIVE:
+            if self.unresponsive_disconnect is not None and now - (self.last_seen or self.created_at) >= self.unresponsive_disconnect:
+                return UNRESPONSIVE
+        return None
 
     def close(self):
         if self.status == CLOSED:
             return
         self.status = CLOSED
-        self.heartbeat_loop_greenlet.kill()
-        self.live_check_loop_greenlet.kill()
+        self.send_queue.clear()
+        self.container.heartbeats.remove(self)
         self.container.disconnect(self.endpoint)
 
     def on_recv(self, msg):
@@ -118,23 +170,169 @@ class Connection(object):
         self.last_seen = now
         if not msg.is_idle_chatter():
             self.last_message = now
+        if not self.is_heartbeat(msg):
+            self.last_received = now
         self.received_message_count += 1
+        self.wire_version = max(msg.version, msg.headers.pop('wire', 1))
+        if msg.subject == 'lymph.ping' and msg.is_request():
+            self.set_peer_codecs(msg.headers.get('codecs', ()))
+
+    def set_peer_codecs(self, names):
+        """
+        Picks the first of our compression codecs that the peer supports.
+        """
+        self.codec = None
+        for name in self.container.compression_codecs:
+            if name in names:
+                self.codec = codecs[name]
+                break
+
+    def compress(self, data):
+        """
+        Returns `data` compressed with the negotiated codec, or None if it's
+        too small or doesn't compress well.
+        """
+        if self.codec is None or len(data) < self.container.compression_threshold:
+            return None
+        start = time.monotonic()
+        compressed = self.codec.compress(data)
+        if len(compressed) >= len(data):
+            return None
+        self.compressed.add(len(data), len(compressed), time.monotonic() - start)
+        return compressed
+
+    def decompress(self, msg):
+        start = time.monotonic()
+        compressed_size, size = msg.decompress()
+        self.decompressed.add(size, compressed_size, time.monotonic() - start)
+
+    def is_heartbeat(self, msg):
+        """
+        Returns True if `msg` is a ping of the peer or the reply to our last
+        ping.
+        """
+        if msg.is_request():
+            return msg.subject == 'lymph.ping'
+        return msg.subject == self.ping_id
 
     def on_send(self, msg):
         if not msg.is_idle_chatter():
             self.last_message = time.monotonic()
         self.sent_message_count += 1
 
+    def start_request(self):
+        self.in_flight += 1
+
+    def finish_request(self, elapsed):
+        """
+        Called once for each request sent over this connection when it has
+        been answered, timed out or was abandoned after `elapsed` seconds.
+        """
+        self.in_flight -= 1
+        self.latency.add(elapsed)
+
     def is_alive(self):
         return self.status in (RESPONSIVE, IDLE)
 
     def stats(self):
         return {
             'endpoint': self.endpoint,
+            'transport_endpoint': self.transport_endpoint,
             'rtt': self.roundtrip_samples.stats,
+            'latency': self.latency.value,
+            'in_flight': self.in_flight,
+            'breaker': self.breaker.stats(),
             'heartbeat': self.heartbeat_samples.stats,
             'phi': self.phi,
             'status': self.status,
             'sent': self.sent_message_count,
             'received': self.received_message_count,
+            'pings': self.explicit_heartbeat_count,
+            'skipped_pings': self.skipped_heartbeat_count,
+            'queued': len(self.send_queue),
+            'wire_version': self.wire_version,
+            'compression': {
+                'codec': self.codec.name if self.codec else None,
+                'sent': self.compressed.stats(),
+                'received': self.decompressed.stats(),
+            },
         }
+
+
+class LoopbackConnection(object):
+    """
+    Takes the place of a :class:`Connection` for messages that a container
+    dispatches to itself (see :meth:`ServiceContainer.send_local_message`).
+    """
+    def __init__(self, container):
+        self.container = container
+        self.endpoint = container.endpoint
+        self.transport_endpoint = 'local'
+        self.sent_message_count = 0
+        self.in_flight = 0
+
+    def on_send(self, msg):
+        self.sent_message_count += 1
+
+    def start_request(self):
+        self.in_flight += 1
+
+    def finish_request(self, elapsed):
+        self.in_flight -= 1
+
+    def is_alive(self):
+        return True
+
+    def stats(self):
+        return {
+            'endpoint': self.endpoint,
+            'transport_endpoint': self.transport_endpoint,
+            'sent': self.sent_message_count,
+            'in_flight': self.in_flight,
+        }
+
+
+class HeartbeatScheduler(object):
+    """
+    Drives the heartbeats of all connections of a container from a single
+    greenlet. Each connection is kept in a :class:`TimerWheel` until its
+    next heartbeat is due.
+    """
+    def __init__(self, container, tick=.05):
+        self.container = container
+        self.wheel = TimerWheel(tick=tick)
+        self.loop_greenlet = None
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def add(self, connection, delay=0):
+        self.wheel.add(connection.endpoint, connection, delay)
+
+    def remove(self, connection):
+        if self.wheel.get(connection.endpoint) is connection:
+            self.wheel.remove(connection.endpoint)
+
+    def start(self):
+        self.loop_greenlet = self.container.spawn(self.loop)
+
+    def stop(self):
+        if self.loop_greenlet:
+            self.loop_greenlet.kill()
+
+    def loop(self):
+        # don't inherit the deadline of whatever started the container
+        trace.set_deadline(None)
+        tick = self.wheel.tick
+        last_tick = time.monotonic()
+        while True:
+            gevent.sleep(tick)
+            now = time.monotonic()
+            while last_tick + tick <= now:
+                last_tick += tick
+                for endpoint, connection in self.wheel.advance():
+                    self.add(connection, connection.heartbeat_interval)
+                    try:
+                        connection.heartbeat()
+                    except Exception:
+                        logger.exception('heartbeat failure (%s)', endpoint)
@@ -1,13 +1,17 @@
 import collections
+import copy
 import errno
+import functools
 import json
 import gc
 import hashlib
+import heapq
 import logging
 import random
 import time
 import os
 import sys
+import tempfile
 
 import gevent
 import gevent.queue
@@ -15,21 +19,31 @@ import gevent.pool
 import six
 import zmq.green as zmq
 
-from lymph.exceptions import RegistrationFailure, SocketNotCreated, NotConnected
-from lymph.core.connection import Connection
-from lymph.core.channels import RequestChannel, ReplyChannel
+from lymph.exceptions import RegistrationFailure, SocketNotCreated, NotConnected, Cancelled, CircuitOpen
+from lymph.core.breaker import CircuitBreaker, is_guarded
+from lymph.core.connection import Connection, LoopbackConnection, HeartbeatScheduler, UNRESPONSIVE
+from lymph.core.channels import RequestChannel, ReplyChannel, BatchRequestChannel, BatchReplyChannel, BatchItemChannel, PendingRequests
 from lymph.core.events import Event
-from lymph.core.messages import Message
+from lymph.core.executor import RequestExecutor
+from lymph.core.hedging import HedgedRequestChannel
+from lymph.core.compression import get_codecs, DEFAULT_THRESHOLD as COMPRESSION_THRESHOLD
+from lymph.core.messages import Message, WIRE_VERSION, hash_subject
 from lymph.core.monitoring import Monitor
 from lymph.core.services import ServiceInstance
 from lymph.core.interfaces import DefaultInterface
 from lymph.core.plugins import Hook
 from lymph.core import trace
+from lymph.utils.sockets import send_zmq_frames, ZERO_COPY_THRESHOLD
 
 
 logger = logging.getLogger(__name__)
 
 
+# maps the tcp:// endpoints of the containers in this process to their
+# inproc:// endpoints
+_inproc_endpoints = {}
+
+
 def create_container(config):
     registry = config.create_instance('registry')
     event_system = config.create_instance('event_system')
@@ -43,7 +57,7 @@ def create_container(config):
 
 
 class ServiceContainer(object):
-    def __init__(self, ip='127.0.0.1', port=None, registry=None, logger=None, events=None, node_endpoint=None, log_endpoint=None, service_name=None, debug=False, monitor_endpoint=None):
+    def __init__(self, ip='127.0.0.1', port=None, registry=None, logger=None, events=None, node_endpoint=None, log_endpoint=None, service_name=None, debug=False, monitor_endpoint=None, recv_batch_size=64, recv_batch_latency=.005, max_concurrent_requests=100, request_backlog=1000, zero_copy_threshold=ZERO_COPY_THRESHOLD, connect_timeout=1, pending_request_ttl=60, wire_version=WIRE_VERSION, compression=None, compression_threshold=COMPRESSION_THRESHOLD, ipc=True, ipc_dir=None, local_dispatch=False, local_dispatch_copy=True, max_connections=1000, idle_disconnect=60, unresponsive_disconnect=30, balancer='least_outstanding', circuit_breaker_threshold=5, circuit_breaker_timeout=5, retry_budget=.1):
         self.zctx = zmq.Context.instance()
         self.ip = ip
         self.port = port
@@ -52,18 +66,46 @@ class ServiceContainer(object):
         self.endpoint = None
         self.service_name = service_name
         self.bound = False
+        self.recv_batch_size = max(int(recv_batch_size), 1)
+        self.recv_batch_latency = recv_batch_latency
+        self.zero_copy_threshold = zero_copy_threshold
+        self.connect_timeout = connect_timeout
+        self.wire_version = wire_version
+        self.compression_codecs = get_codecs(compression)
+        self.compression_threshold = compression_threshold
+        self.ipc_dir = (ipc_dir or tempfile.gettempdir()) if ipc else None
+        self.inproc_endpoint = None
+        self.ipc_endpoint = None
+        self.local_dispatch = local_dispatch
+        self.local_dispatch_copy = local_dispatch_copy
+        self.max_connections = max_connections
+        self.idle_disconnect = idle_disconnect
+        self.unresponsive_disconnect = unresponsive_disconnect
+        self.balancer = balancer
+        self.circuit_breaker_threshold = circuit_breaker_threshold
+        self.circuit_breaker_timeout = circuit_breaker_timeout
+        self.retry_budget = retry_budget
+        self.subjects = {}
 
         self.request_counts = collections.Counter()
 
         self.recv_loop_greenlet = None
-        self.channels = {}
+        self.channels = PendingRequests(self, ttl=pending_request_ttl)
+        self.reply_channels = {}
         self.connections = {}
+        # circuit breakers by endpoint, they outlive reaped connections
+        self.breakers = {}
+        self.reaped_connection_counts = collections.Counter()
+        self.heartbeats = HeartbeatScheduler(self)
         self.pool = trace.Group()
+        self.executor = RequestExecutor(self, size=max_concurrent_requests, backlog=request_backlog)
         self.service_registry = registry
         self.event_system = events
 
+        self.register_subject('lymph.batch')
         self.bind()
         self.identity = hashlib.md5(self.endpoint.encode('utf-8')).hexdigest()
+        self.loopback = LoopbackConnection(self)
         self.installed_interfaces = {}
         self.installed_plugins = []
         self.error_hook = Hook()
@@ -94,8 +136,28 @@ class ServiceContainer(object):
         obj = cls(self, **kwargs)
         obj.name = interface_name
         self.installed_interfaces[obj.name] = obj
+        for method_name in getattr(obj, 'methods', ()):
+            self.register_subject('%s.%s' % (obj.name, method_name))
         return obj
 
+    def register_subject(self, subject):
+        """
+        Makes `subject` known to the v2 wire format which only transmits a
+        hash of the subjects of requests.
+        """
+        subject_hash = hash_subject(subject)
+        known = self.subjects.get(subject_hash, subject)
+        if known != subject:
+            logger.warning('subject hash collision: %s and %s', known, subject)
+            subject = None
+        self.subjects[subject_hash] = subject
+
+    def is_known_subject(self, subject):
+        """
+        Returns True if requests may refer to `subject` by its hash.
+        """
+        return self.subjects.get(hash_subject(subject)) == subject
+
     def install_plugin(self, cls, **kwargs):
         plugin = cls(self, **kwargs)
         self.installed_plugins.append(plugin)
@@ -130,7 +192,12 @@ class ServiceContainer(object):
                 'collections': gc.get_count(),
             },
             'rpc': self.rpc_stats(),
+            'pending_requests': self.channels.stats(),
+            'executor': self.executor.stats(),
             'connections': [c.stats() for c in self.connections.values()],
+            'reaped_connections': dict(self.reaped_connection_counts),
+            'local': self.loopback.stats(),
+            'services': {name: service.stats() for name, service in six.iteritems(getattr(self.service_registry, 'cache', {}))},
         }
         for name, interface in six.iteritems(self.installed_interfaces):
             s[name] = interface.stats()
@@ -147,6 +214,7 @@ class ServiceContainer(object):
         if self.bound:
             raise TypeError('this container is already bound (endpoint=%s)', self.endpoint)
         self.send_sock = self.zctx.socket(zmq.ROUTER)
+        self.send_sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
         self.recv_sock = self.zctx.socket(zmq.ROUTER)
         port = self.port
         retries = 0
@@ -171,8 +239,51 @@ class ServiceContainer(object):
                 self.port = port
                 self.bound = True
                 break
+        self.bind_local_endpoints()
+
+    def bind_local_endpoints(self):
+        """
+        Additionally binds the receive socket to an inproc:// endpoint for
+        containers in the same process and an ipc:// endpoint for containers
+        on the same host (see :meth:`get_transport_endpoint`).
+        """
+        identity = hashlib.md5(self.endpoint.encode('utf-8')).hexdigest()
+        self.inproc_endpoint = 'inproc://lymph-%s' % identity
+        self.recv_sock.bind(self.inproc_endpoint)
+        _inproc_endpoints[self.endpoint] = self.inproc_endpoint
+        if self.ipc_dir:
+            endpoint = 'ipc://%s' % self.get_ipc_path(self.endpoint)
+            try:
+                self.recv_sock.bind(endpoint)
+            except zmq.ZMQError as e:
+                logger.warning('cannot bind to %s: %s', endpoint, e)
+            else:
+                self.ipc_endpoint = endpoint
+
+    def get_ipc_path(self, endpoint):
+        identity = hashlib.md5(endpoint.encode('utf-8')).hexdigest()
+        return os.path.join(self.ipc_dir, 'lymph-%s.sock' % identity)
+
+    def get_transport_endpoint(self, endpoint):
+        """
+        Returns the endpoint the send socket connects to in order to reach the
+        container listening on `endpoint`: its inproc:// endpoint if it lives
+        in this process, its ipc:// endpoint if it's on the same host, and
+        `endpoint` otherwise.
+        """
+        try:
+            return _inproc_endpoints[endpoint]
+        except KeyError:
+            pass
+        if self.ipc_dir and endpoint.startswith('tcp://%s:' % self.ip):
+            path = self.get_ipc_path(endpoint)
+            if os.path.exists(path):
+                return 'ipc://%s' % path
+        return endpoint
 
     def close_sockets(self):
+        if _inproc_endpoints.get(self.endpoint) == self.inproc_endpoint:
+            del _inproc_endpoints[self.endpoint]
         self.recv_sock.close()
         self.send_sock.close()
 
@@ -197,6 +308,8 @@ class ServiceContainer(object):
         self.running = True
         logger.info('starting %s at %s (pid=%s)', ', '.join(self.service_types), self.endpoint, os.getpid())
         self.recv_loop_greenlet = self.spawn(self.recv_loop)
+        self.channels.start()
+        self.heartbeats.start()
         self.monitor.start()
         self.service_registry.on_start()
         self.event_system.on_start()
@@ -222,9 +335,12 @@ class ServiceContainer(object):
         self.event_system.on_stop()
         self.service_registry.on_stop()
         self.monitor.stop()
+        self.channels.stop()
+        self.heartbeats.stop()
         for connection in list(self.connections.values()):
             connection.close()
         self.recv_loop_greenlet.kill()
+        self.executor.stop()
         self.pool.kill()
         self.close_sockets()
 
@@ -233,14 +349,40 @@ class ServiceContainer(object):
         self.recv_loop_greenlet.join()
 
     def connect(self, endpoint):
-        if endpoint not in self.connections:
-            logger.debug("connect(%s)", endpoint)
-            self.connections[endpoint] = Connection(self, endpoint)
-            self.send_sock.connect(endpoint)
-            for service in six.itervalues(self.installed_interfaces):
-                service.on_connect(endpoint)
-            gevent.sleep(0.02)
-        return self.connections[endpoint]
+        try:
+            return self.connections[endpoint]
+        except KeyError:
+            pass
+        self.evict_connections()
+        transport_endpoint = self.get_transport_endpoint(endpoint)
+        logger.debug("connect(%s) via %s", endpoint, transport_endpoint)
+        connection = self.connections[endpoint] = self.create_connection(endpoint, transport_endpoint)
+        self.send_sock.connect(transport_endpoint)
+        for service in six.itervalues(self.installed_interfaces):
+            service.on_connect(endpoint)
+        return connection
+
+    def create_connection(self, endpoint, transport_endpoint=None):
+        return Connection(
+            self, endpoint,
+            transport_endpoint=transport_endpoint,
+            idle_disconnect=self.idle_disconnect,
+            unresponsive_disconnect=self.unresponsive_disconnect,
+            breaker=self.get_breaker(endpoint),
+        )
+
+    def get_breaker(self, endpoint):
+        """
+        Returns the circuit breaker of the instance at `endpoint`. It is kept
+        when the connection to the instance is closed, so that reaped
+        connections to failing instances don't start with a closed breaker.
+        """
+        try:
+            return self.breakers[endpoint]
+        except KeyError:
+            breaker = self.breakers[endpoint] = CircuitBreaker(
+                self.circuit_breaker_threshold, self.circuit_breaker_timeout)
+            return breaker
 
     def disconnect(self, endpoint, socket=False):
         try:
@@ -249,55 +391,297 @@ class ServiceContainer(object):
             return
         del self.connections[endpoint]
         connection.close()
+        if connection.breaker.is_pristine():
+            # nothing to remember about healthy instances
+            self.breakers.pop(endpoint, None)
         logger.debug("disconnect(%s)", endpoint)
         if socket:
-            self.send_sock.disconnect(endpoint)
+            self.disconnect_socket(connection.transport_endpoint)
         for service in six.itervalues(self.installed_interfaces):
             service.on_disconnect(endpoint)
 
+    def disconnect_socket(self, transport_endpoint):
+        try:
+            self.send_sock.disconnect(transport_endpoint)
+        except zmq.ZMQError as e:
+            logger.debug("cannot disconnect from %s: %s", transport_endpoint, e)
+
+    def reap_connection(self, connection, reason):
+        """
+        Closes `connection` and removes the peer from the send socket. The
+        next message to the peer transparently opens a new connection.
+        """
+        logger.info("disconnecting %s (%s)", connection.endpoint, reason)
+        self.reaped_connection_counts[reason] += 1
+        if reason == UNRESPONSIVE:
+            # keep the instance out of rotation until a probe succeeds
+            connection.breaker.open()
+        self.disconnect(connection.endpoint, socket=True)
+
+    def evict_connections(self):
+        """
+        Makes room for a new connection by reaping the least recently used
+        connections once `max_connections` is reached. Connections that
+        shouldn't be reaped when idle are never evicted.
+        """
+        if not self.max_connections:
+            return
+        excess = len(self.connections) - self.max_connections + 1
+        if excess <= 0:
+            return
+        candidates = [c for c in six.itervalues(self.connections) if c.idle_disconnect is not None]
+        for connection in heapq.nsmallest(excess, candidates, key=lambda c: c.last_message):
+            self.reap_connection(connection, 'evicted')
+
     def lookup(self, address):
         if '://' not in address:
             return self.service_registry.get(address)
         return ServiceInstance(self, address)
 
+    def route(self, address, route_key=None, exclude=None):
+        """
+        Returns the connection that a message to `address` is sent over.
+        Endpoints, e.g. the source of a request that is answered, are
+        looked up in the connection table, service names are resolved by
+        the balancer of the service.
+        """
+        connection = self.connections.get(address)
+        if connection is not None:
+            return connection
+        if '://' in address:
+            return self.connect(address)
+        return self.service_registry.get(address).connect(route_key, exclude=exclude)
+
     def discover(self):
         return self.service_registry.discover()
 
-    def send_message(self, address, msg):
+    def send_message(self, address, msg, route_key=None, exclude=None):
+        """
+        Sends `msg` to `address` and returns the connection it was sent
+        over, or None if it couldn't be sent.
+        """
+        connection = self.route_message(address, msg, route_key=route_key, exclude=exclude)
+        if connection is not None:
+            self.send_to(connection, msg)
+        return connection
+
+    def route_message(self, address, msg, route_key=None, exclude=None):
+        """
+        Returns the connection that `msg` is sent to `address` over, the
+        loopback connection for local addresses, or None if there is none.
+        Raises :exc:`CircuitOpen` if `msg` is a request and the circuit
+        breaker of the connection is open.
+        """
         if not self.running:
             # FIXME: This should raise an Error instead of failing silently.
             logger.error('cannot send message (container not started): %s', msg)
-            return
-        service = self.lookup(address)
+            return None
+        if self.is_local_address(address):
+            return self.loopback
         try:
-            connection = service.connect()
+            connection = self.route(address, route_key=route_key, exclude=exclude)
         except NotConnected:
             logger.error('cannot send message (no connection): %s', msg)
-            return
-        self.send_sock.send(connection.endpoint.encode('utf-8'), flags=zmq.SNDMORE)
-        self.send_sock.send_multipart(msg.pack_frames())
+            return None
+        if msg.type == Message.REQ and is_guarded(msg) and not connection.breaker.is_available():
+            raise CircuitOpen(msg)
+        return connection
+
+    def send_to(self, connection, msg):
+        """
+        Sends `msg` over `connection`. Returns the tracker of the zero-copy
+        send if the message has large frames (see :func:`send_zmq_frames`).
+        """
+        if connection is self.loopback:
+            self.send_local_message(msg)
+            return None
+        version = min(self.wire_version, connection.wire_version)
+        frames = msg.pack_frames(
+            version, compress=connection.compress, hashed_subjects=connection.hashed_subjects,
+            identity=connection.identity)
+        tracker = self.send_frames(connection, frames)
         logger.debug('-> %s to %s', msg, connection.endpoint)
         connection.on_send(msg)
+        return tracker
+
+    def is_local_address(self, address):
+        """
+        Returns True if messages to `address` are dispatched in-process, i.e.
+        if local dispatch is enabled and `address` is either the endpoint of
+        this container or the name of one of its interfaces.
+        """
+        return self.local_dispatch and (address == self.endpoint or address in self.installed_interfaces)
+
+    def send_local_message(self, msg):
+        """
+        Dispatches `msg` as if it had been received from this container,
+        without serializing it. The body is copied unless
+        `local_dispatch_copy` is disabled.
+        """
+        body = msg.body
+        if self.local_dispatch_copy:
+            body = copy.deepcopy(body)
+        local_msg = Message(
+            msg_type=msg.type,
+            subject=msg.subject,
+            body=body,
+            msg_id=msg.id,
+            source=self.endpoint,
+            headers=dict(msg.headers),
+            lazy=True,
+        )
+        logger.debug('-> %s (local)', msg)
+        self.loopback.on_send(msg)
+        self.dispatch_message(local_msg)
+        return self.loopback
+
+    def send_frames(self, connection, frames):
+        """
+        Sends `frames` to `connection` right away if the peer is reachable.
+        Otherwise the frames are queued on the connection and sent as soon as
+        the peer becomes reachable (see :meth:`flush_send_queue`).
+        """
+        if not connection.send_queue:
+            try:
+                return send_zmq_frames(self.send_sock, frames, self.zero_copy_threshold)
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+            self.spawn(self.flush_send_queue, connection)
+        connection.send_queue.append(frames)
+
+    def flush_send_queue(self, connection):
+        deadline = time.monotonic() + self.connect_timeout
+        delay = .001
+        queue = connection.send_queue
+        while queue:
+            try:
+                send_zmq_frames(self.send_sock, queue[0], self.zero_copy_threshold)
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    logger.error('cannot send message to %s: %s', connection.endpoint, e)
+                elif time.monotonic() < deadline:
+                    gevent.sleep(delay)
+                    delay = min(2 * delay, .016)
+                    continue
+                else:
+                    logger.error('cannot send %s queued messages (%s unreachable)', len(queue), connection.endpoint)
+                    queue.clear()
+                    return
+            queue.popleft()
 
     def prepare_headers(self, headers):
         headers = headers or {}
         headers.setdefault('trace_id', trace.get_id())
         return headers
 
-    def send_request(self, address, subject, body, headers=None):
+    def prepare_request_headers(self, headers, timeout=None):
+        """
+        Like :meth:`prepare_headers`, but also sets the absolute `deadline`
+        of the request. Requests sent while handling another request inherit
+        its deadline if that is earlier.
+        """
+        headers = self.prepare_headers(headers)
+        deadline = trace.get_deadline()
+        if timeout is not None:
+            timeout_deadline = time.time() + timeout
+            if deadline is None or timeout_deadline < deadline:
+                deadline = timeout_deadline
+        if deadline is not None:
+            headers.setdefault('deadline', deadline)
+        return headers
+
+    def send_request(self, address, subject, body, headers=None, stream_window=None, timeout=None, route_key=None, hedge=None, exclude=None):
+        """
+        Sends a request and returns the channel for its reply. If `hedge` is
+        a :class:`HedgePolicy`, a duplicate may be sent to another instance
+        of the service while waiting for the reply. The request is not sent
+        to the instance with the endpoint `exclude` if there is another one.
+        """
+        request_headers = self.prepare_request_headers(headers, timeout=timeout)
+        if stream_window:
+            request_headers['stream_window'] = stream_window
         msg = Message(
             msg_type=Message.REQ,
             subject=subject,
             body=body,
             source=self.endpoint,
-            headers=self.prepare_headers(headers),
+            headers=request_headers,
         )
         channel = RequestChannel(msg, self)
-        self.channels[msg.id] = channel
-        self.send_message(address, msg)
+        self.channels.add(channel)
+        try:
+            connection = self.route_message(address, msg, route_key=route_key, exclude=exclude)
+        except CircuitOpen:
+            self.channels.remove(msg.id)
+            raise
+        if connection is not None:
+            channel.tracker = self.send_to(connection, msg)
+        channel.set_connection(connection)
+        if hedge is not None and not stream_window and self.can_hedge(address):
+            hedge_headers = dict(headers or {})
+            if msg.deadline is not None:
+                hedge_headers['deadline'] = msg.deadline
+            resend = functools.partial(
+                self.send_request, address, subject, body, headers=hedge_headers, timeout=timeout, route_key=route_key)
+            return HedgedRequestChannel(self, channel, hedge, resend)
+        return channel
+
+    def can_hedge(self, address):
+        if '://' in address or self.is_local_address(address):
+            return False
+        return len(self.lookup(address)) > 1
+
+    def send_batch(self, address, requests, headers=None, timeout=None, route_key=None):
+        """
+        Sends several requests to `address` in a single message. `requests`
+        is a sequence of `(subject, body)` pairs.
+        """
+        requests = [Message(
+            msg_type=Message.REQ,
+            subject=subject,
+            body=body,
+            lazy=True,
+        ) for subject, body in requests]
+        msg = Message(
+            msg_type=Message.BATCH,
+            subject='lymph.batch',
+            body=[[request.subject, request.body] for request in requests],
+            source=self.endpoint,
+            headers=self.prepare_request_headers(headers, timeout=timeout),
+        )
+        channel = BatchRequestChannel(msg, self, requests)
+        self.channels.add(channel)
+        connection = self.route_message(address, msg, route_key=route_key)
+        if connection is not None:
+            channel.tracker = self.send_to(connection, msg)
+        channel.set_connection(connection)
         return channel
 
+    def send_credit(self, address, request, n):
+        msg = Message(
+            msg_type=Message.CREDIT,
+            subject=request.id,
+            body=n,
+            source=self.endpoint,
+        )
+        self.send_message(address, msg)
+
+    def send_cancel(self, channel):
+        if channel.connection is None:
+            return
+        msg = Message(
+            msg_type=Message.CANCEL,
+            subject=channel.request.id,
+            body=None,
+            source=self.endpoint,
+        )
+        self.send_message(channel.connection.endpoint, msg)
+
     def send_reply(self, msg, body, msg_type=Message.REP, headers=None):
+        if msg.version >= 2 and not msg.subject_hashed and msg_type != Message.CHUNK and self.is_known_subject(msg.subject):
+            # the client may send the hash of the subject from now on
+            headers = dict(headers or (), subject_hash=True)
         reply_msg = Message(
             msg_type=msg_type,
             subject=msg.id,
@@ -305,21 +689,54 @@ class ServiceContainer(object):
             source=self.endpoint,
             headers=self.prepare_headers(headers),
         )
-        self.send_message(msg.source, reply_msg)
+        connection = self.connections.get(msg.source)
+        if connection is None or not self.running or self.is_local_address(msg.source):
+            self.send_message(msg.source, reply_msg)
+        else:
+            # the request came in over this connection, reply straight to it
+            self.send_to(connection, reply_msg)
         return reply_msg
 
-    def dispatch_request(self, msg):
+    def dispatch_batch(self, msg):
+        batch = BatchReplyChannel(msg, self)
+        if not batch.remaining:
+            self.send_reply(msg, [])
+            return
+        self.reply_channels[msg.id] = batch
+        for index, (subject, body) in enumerate(msg.body):
+            if '.' not in subject or subject.rsplit('.', 1)[0] not in self.installed_interfaces:
+                logger.warning('unsupported subject in batch: %s', subject)
+                batch.add_result(index, None, msg_type=Message.NACK)
+                continue
+            request = Message(
+                msg_type=Message.REQ,
+                subject=subject,
+                body=body,
+                msg_id='%s.%s' % (msg.id, index),
+                source=msg.source,
+                headers=msg.headers,
+                lazy=True,
+            )
+            channel = BatchItemChannel(request, self, batch, index)
+            batch.items.append(channel)
+            if not self.executor.submit(request, channel=channel):
+                batch.add_result(index, None, msg_type=Message.OVERLOADED)
+
+    def dispatch_request(self, msg, channel=None):
         start = time.time()
         self.request_counts[msg.subject] += 1
-        channel = ReplyChannel(msg, self)
-        service_name, func_name = msg.subject.rsplit('.', 1)
-        try:
-            service = self.installed_interfaces[service_name]
-        except KeyError:
-            logger.warning('unsupported service type: %s', service_name)
-            return
+        if channel is None:
+            channel = ReplyChannel(msg, self)
+        service_name, _, func_name = msg.subject.rpartition('.')
         try:
+            service = self.installed_interfaces.get(service_name)
+            if service is None:
+                logger.warning('unsupported service type: %s', service_name or msg.subject)
+                channel.nack(True)
+                return
             service.handle_request(func_name, channel)
+        except Cancelled:
+            logger.info('request cancelled: %s', msg)
         except Exception:
             logger.exception('Request error:')
             exc_info = sys.exc_info()
@@ -334,6 +751,7 @@ class ServiceContainer(object):
             except:
                 logger.exception('failed to send automatic NACK')
         finally:
+            channel.close()
             elapsed = (time.time() - start) * (10 ** 3)
             self._log_request(msg, elapsed)
 
@@ -350,33 +768,97 @@ class ServiceContainer(object):
         logger.debug('<- %s', msg)
         connection = self.connect(msg.source)
         connection.on_recv(msg)
-        if msg.is_request():
-            self.spawn(self.dispatch_request, msg)
-        elif msg.is_reply():
+        if msg.compressed:
             try:
-                channel = self.channels[msg.subject]
-            except KeyError:
+                connection.decompress(msg)
+            except ValueError as e:
+                logger.warning('dropping message %s: %s', msg, e)
+                return
+        self.dispatch_message(msg)
+
+    def dispatch_message(self, msg):
+        if msg.is_batch():
+            self.dispatch_batch(msg)
+        elif msg.is_request():
+            channel = ReplyChannel(msg, self)
+            self.reply_channels[msg.id] = channel
+            if not self.executor.submit(msg, channel=channel):
+                channel.close()
+                logger.warning('rejecting request (overloaded): %s', msg)
+                self.send_reply(msg, None, msg_type=Message.OVERLOADED)
+        elif msg.is_reply():
+            channel = self.channels.get(msg.subject)
+            if channel is None:
                 logger.debug('reply to unknown subject: %s (msg-id=%s)', msg.subject, msg.id)
                 return
+            self.confirm_subject_hash(channel, msg)
             channel.recv(msg)
+        elif msg.type == Message.CREDIT:
+            channel = self.reply_channels.get(msg.subject)
+            if channel and channel.request.source == msg.source:
+                channel.add_credit(msg.body)
+        elif msg.type == Message.CANCEL:
+            channel = self.reply_channels.get(msg.subject)
+            if channel and channel.request.source == msg.source:
+                logger.debug('cancelling %s', channel.request)
+                channel.cancel()
         else:
             logger.warning('unknown message type: %s (msg-id=%s)', msg.type, msg.id)
 
-    def recv_loop(self):
-        while True:
-            frames = self.recv_sock.recv_multipart()
+    def confirm_subject_hash(self, channel, msg):
+        connection = channel.connection
+        if connection is None or connection is self.loopback:
+            return
+        if msg.headers.pop('subject_hash', False):
+            connection.hashed_subjects.add(channel.request.subject)
+        elif msg.type == Message.NACK:
+            # the peer might have been replaced by one that doesn't know the hash
+            connection.hashed_subjects.discard(channel.request.subject)
+
+    def recv_batch(self):
+        """
+        Blocks until the receive socket is readable, then drains up to
+        `recv_batch_size` pending frame sets without blocking. Draining stops
+        early once `recv_batch_latency` seconds have passed.
+        """
+        batch = [self.recv_sock.recv_multipart()]
+        deadline = time.monotonic() + self.recv_batch_latency
+        while len(batch) < self.recv_batch_size:
+            try:
+                batch.append(self.recv_sock.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+            if time.monotonic() >= deadline:
+                break
+        return batch
+
+    def unpack_batch(self, batch):
+        messages = []
+        for frames in batch:
             try:
-                msg = Message.unpack_frames(frames)
+                msg = Message.unpack_frames(frames, subjects=self.subjects)
+                # headers are needed to route every message, decode them now
+                # to reject malformed messages early
+                msg.headers
+                messages.append(msg)
             except ValueError as e:
                 msg_id = frames[1] if len(frames) >= 2 else None
                 logger.warning('bad message format %s: %r (msg-id=%s)', e, (frames), msg_id)
-                continue
-            self.recv_message(msg)
+        return messages
+
+    def recv_loop(self):
+        while True:
+            for msg in self.unpack_batch(self.recv_batch()):
+                self.recv_message(msg)
 
     def emit_event(self, event_type, payload, headers=None):
         headers = self.prepare_headers(headers)
         event = Event(event_type, payload, source=self.identity, headers=headers)
         self.event_system.emit(event)
 
-    def ping(self, address):
-        return self.send_request(address, 'lymph.ping', {'payload': ''})
+    def ping(self, address, timeout=None):
+        headers = None
+        if self.compression_codecs:
+            # pings advertise the compression codecs we understand
+            headers = {'codecs': self.compression_codecs}
+        return self.send_request(address, 'lymph.ping', {'payload': ''}, headers=headers, timeout=timeout)
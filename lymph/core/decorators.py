@@ -31,6 +31,8 @@ class RPCBase(collections.Callable):
         2
     """
 
+    cache = None
+
     def __init__(self, func, assigned=functools.WRAPPER_ASSIGNMENTS):
         self._original = func
 
@@ -81,27 +83,60 @@ class _RPCDecorator(RPCBase):
 
     def __init__(self, *args, **kwargs):
         self._raises = kwargs.pop('raises', ())
+        self._stream = kwargs.pop('stream', False)
+        cache = kwargs.pop('cache', None)
         super(_RPCDecorator, self).__init__(*args, **kwargs)
+        if cache:
+            if self._stream:
+                raise TypeError('streaming rpc methods cannot be cached')
+            self.cache = self._declare_cache({} if cache is True else cache)
 
     @property
     def raises(self):
         return self._raises
 
+    @property
+    def stream(self):
+        return self._stream
+
+    def _declare_cache(self, options):
+        func_name = self.__name__
+
+        def factory(interface):
+            from lymph.core.cache import RpcCache
+            return RpcCache(interface, func_name, **options)
+        return Declaration(factory)
+
     def rpc_call(self, interface, channel, *args, **kwargs):
         try:
-            ret = self._original(interface, *args, **kwargs)
+            if self.cache is not None:
+                cache = interface.components[self.cache]
+                ret = cache.call(functools.partial(self._original, interface), kwargs)
+            else:
+                ret = self._original(interface, *args, **kwargs)
+            if self._stream:
+                for chunk in ret:
+                    channel.send_chunk(chunk)
         except self._raises as ex:
             channel.error(type=ex.__class__.__name__, message=str(ex))
         else:
-            channel.reply(ret)
+            if self._stream:
+                channel.end_stream()
+            else:
+                channel.reply(ret)
 
 
 def raw_rpc():
     return _RawRPCDecorator
 
 
-def rpc(raises=()):
-    return functools.partial(_RPCDecorator, raises=raises)
+def rpc(raises=(), stream=False, cache=None):
+    """
+    Declares an rpc method. `cache` caches its results: True for the
+    defaults of :class:`lymph.core.cache.RpcCache`, or a dict of its
+    arguments.
+    """
+    return functools.partial(_RPCDecorator, raises=raises, stream=stream, cache=cache)
 
 
 def event(*event_types, **kwargs):
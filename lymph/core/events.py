@@ -42,17 +42,21 @@ class Event(object):
 
 
 class EventHandler(Component):
-    def __init__(self, interface, func, event_types, sequential=False, queue_name=None, active=True):
+    def __init__(self, interface, func, event_types, sequential=False, queue_name=None, active=True, broadcast=False):
         self.func = func
         self.event_types = event_types
         self.sequential = sequential
         self.active = active
+        self.broadcast = broadcast
         self.interface = interface
         self._queue_name = queue_name or func.__name__
 
     @property
     def queue_name(self):
-        return '%s-%s' % (self.interface.name, self._queue_name)
+        name = '%s-%s' % (self.interface.name, self._queue_name)
+        if self.broadcast:
+            name = '%s-%s' % (name, self.interface.container.identity)
+        return name
 
     @queue_name.setter
     def queue_name(self, value):
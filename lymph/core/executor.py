@@ -0,0 +1,188 @@
+import collections
+import logging
+import time
+
+import gevent.queue
+
+from lymph.core import trace
+from lymph.utils import SampleWindow
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Lane(object):
+    """
+    Per interface bookkeeping. `running` counts requests that have been
+    handed to the workers (queued or executing), `pending` holds requests
+    that wait for the interface's concurrency limit.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.running = 0
+        self.pending = collections.deque()
+
+    def has_capacity(self):
+        return not self.limit or self.running < self.limit
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'running': self.running,
+            'pending': len(self.pending),
+        }
+
+
+def _remove_item(queue, channel):
+    for item in queue:
+        if item[2] is channel:
+            queue.remove(item)
+            return True
+    return False
+
+
+class RequestExecutor(object):
+    """
+    Runs requests on a bounded set of long-lived worker greenlets.
+
+    At most `size` requests are executed concurrently, per interface limits
+    are taken from `Interface.max_concurrent_requests`. Up to `backlog`
+    requests wait for a worker, :meth:`submit` rejects everything beyond.
+    """
+    def __init__(self, container, size=100, backlog=1000):
+        self.container = container
+        self.size = size
+        self.backlog = backlog
+        self.ready = gevent.queue.Queue()
+        self.lanes = {}
+        self.workers = []
+        self.idle = 0
+        self.active = 0
+        self.queued = 0
+        self.rejected_count = 0
+        self.expired_count = 0
+        self.cancelled_count = 0
+        self.wait_samples = SampleWindow(100, factor=1000)  # milliseconds
+
+    def get_lane(self, interface_name):
+        try:
+            return self.lanes[interface_name]
+        except KeyError:
+            interface = self.container.installed_interfaces.get(interface_name)
+            limit = getattr(interface, 'max_concurrent_requests', None)
+            lane = self.lanes[interface_name] = _Lane(limit)
+            return lane
+
+    def submit(self, msg, channel=None):
+        """
+        Queues `msg` for execution. Returns False if the backlog is full and
+        the request was rejected. Requests past their deadline are dropped.
+        """
+        if msg.is_expired():
+            self.drop_expired(msg, channel)
+            return True
+        if self.queued >= self.backlog:
+            self.rejected_count += 1
+            return False
+        lane = self.get_lane(msg.subject.rsplit('.', 1)[0])
+        item = (lane, msg, channel, time.monotonic())
+        self.queued += 1
+        if lane.has_capacity():
+            self._schedule(item)
+        else:
+            lane.pending.append(item)
+        return True
+
+    def cancel(self, channel):
+        """
+        Drops the request of `channel` if it hasn't been picked up by a
+        worker yet, so that it doesn't hold a backlog slot until then.
+        """
+        lane = self.lanes.get(channel.request.subject.rsplit('.', 1)[0])
+        if lane is None:
+            return
+        if _remove_item(lane.pending, channel):
+            pass
+        elif _remove_item(self.ready.queue, channel):
+            # it was scheduled already and counts as running
+            self._release(lane)
+        else:
+            return
+        self.queued -= 1
+        self.cancelled_count += 1
+        logger.debug('dropping cancelled request: %s', channel.request)
+        channel.drop()
+
+    def _release(self, lane):
+        lane.running -= 1
+        if lane.pending and lane.has_capacity():
+            self._schedule(lane.pending.popleft())
+
+    def _schedule(self, item):
+        item[0].running += 1
+        self.ready.put(item)
+        if self.ready.qsize() > self.idle and len(self.workers) < self.size:
+            self.workers.append(self.container.spawn(self.worker_loop))
+
+    def worker_loop(self):
+        try:
+            while True:
+                self.idle += 1
+                try:
+                    lane, msg, channel, queued_at = self.ready.get()
+                finally:
+                    self.idle -= 1
+                self.queued -= 1
+                self.active += 1
+                self.wait_samples.add(time.monotonic() - queued_at)
+                try:
+                    self.run(msg, channel)
+                finally:
+                    self.active -= 1
+                    self._release(lane)
+        finally:
+            self.workers.remove(gevent.getcurrent())
+
+    def drop_expired(self, msg, channel=None):
+        self.expired_count += 1
+        logger.info('dropping expired request: %s (deadline=%s)', msg, msg.deadline)
+        if channel is not None:
+            channel.drop()
+
+    def run(self, msg, channel=None):
+        if channel is not None and channel.is_cancelled():
+            self.cancelled_count += 1
+            logger.debug('dropping cancelled request: %s', msg)
+            channel.drop()
+            return
+        if msg.is_expired():
+            self.drop_expired(msg, channel)
+            return
+        trace.get_trace().clear()
+        trace.set_id(msg.headers.get('trace_id'))
+        trace.set_deadline(msg.deadline)
+        trace.set_channel(channel)
+        try:
+            self.container.dispatch_request(msg, channel=channel)
+        except Exception:
+            logger.exception('request worker failure')
+
+    def stop(self):
+        for worker in list(self.workers):
+            worker.kill()
+        self.ready = gevent.queue.Queue()
+        self.lanes.clear()
+        self.queued = 0
+
+    def stats(self):
+        return {
+            'workers': len(self.workers),
+            'active': self.active,
+            'queued': self.queued,
+            'backlog': self.backlog,
+            'rejected': self.rejected_count,
+            'expired': self.expired_count,
+            'cancelled': self.cancelled_count,
+            'wait': self.wait_samples.stats,
+            'interfaces': {name: lane.stats() for name, lane in self.lanes.items()},
+        }
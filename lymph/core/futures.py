@@ -0,0 +1,93 @@
+import gevent
+
+from lymph.exceptions import RemoteError, RpcError, Timeout
+
+
+class RequestFuture(object):
+    """
+    The pending reply to a request that was sent with
+    ``proxy.method.spawn()``. It waits on the :class:`RequestChannel` of the
+    request, so no greenlet is needed per request.
+    """
+    def __init__(self, channel, error_map=None):
+        self.channel = channel
+        self.error_map = error_map or {}
+
+    def __repr__(self):
+        return '<RequestFuture %s>' % self.channel.request.subject
+
+    @property
+    def result(self):
+        return self.channel.result
+
+    def ready(self):
+        return self.channel.result.ready()
+
+    def get(self, timeout=1):
+        """
+        Returns the body of the reply, or raises the same exceptions as the
+        blocking proxy call.
+        """
+        try:
+            return self.channel.get(timeout=timeout).body
+        except RemoteError as e:
+            error_type = str(e.__class__)
+            if error_type in self.error_map:
+                raise self.error_map[error_type]()
+            raise
+
+    def cancel(self):
+        """
+        Abandons the request unless it has already been answered or has
+        timed out.
+        """
+        if self.channel.finished:
+            self.channel.close()
+        else:
+            self.channel.cancel()
+
+
+def gather(*futures, **kwargs):
+    """
+    Waits for the replies to all `futures` and returns their results in the
+    same order. The `timeout` (default: 1 second) applies to all of them
+    together. The first error is raised and the requests that are still
+    pending are cancelled, unless `return_exceptions` is True, in which case
+    the exceptions are returned in place of the results.
+    """
+    timeout = kwargs.pop('timeout', 1)
+    return_exceptions = kwargs.pop('return_exceptions', False)
+    if kwargs:
+        raise TypeError('unexpected keyword arguments: %s' % ', '.join(kwargs))
+    gevent.wait([future.result for future in futures], timeout=timeout)
+    results = []
+    for i, future in enumerate(futures):
+        try:
+            results.append(future.get(timeout=0))
+        except RpcError as e:
+            if not return_exceptions:
+                for pending in futures[i + 1:]:
+                    pending.cancel()
+                raise
+            results.append(e)
+    return results
+
+
+def wait_any(*futures, **kwargs):
+    """
+    Returns the first of `futures` that has a reply, without waiting for the
+    others. Raises :exc:`lymph.exceptions.Timeout` if there is no reply
+    within `timeout` seconds (default: 1).
+    """
+    timeout = kwargs.pop('timeout', 1)
+    if kwargs:
+        raise TypeError('unexpected keyword arguments: %s' % ', '.join(kwargs))
+    for future in futures:
+        if future.ready():
+            return future
+    done = gevent.wait([future.result for future in futures], timeout=timeout, count=1)
+    if not done:
+        raise Timeout('no reply to any of %s requests within %s seconds' % (len(futures), timeout))
+    for future in futures:
+        if future.ready():
+            return future
@@ -0,0 +1,177 @@
+from __future__ import division
+
+import collections
+import logging
+import time
+
+import gevent
+
+from lymph.exceptions import Timeout, CircuitOpen
+from lymph.utils import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyWindow(object):
+    """
+    The latencies of the last `size` requests. Once the window is full,
+    percentiles are only recomputed after every `size / 10` new samples.
+    """
+    def __init__(self, size=100):
+        self.values = collections.deque(maxlen=size)
+        self.refresh_interval = max(size // 10, 1)
+        self.sorted_values = []
+        self.stale = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        self.values.append(value)
+        self.stale += 1
+
+    def percentile(self, p):
+        if self.stale >= self.refresh_interval or len(self.sorted_values) < len(self.values):
+            self.sorted_values = sorted(self.values)
+            self.stale = 0
+        values = self.sorted_values
+        return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class HedgePolicy(object):
+    """
+    Decides when a duplicate of a request is sent to another instance: once
+    the request has been waiting for longer than the `percentile` of the
+    latencies observed for its subject. No request is hedged before
+    `min_samples` latencies have been observed.
+
+    Every request adds `budget` to a token bucket that holds at most
+    `max_tokens` and every hedge takes one, so at most a `budget` fraction
+    of the requests is sent twice.
+    """
+    def __init__(self, percentile=95, budget=.05, max_tokens=10, min_samples=20, min_delay=.001, window=100):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.window = window
+        self.budget = TokenBucket(budget, max_tokens)
+        self.latencies = {}
+        self.request_count = 0
+        self.win_count = 0
+
+    def get_delay(self, subject):
+        latencies = self.latencies.get(subject)
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+        return max(latencies.percentile(self.percentile), self.min_delay)
+
+    def add_sample(self, subject, latency):
+        try:
+            latencies = self.latencies[subject]
+        except KeyError:
+            latencies = self.latencies[subject] = LatencyWindow(self.window)
+        latencies.add(latency)
+
+    def on_request(self):
+        self.request_count += 1
+        self.budget.deposit()
+
+    def acquire(self):
+        return self.budget.withdraw()
+
+    def stats(self):
+        return {
+            'requests': self.request_count,
+            'hedged': self.budget.withdrawn,
+            'denied': self.budget.denied,
+            'won': self.win_count,
+            'delays': {subject: self.get_delay(subject) for subject in self.latencies},
+        }
+
+
+class HedgedRequestChannel(object):
+    """
+    Wraps the :class:`RequestChannel` of a request that may be hedged. The
+    duplicate is sent while :meth:`get` waits for the reply, the first reply
+    wins and the other request is cancelled.
+    """
+    def __init__(self, container, channel, policy, resend):
+        self.container = container
+        self.channel = channel
+        self.request = channel.request
+        self.policy = policy
+        self.resend = resend
+        self.channels = [channel]
+        self.sent_at = time.monotonic()
+        policy.on_request()
+
+    @property
+    def connection(self):
+        return self.channel.connection
+
+    def hedge(self):
+        if not self.policy.acquire():
+            return
+        try:
+            channel = self.resend(exclude=self.channel.connection.endpoint)
+        except CircuitOpen:
+            return
+        if channel.connection is None:
+            channel.close()
+            return
+        logger.debug('hedging %s with %s', self.request, channel.request)
+        self.channels.append(channel)
+
+    def get(self, timeout=1):
+        deadline = self.request.deadline
+        if deadline is not None:
+            remaining = max(deadline - time.time(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        wait_until = None if timeout is None else time.monotonic() + timeout
+        try:
+            self.wait_for_hedge(wait_until)
+            results = [channel.result for channel in self.channels]
+            gevent.wait(results, count=1, timeout=None if wait_until is None else max(wait_until - time.monotonic(), 0))
+        except gevent.GreenletExit:
+            self.cancel()
+            raise
+        winner = None
+        for channel in self.channels:
+            if channel.result.ready():
+                winner = channel
+                break
+        for channel in self.channels:
+            if channel is not winner:
+                if winner is None:
+                    channel.finish(failed=True)
+                channel.cancel()
+        if winner is None:
+            raise Timeout(self.request)
+        if winner is not self.channel:
+            self.policy.win_count += 1
+        self.policy.add_sample(self.request.subject, time.monotonic() - self.sent_at)
+        return winner.get(timeout=0)
+
+    def wait_for_hedge(self, wait_until):
+        """
+        Waits for the reply until the hedge delay has passed and sends the
+        duplicate if there is no reply by then.
+        """
+        delay = self.policy.get_delay(self.request.subject)
+        if delay is None or self.channel.connection is None:
+            return
+        hedge_at = self.sent_at + delay
+        if wait_until is not None and hedge_at >= wait_until:
+            return
+        self.channel.result.wait(timeout=max(hedge_at - time.monotonic(), 0))
+        if not self.channel.result.ready():
+            self.hedge()
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+
+    def cancel(self):
+        for channel in self.channels:
+            channel.cancel()
@@ -1,9 +1,13 @@
 import textwrap
-import functools
+import time
+
 import six
 
 from lymph.core.decorators import rpc, RPCBase
-from lymph.exceptions import RemoteError
+from lymph.core.channels import DEFAULT_STREAM_WINDOW
+from lymph.core.futures import RequestFuture
+from lymph.core.hedging import HedgePolicy
+from lymph.exceptions import RemoteError, RpcError, Timeout, Nack
 from lymph.core.declarations import Declaration
 
 
@@ -29,36 +33,185 @@ class InterfaceBase(type):
                 declarations.add(value)
             elif isinstance(value, RPCBase):
                 methods[name] = value
+                if value.cache is not None:
+                    declarations.add(value.cache)
         new_cls = super(InterfaceBase, cls).__new__(cls, clsname, bases, attrs)
         new_cls.methods = methods
         new_cls.declarations = declarations
         return new_cls
 
 
+class ProxyMethod(object):
+    """
+    A method of a :class:`Proxy`. Calling it waits for the reply,
+    :meth:`spawn` sends the request and returns a :class:`RequestFuture`,
+    :meth:`stream` iterates over the chunks of a streaming reply.
+    """
+    def __init__(self, proxy, subject):
+        self.proxy = proxy
+        self.subject = subject
+
+    def __call__(self, **kwargs):
+        return self.proxy._call(self.subject, **kwargs)
+
+    def spawn(self, **kwargs):
+        """
+        Sends the request without waiting for the reply. Spawned requests
+        are neither hedged nor retried.
+        """
+        return self.proxy._spawn(self.subject, **kwargs)
+
+    def stream(self, **kwargs):
+        """
+        Calls a streaming rpc method and returns an iterator over the chunks
+        of the reply.
+        """
+        return self.proxy._stream(self.subject, **kwargs)
+
+
 class Proxy(Component):
-    def __init__(self, container, address, timeout=1, namespace='', error_map=None):
+    """
+    Sends requests to `address`. If `route_key` is given, requests are routed
+    to instances by consistent hashing: it is either the name of the argument
+    that holds the key, or a function that returns the key for the arguments
+    of a call.
+
+    `hedge` enables hedged requests: True for the defaults of
+    :class:`HedgePolicy`, a dict of its arguments, or a policy.
+
+    Calls of the methods in `idempotent` (or of all methods if it's True)
+    that time out or are rejected are retried up to `retries` times on
+    another instance, as long as the retry budget of the service allows.
+    """
+    def __init__(self, container, address, timeout=1, namespace='', error_map=None, route_key=None, hedge=None, idempotent=(), retries=1):
         self._container = container
         self._address = address
         self._method_cache = {}
         self._timeout = timeout
         self._namespace = namespace or address
         self._error_map = error_map or {}
+        self._route_key = route_key
+        self._fixed_route_key = None
+        if hedge is True:
+            hedge = HedgePolicy()
+        elif isinstance(hedge, dict):
+            hedge = HedgePolicy(**hedge)
+        self._hedge = hedge or None
+        self._idempotent = idempotent if idempotent is True else frozenset(idempotent)
+        self._retries = retries
+
+    def _route(self, key):
+        """
+        Returns a proxy that sends all requests to the instance that `key`
+        maps to, e.g. ``proxy._route(user_id).get_profile()``.
+        """
+        proxy = object.__new__(self.__class__)
+        proxy.__dict__.update(self.__dict__)
+        proxy._method_cache = {}
+        proxy._fixed_route_key = key
+        return proxy
+
+    def _get_route_key(self, kwargs):
+        if self._fixed_route_key is not None:
+            return self._fixed_route_key
+        if self._route_key is None:
+            return None
+        if callable(self._route_key):
+            return self._route_key(kwargs)
+        return kwargs.get(self._route_key)
+
+    def _is_idempotent(self, subject):
+        if self._idempotent is True:
+            return True
+        return subject.rsplit('.', 1)[-1] in self._idempotent
+
+    def _get_retry_budget(self):
+        # retries go to another instance, so there has to be one
+        if '://' in self._address:
+            return None
+        service = self._container.lookup(self._address)
+        if len(service) < 2:
+            return None
+        return service.retry_budget
 
     def _call(self, __name, **kwargs):
-        channel = self._container.send_request(self._address, __name, kwargs)
+        route_key = self._get_route_key(kwargs)
+        channel = self._container.send_request(
+            self._address, __name, kwargs, timeout=self._timeout, route_key=route_key, hedge=self._hedge)
+        retries, budget = 0, None
+        if self._retries and self._is_idempotent(__name):
+            budget = self._get_retry_budget()
+            if budget is not None:
+                budget.deposit()
+                retries = self._retries
+        # retries share the deadline of the first request
+        deadline = channel.request.deadline
+        while True:
+            try:
+                return channel.get(timeout=self._timeout).body
+            except (Timeout, Nack):
+                if not retries or (deadline is not None and deadline <= time.time()) or not budget.withdraw():
+                    raise
+                retries -= 1
+                exclude = channel.connection.endpoint if channel.connection else None
+                headers = {'deadline': deadline} if deadline is not None else None
+                channel = self._container.send_request(
+                    self._address, __name, kwargs, headers=headers, route_key=route_key, exclude=exclude)
+            except RemoteError as e:
+                error_type = str(e.__class__)
+                if error_type in self._error_map:
+                    raise self._error_map[error_type]()
+                raise
+
+    def _spawn(self, __name, **kwargs):
+        channel = self._container.send_request(
+            self._address, __name, kwargs, timeout=self._timeout, route_key=self._get_route_key(kwargs))
+        return RequestFuture(channel, self._error_map)
+
+    def _stream(self, __name, **kwargs):
+        channel = self._container.send_request(
+            self._address, __name, kwargs,
+            stream_window=DEFAULT_STREAM_WINDOW, route_key=self._get_route_key(kwargs))
+        return self._iter_stream(channel)
+
+    def _iter_stream(self, channel):
         try:
-            return channel.get(timeout=self._timeout).body
+            for chunk in channel.stream(timeout=self._timeout):
+                yield chunk
         except RemoteError as e:
             error_type = str(e.__class__)
             if error_type in self._error_map:
                 raise self._error_map[error_type]()
             raise
 
+    def call_batch(self, calls):
+        """
+        Calls several methods with a single message. `calls` is a sequence of
+        `(name, kwargs)` pairs. Returns a list with the result of each call,
+        or the exception instance if the call failed. Batches are only routed
+        by a key that was given to :meth:`_route`.
+
+        This shadows a remote method of the same name, which can still be
+        called as ``proxy._call('<namespace>.call_batch', ...)``.
+        """
+        channel = self._container.send_batch(self._address, [
+            ('%s.%s' % (self._namespace, name), kwargs) for name, kwargs in calls
+        ], timeout=self._timeout, route_key=self._fixed_route_key)
+        results = []
+        for result in channel.get(timeout=self._timeout):
+            if isinstance(result, RemoteError) and str(result.__class__) in self._error_map:
+                results.append(self._error_map[str(result.__class__)]())
+            elif isinstance(result, RpcError):
+                results.append(result)
+            else:
+                results.append(result.body)
+        return results
+
     def __getattr__(self, name):
         try:
             return self._method_cache[name]
         except KeyError:
-            method = functools.partial(self._call, '%s.%s' % (self._namespace, name))
+            method = ProxyMethod(self, '%s.%s' % (self._namespace, name))
             self._method_cache[name] = method
             return method
 
@@ -66,6 +219,7 @@ class Proxy(Component):
 @six.add_metaclass(InterfaceBase)
 class Interface(object):
     register_with_coordinator = True
+    max_concurrent_requests = None
 
     def __init__(self, container, name=None):
         self.container = container
@@ -96,7 +250,7 @@ class Interface(object):
         self.methods[func_name].rpc_call(self, channel, **channel.request.body)
 
     def request(self, address, subject, body, timeout=None):
-        channel = self.container.send_request(address, subject, body)
+        channel = self.container.send_request(address, subject, body, timeout=timeout)
         return channel.get(timeout=timeout)
 
     def emit(self, event_type, payload):
@@ -127,8 +281,18 @@ class Interface(object):
     def on_disconnect(self, endpoint):
         pass
 
+    def get_cache(self, name):
+        """
+        Returns the :class:`RpcCache` of the rpc method `name`.
+        """
+        return self.components[self.methods[name].cache]
+
     def stats(self):
-        return {}
+        stats = {}
+        caches = {name: self.get_cache(name).stats() for name, method in six.iteritems(self.methods) if method.cache}
+        if caches:
+            stats['cache'] = caches
+        return stats
 
 
 class DefaultInterface(Interface):
@@ -1,5 +1,65 @@
+import base64
+import binascii
+import struct
+import time
+import zlib
+
+import six
+
+from lymph.core import compression
 from lymph.serializers import msgpack_serializer
-from lymph.utils import make_id
+from lymph.serializers.base import BUFFER_THRESHOLD
+from lymph.utils import make_id, Undefined
+
+
+#: the newest wire format this version of lymph can send and receive
+WIRE_VERSION = 2
+
+FLAG_TRACE_ID = 0x01
+FLAG_DEADLINE = 0x02
+FLAG_HEADERS = 0x04
+FLAG_SUBJECT_ID = 0x08
+FLAG_SUBJECT_HASH = 0x10
+FLAG_BUFFERS = 0x20
+FLAG_COMPRESSED = 0x40
+
+_preamble = struct.Struct('>BBB12s')
+_deadline = struct.Struct('>d')
+_subject_hash = struct.Struct('>I')
+
+_subject_hashes = {}
+
+
+def hash_subject(subject):
+    """
+    Returns the 32-bit hash that replaces `subject` in v2 request messages.
+    """
+    try:
+        return _subject_hashes[subject]
+    except KeyError:
+        h = _subject_hashes[subject] = zlib.crc32(subject.encode('utf-8')) & 0xffffffff
+        return h
+
+
+def encode_id(msg_id):
+    """
+    Returns the 12 raw bytes of an id created by :func:`lymph.utils.make_id`,
+    or None if `msg_id` wasn't created that way.
+    """
+    if not isinstance(msg_id, six.string_types) or len(msg_id) != 16:
+        return None
+    encoded = msg_id.encode('ascii', 'replace')
+    try:
+        raw = base64.urlsafe_b64decode(encoded)
+    except (TypeError, ValueError, binascii.Error):
+        return None
+    if base64.urlsafe_b64encode(raw) != encoded:
+        return None
+    return raw
+
+
+def decode_id(raw):
+    return base64.urlsafe_b64encode(raw).decode('ascii')
 
 
 class Message(object):
@@ -8,12 +68,23 @@ class Message(object):
     REQ = b'REQ'
     NACK = b'NACK'
     ERROR = b'ERROR'
+    OVERLOADED = b'OVERLOADED'
+    BATCH = b'BATCH'
+    CHUNK = b'CHUNK'
+    CREDIT = b'CREDIT'
+    CANCEL = b'CANCEL'
+
+    TYPES = (REQ, REP, ACK, NACK, ERROR, OVERLOADED, BATCH, CHUNK, CREDIT, CANCEL)
+    TYPE_CODES = {msg_type: code for code, msg_type in enumerate(TYPES, 1)}
+
+    __slots__ = ('id', 'type', 'subject', 'source', 'version', '_headers', '_packed_headers', '_body', '_packed_body', '_buffers', 'compressed', 'subject_hashed')
 
-    def __init__(self, msg_type, subject, packed_body=None, headers=None, packed_headers=None, msg_id=None, source=None, lazy=False, **kwargs):
+    def __init__(self, msg_type, subject, packed_body=None, headers=None, packed_headers=None, msg_id=None, source=None, lazy=False, version=1, buffers=None, compressed=False, **kwargs):
         self.id = msg_id if msg_id else make_id()
         self.type = msg_type
         self.subject = subject
         self.source = source
+        self.version = version
 
         if headers and packed_headers:
             raise TypeError("Message takes either 'headers' or 'packed_headers' not both")
@@ -28,39 +99,108 @@ class Message(object):
             self._body = kwargs['body']
         elif packed_body is None:
             raise TypeError("Message requires either 'body' or 'packed_body'")
+        else:
+            self._body = Undefined
 
         self._packed_body = packed_body
+        self._buffers = buffers
+        self.compressed = compressed
+        # True if the subject was received as a hash
+        self.subject_hashed = False
         if not lazy:
+            # the body is packed once the wire format is known, v1 messages
+            # carry their buffers inline and never need to extract them
             self.body
-            self.packed_body
             self.headers
             self.packed_headers
 
     def is_request(self):
-        return self.type == self.REQ
+        return self.type in (self.REQ, self.BATCH)
+
+    def is_batch(self):
+        return self.type == self.BATCH
 
     def is_reply(self):
-        return self.type in (self.REP, self.ACK, self.NACK, self.ERROR)
+        return self.type in (self.REP, self.ACK, self.NACK, self.ERROR, self.OVERLOADED, self.CHUNK)
+
+    @property
+    def deadline(self):
+        return self.headers.get('deadline')
+
+    def is_expired(self):
+        deadline = self.deadline
+        return deadline is not None and deadline < time.time()
 
     def is_idle_chatter(self):
-        return not self.is_request() or self.subject == '_ping'
+        """
+        Returns True for messages that don't keep a connection from becoming
+        idle: heartbeat pings and all replies.
+        """
+        return not self.is_request() or self.subject == 'lymph.ping'
+
+    # Received messages are created lazily: headers and body are only decoded
+    # when they are accessed, and the packed buffers are released afterwards.
 
     @property
     def body(self):
-        if not hasattr(self, '_body'):
-            self._body = msgpack_serializer.loads(self._packed_body)
+        if self._body is Undefined:
+            if self.compressed:
+                self.decompress()
+            self._body = msgpack_serializer.loads(self._packed_body, buffers=self._buffers)
+            self._packed_body = None
+            self._buffers = None
         return self._body
 
     @property
     def packed_body(self):
+        """
+        The msgpack encoded body. Large binary values and numpy arrays are not
+        part of it, they are sent as separate frames (see :attr:`buffers`).
+        """
+        if self.compressed:
+            self.decompress()
         if self._packed_body is None:
-            self._packed_body = msgpack_serializer.dumps(self._body)
+            self._buffers = []
+            self._packed_body = msgpack_serializer.dumps(self._body, buffers=self._buffers)
         return self._packed_body
 
+    @property
+    def buffers(self):
+        self.packed_body
+        return self._buffers
+
+    def decompress(self):
+        """
+        Decompresses the packed body of a received message. Returns the
+        compressed and the uncompressed size.
+        """
+        compressed_size = len(self._packed_body)
+        self._packed_body = compression.decompress(self._packed_body)
+        self.compressed = False
+        return compressed_size, len(self._packed_body)
+
+    def pack_inline_body(self):
+        """
+        The msgpack encoded body with all binary values inline, as v1
+        messages carry it.
+        """
+        if self._packed_body is None:
+            packed = msgpack_serializer.dumps(self._body)
+            if len(packed) < BUFFER_THRESHOLD:
+                # too small to hold an out-of-band buffer, so it is the
+                # packed body as well
+                self._packed_body = packed
+                self._buffers = []
+            return packed
+        if self.buffers:
+            return msgpack_serializer.dumps(self.body)
+        return self.packed_body
+
     @property
     def headers(self):
         if self._headers is None:
             self._headers = msgpack_serializer.loads(self._packed_headers)
+            self._packed_headers = None
         return self._headers
 
     @property
@@ -69,17 +209,100 @@ class Message(object):
             self._packed_headers = msgpack_serializer.dumps(self._headers)
         return self._packed_headers
 
-    def pack_frames(self):
-        return [
+    def pack_frames(self, version=1, compress=None, hashed_subjects=(), identity=None):
+        """
+        Returns the frames of this message in the given wire format. Messages
+        that cannot be represented in the v2 format are sent as v1. If an
+        `identity` is given, it is the first frame, i.e. the routing id of the
+        peer on a ROUTER socket.
+
+        `compress` is called with the packed body of v2 messages and returns
+        the compressed body or None if it should be sent uncompressed.
+        v2 requests only carry the hash of their subject if it is in
+        `hashed_subjects`, i.e. if the peer confirmed that it knows the hash.
+        """
+        if version >= 2 and self.type in self.TYPE_CODES:
+            frames = self._pack_frames_v2(compress, hashed_subjects, identity)
+            if frames is not None:
+                return frames
+        # v1 messages advertise the newest format we understand
+        if self.headers.get('wire') == WIRE_VERSION:
+            packed_headers = self.packed_headers
+        else:
+            packed_headers = msgpack_serializer.dumps(dict(self.headers, wire=WIRE_VERSION))
+        frames = [
             self.id.encode('utf-8'),
             self.type,
             self.subject.encode('utf-8'),
-            self.packed_headers,
-            self.packed_body,
+            packed_headers,
+            self.pack_inline_body(),
         ]
+        if identity is not None:
+            frames.insert(0, identity)
+        return frames
+
+    def _pack_frames_v2(self, compress=None, hashed_subjects=(), identity=None):
+        raw_id = encode_id(self.id)
+        if raw_id is None:
+            return None
+        flags = 0
+        fields = []
+        headers = self.headers
+        if headers:
+            headers = dict(headers)
+            headers.pop('wire', None)
+            raw_trace_id = encode_id(headers.get('trace_id'))
+            if raw_trace_id is not None:
+                flags |= FLAG_TRACE_ID
+                fields.append(raw_trace_id)
+                del headers['trace_id']
+            deadline = headers.get('deadline')
+            if isinstance(deadline, (int, float)):
+                flags |= FLAG_DEADLINE
+                fields.append(_deadline.pack(deadline))
+                del headers['deadline']
+        if self.is_request() and self.subject in hashed_subjects:
+            flags |= FLAG_SUBJECT_HASH
+            fields.append(_subject_hash.pack(hash_subject(self.subject)))
+        elif self.is_request():
+            fields.append(self.subject.encode('utf-8'))
+        else:
+            raw_subject = encode_id(self.subject)
+            if raw_subject is not None:
+                flags |= FLAG_SUBJECT_ID
+                fields.append(raw_subject)
+            else:
+                fields.append(self.subject.encode('utf-8'))
+        frames = [] if identity is None else [identity]
+        # the preamble goes first, it is filled in once the flags are known
+        preamble_index = len(frames)
+        frames.append(None)
+        if headers:
+            flags |= FLAG_HEADERS
+            frames.append(msgpack_serializer.dumps(headers))
+        body = self.packed_body
+        if compress is not None:
+            compressed_body = compress(body)
+            if compressed_body is not None:
+                flags |= FLAG_COMPRESSED
+                body = compressed_body
+        frames.append(body)
+        if self.buffers:
+            flags |= FLAG_BUFFERS
+            frames.extend(self.buffers)
+        preamble = _preamble.pack(WIRE_VERSION, self.TYPE_CODES[self.type], flags, raw_id)
+        frames[preamble_index] = preamble + b''.join(fields)
+        return frames
 
     @classmethod
-    def unpack_frames(self, frames):
+    def unpack_frames(self, frames, subjects=None):
+        """
+        Creates a message from the `frames` received by a ROUTER socket, i.e.
+        the source followed by the message in either wire format. `subjects`
+        maps subject hashes to the subjects of v2 requests.
+        """
+        if len(frames) >= 3 and frames[1][:1] == b'\x02':
+            return self._unpack_frames_v2(frames, subjects or {})
         try:
             source, msg_id, msg_type, subject, headers, body = frames
         except ValueError:
@@ -99,13 +322,68 @@ class Message(object):
             source=source,
             packed_body=body,
             packed_headers=headers,
+            lazy=True,
         )
 
+    @classmethod
+    def _unpack_frames_v2(self, frames, subjects):
+        source, preamble = frames[0], frames[1]
+        try:
+            version, type_code, flags, raw_id = _preamble.unpack_from(preamble)
+            if not 0 < type_code <= len(self.TYPES):
+                raise ValueError('unknown message type code: %s' % type_code)
+            msg_type = self.TYPES[type_code - 1]
+            offset = _preamble.size
+            headers = {}
+            body_index = 2
+            if flags & FLAG_HEADERS:
+                headers = msgpack_serializer.loads(frames[2])
+                body_index = 3
+            expected = body_index + 1
+            if flags & FLAG_BUFFERS:
+                if len(frames) <= expected:
+                    raise ValueError('bad message frame count: got %s, expected more than %s' % (len(frames), expected))
+            elif len(frames) != expected:
+                raise ValueError('bad message frame count: got %s, expected %s' % (len(frames), expected))
+            if flags & FLAG_TRACE_ID:
+                headers['trace_id'] = decode_id(preamble[offset:offset + 12])
+                offset += 12
+            if flags & FLAG_DEADLINE:
+                headers['deadline'] = _deadline.unpack_from(preamble, offset)[0]
+                offset += _deadline.size
+            if flags & FLAG_SUBJECT_HASH:
+                subject_hash = _subject_hash.unpack_from(preamble, offset)[0]
+                # unknown hashes are NACKed, see Container.dispatch_request()
+                subject = subjects.get(subject_hash) or '#%08x' % subject_hash
+            elif flags & FLAG_SUBJECT_ID:
+                subject = decode_id(preamble[offset:offset + 12])
+            else:
+                subject = preamble[offset:].decode('utf-8')
+            source = source.decode('utf-8')
+        except (struct.error, IndexError):
+            raise ValueError('truncated v2 message preamble')
+        except UnicodeDecodeError:
+            raise ValueError('message subject and source must be utf-8 encoded.')
+        msg = Message(
+            msg_type=msg_type,
+            subject=subject,
+            msg_id=decode_id(raw_id),
+            source=source,
+            packed_body=frames[body_index],
+            buffers=frames[body_index + 1:],
+            compressed=bool(flags & FLAG_COMPRESSED),
+            headers=headers,
+            version=version,
+            lazy=True,
+        )
+        msg.subject_hashed = bool(flags & FLAG_SUBJECT_HASH)
+        return msg
+
     def __str__(self):
-        return '{type=%s subject=%s id=%s..}' % (
+        return '{type=%s subject=%s id=%s}' % (
             self.type,
             self.subject,
-            self.id[:10],
+            self.id,
         )
 
     def __repr__(self):
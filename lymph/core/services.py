@@ -1,10 +1,11 @@
 import hashlib
 import logging
-import random
 
 import six
 
-from lymph.utils import observables
+from lymph.core.balancing import get_balancer, HashRing
+from lymph.core.connection import UNRESPONSIVE
+from lymph.utils import observables, TokenBucket
 from lymph.exceptions import NotConnected
 
 
@@ -21,33 +22,57 @@ class ServiceInstance(object):
         self.container = container
         self.identity = identity if identity else hashlib.md5(endpoint.encode('utf-8')).hexdigest()
         self.update(endpoint, **info)
-        self.connection = None
 
-    def update(self, endpoint, log_endpoint=None, name=None):
+    def update(self, endpoint, log_endpoint=None, name=None, weight=1):
         self.endpoint = endpoint
         self.log_endpoint = log_endpoint
         self.name = name
+        self.weight = weight
+
+    @property
+    def connection(self):
+        return self.container.connections.get(self.endpoint)
 
     def connect(self):
-        self.connection = self.container.connect(self.endpoint)
-        return self.connection
+        return self.container.connect(self.endpoint)
 
     def disconnect(self):
-        if self.connection:
-            self.container.disconnect(self.endpoint)
-            self.connection = None
+        self.container.disconnect(self.endpoint)
+
+    @property
+    def breaker(self):
+        return self.container.breakers.get(self.endpoint)
 
     def is_alive(self):
-        return self.connection is None or self.connection.is_alive()
+        breaker = self.breaker
+        if breaker is not None and not breaker.is_available():
+            return False
+        # new connections are given the benefit of the doubt
+        connection = self.connection
+        return connection is None or connection.status != UNRESPONSIVE
+
+    def stats(self):
+        connection = self.connection
+        breaker = self.breaker
+        return {
+            'alive': self.is_alive(),
+            'status': connection.status if connection else None,
+            'breaker': breaker.stats() if breaker else None,
+        }
 
 
 class Service(observables.Observable):
 
-    def __init__(self, container, name=None, instances=()):
+    def __init__(self, container, name=None, instances=(), balancer=None):
         super(Service, self).__init__()
         self.container = container
         self.name = name
         self.instances = {i.endpoint: i for i in instances}
+        if balancer is None:
+            balancer = getattr(container, 'balancer', 'random')
+        self.balancer = get_balancer(balancer)(self)
+        self.ring = None
+        self.retry_budget = TokenBucket(getattr(container, 'retry_budget', .1))
 
     def __iter__(self):
         return six.itervalues(self.instances)
@@ -58,16 +83,44 @@ class Service(observables.Observable):
     def identities(self):
         return list(self.instances.keys())
 
-    def connect(self):
-        choices = [i for i in self if i.is_alive()]
-        if not choices:
-            logger.info("no live instance for %s", self.name)
-            choices = list(self.instances.values())
-        if not choices:
+    def connect(self, route_key=None, exclude=None):
+        """
+        Connects to the instance chosen by the balancer, or to the instance
+        that `route_key` maps to on the hash ring if it's given. If
+        `exclude` is the endpoint of an instance, another one is chosen.
+        """
+        if exclude is not None:
+            exclude = self.get_instance(exclude)
+        if route_key is None:
+            instance = self.balancer.select_other(exclude) if exclude else self.balancer.select()
+        else:
+            instance = self.get_ring().get(route_key, exclude=exclude)
+        if instance is None:
             raise NotConnected()
-        instance = random.choice(choices)
         return instance.connect()
 
+    def stats(self):
+        return {
+            'instances': {instance.endpoint: instance.stats() for instance in self},
+            'retry_budget': self.retry_budget.stats,
+        }
+
+    def get_instance(self, endpoint):
+        for instance in self:
+            if instance.endpoint == endpoint:
+                return instance
+        return None
+
+    def set_balancer(self, balancer):
+        self.balancer = get_balancer(balancer)(self)
+
+    def get_ring(self):
+        if self.ring is None:
+            self.ring = HashRing(self)
+            self.observe(ADDED, self.ring.add)
+            self.observe(REMOVED, self.ring.remove)
+        return self.ring
+
     def disconnect(self):
         for instance in self:
             instance.disconnect()
@@ -79,12 +132,15 @@ class Service(observables.Observable):
             pass
         else:
             instance.disconnect()
+            self.balancer.update()
             self.notify_observers(REMOVED, instance)
 
     def update(self, identity, **info):
         if identity in self.instances:
             self.instances[identity].update(**info)
+            self.balancer.update()
             self.notify_observers(UPDATED, self.instances[identity])
         else:
             instance = self.instances[identity] = ServiceInstance(self.container, **info)
+            self.balancer.update()
             self.notify_observers(ADDED, instance)
@@ -0,0 +1,122 @@
+import collections
+import unittest
+
+from lymph.core.balancing import (
+    RandomBalancer, LeastOutstandingBalancer, EWMABalancer, WeightedRoundRobinBalancer, HashRing, get_balancer)
+from lymph.core.connection import RESPONSIVE, UNRESPONSIVE
+from lymph.utils import EWMA
+
+
+class FakeConnection(object):
+    def __init__(self, in_flight=0, latency=None):
+        self.status = RESPONSIVE
+        self.in_flight = in_flight
+        self.latency = EWMA()
+        if latency is not None:
+            self.latency.add(latency)
+
+
+class FakeInstance(object):
+    def __init__(self, name, weight=1, **kwargs):
+        self.name = name
+        self.weight = weight
+        self.connection = FakeConnection(**kwargs)
+
+    def __repr__(self):
+        return self.name
+
+    def is_alive(self):
+        return self.connection.status == RESPONSIVE
+
+
+class BalancerTest(unittest.TestCase):
+    def count(self, balancer, n=1000):
+        return collections.Counter(balancer.select().name for i in range(n))
+
+    def test_random_skips_dead_instances(self):
+        instances = [FakeInstance('a'), FakeInstance('b'), FakeInstance('c')]
+        instances[0].connection.status = UNRESPONSIVE
+        counts = self.count(RandomBalancer(instances))
+        self.assertEqual(set(counts), {'b', 'c'})
+
+    def test_fallback_to_dead_instances(self):
+        instances = [FakeInstance('a')]
+        instances[0].connection.status = UNRESPONSIVE
+        self.assertEqual(LeastOutstandingBalancer(instances).select().name, 'a')
+        self.assertIsNone(LeastOutstandingBalancer([]).select())
+
+    def test_least_outstanding(self):
+        instances = [FakeInstance('a', in_flight=10), FakeInstance('b'), FakeInstance('c')]
+        counts = self.count(LeastOutstandingBalancer(instances))
+        # 'a' only wins if it's sampled twice, which can't happen
+        self.assertEqual(set(counts), {'b', 'c'})
+
+    def test_ewma(self):
+        instances = [FakeInstance('a', latency=100), FakeInstance('b', latency=1), FakeInstance('c', latency=1, in_flight=50)]
+        counts = self.count(EWMABalancer(instances))
+        self.assertEqual(counts['a'], 0)
+        self.assertGreater(counts['b'], counts['c'])
+
+    def test_weighted_round_robin(self):
+        instances = [FakeInstance('a', weight=3), FakeInstance('b', weight=1), FakeInstance('c', weight=0)]
+        balancer = WeightedRoundRobinBalancer(instances)
+        self.assertEqual(self.count(balancer, 400), {'a': 300, 'b': 100})
+        # smooth: no instance is picked more than its share in a row
+        self.assertNotEqual([balancer.select().name for i in range(4)].count('b'), 0)
+        instances[0].connection.status = UNRESPONSIVE
+        self.assertEqual(self.count(balancer, 10), {'b': 10})
+
+    def test_select_other(self):
+        instances = [FakeInstance('a'), FakeInstance('b'), FakeInstance('c')]
+        balancer = LeastOutstandingBalancer(instances)
+        self.assertEqual(set(balancer.select_other(instances[0]).name for i in range(100)), {'b', 'c'})
+        instances[1].connection.status = UNRESPONSIVE
+        instances[2].connection.status = UNRESPONSIVE
+        self.assertIsNone(balancer.select_other(instances[0]))
+
+    def test_get_balancer(self):
+        self.assertIs(get_balancer('ewma'), EWMABalancer)
+        self.assertIs(get_balancer('lymph.core.balancing:RandomBalancer'), RandomBalancer)
+        self.assertIs(get_balancer(RandomBalancer), RandomBalancer)
+
+
+class HashRingTest(unittest.TestCase):
+    def test_distribution(self):
+        instances = [FakeInstance(str(i)) for i in range(4)]
+        for instance in instances:
+            instance.identity = instance.name
+        ring = HashRing(instances)
+        self.assertEqual(len(ring), 400)
+        counts = collections.Counter(ring.get(key).name for key in range(4000))
+        self.assertEqual(set(counts), {'0', '1', '2', '3'})
+        self.assertGreater(min(counts.values()), 600)
+
+    def test_only_keys_of_removed_instance_move(self):
+        instances = [FakeInstance(str(i)) for i in range(4)]
+        for instance in instances:
+            instance.identity = instance.name
+        ring = HashRing(instances)
+        before = {key: ring.get(key) for key in range(1000)}
+        ring.remove(instances[0])
+        after = {key: ring.get(key) for key in range(1000)}
+        moved = [key for key in before if before[key] is not after[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(before[key] is instances[0] for key in moved))
+        ring.add(instances[0])
+        self.assertEqual({key: ring.get(key) for key in range(1000)}, before)
+
+    def test_skip_dead_instances(self):
+        instances = [FakeInstance(str(i)) for i in range(3)]
+        for instance in instances:
+            instance.identity = instance.name
+        ring = HashRing(instances)
+        owner = ring.get('foo')
+        owner.connection.status = UNRESPONSIVE
+        fallback = ring.get('foo')
+        self.assertIsNot(fallback, owner)
+        self.assertIsNot(ring.get('foo', exclude=fallback), fallback)
+        for instance in instances:
+            instance.connection.status = UNRESPONSIVE
+        self.assertIs(ring.get('foo'), owner)
+        self.assertIsNone(ring.get('foo', exclude=owner))
+        self.assertIsNone(HashRing().get('foo'))
@@ -0,0 +1,203 @@
+import time
+import unittest
+
+import gevent
+import mock
+
+import lymph
+from lymph.core.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from lymph.core.interfaces import Interface
+from lymph.exceptions import Nack, CircuitOpen, Timeout
+from lymph.services.coordinator import Coordinator
+from lymph.testing import MockServiceNetwork
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_open_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3)
+        breaker.record(True)
+        breaker.record(True)
+        breaker.record(False)
+        breaker.record(True)
+        breaker.record(True)
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record(True)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.is_available())
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        breaker.record(True)
+        breaker.opened_at -= 10
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.is_available())
+        probe = breaker.on_request()
+        self.assertTrue(probe)
+        self.assertFalse(breaker.is_available())
+        # an abandoned probe makes room for another one
+        breaker.record(None, probe)
+        self.assertTrue(breaker.is_available())
+        breaker.record(True, breaker.on_request())
+        self.assertEqual(breaker.state, OPEN)
+        breaker.opened_at -= 10
+        breaker.record(False, breaker.on_request())
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.stats(), {'state': CLOSED, 'failures': 0, 'opened': 2})
+
+    def test_only_probes_close_the_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        self.assertFalse(breaker.on_request())
+        breaker.record(True)
+        self.assertEqual(breaker.state, OPEN)
+        # replies to requests sent before the breaker opened
+        breaker.record(False)
+        self.assertEqual(breaker.state, OPEN)
+        breaker.opened_at -= 10
+        breaker.record(False)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        breaker.record(False, breaker.on_request())
+        self.assertEqual(breaker.state, CLOSED)
+
+
+class Flaky(Interface):
+    broken = False
+
+    @lymph.rpc()
+    def get(self):
+        if self.broken:
+            raise Exception('broken')
+        return self.container.endpoint
+
+    @lymph.rpc()
+    def slow(self, delay=0):
+        if self.broken:
+            raise Exception('broken')
+        gevent.sleep(delay)
+        return self.container.endpoint
+
+
+class Client(Interface):
+    pass
+
+
+class CircuitBreakerIntegrationTest(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.network.add_service(Coordinator, 'coordinator')
+        self.broken = self.network.add_service(Flaky, 'flaky')
+        self.broken.installed_interfaces['flaky'].broken = True
+        self.healthy = self.network.add_service(Flaky, 'flaky')
+        self.client_container = self.network.add_service(Client, 'client', circuit_breaker_threshold=2)
+        self.network.start()
+        self.client = self.client_container.installed_interfaces['client']
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+    def test_breaker_opens(self):
+        for i in range(2):
+            self.assertRaises(Nack, self.client.request, self.broken.endpoint, 'flaky.get', {})
+        connection = self.client_container.connections[self.broken.endpoint]
+        self.assertEqual(connection.breaker.state, OPEN)
+        proxy = self.client.proxy('flaky')
+        for i in range(10):
+            self.assertEqual(proxy.get(), self.healthy.endpoint)
+        stats = self.client_container.stats()['services']['flaky']
+        self.assertEqual(stats['instances'][self.broken.endpoint]['breaker']['state'], OPEN)
+        self.assertFalse(stats['instances'][self.broken.endpoint]['alive'])
+
+    def test_breaker_survives_reaping(self):
+        for i in range(2):
+            self.assertRaises(Nack, self.client.request, self.broken.endpoint, 'flaky.get', {})
+        instance = self.client_container.lookup('flaky').get_instance(self.broken.endpoint)
+        self.assertFalse(instance.is_alive())
+        self.client_container.reap_connection(instance.connection, 'unresponsive')
+        self.assertIsNone(instance.connection)
+        self.assertFalse(instance.is_alive())
+        proxy = self.client.proxy('flaky')
+        for i in range(10):
+            self.assertEqual(proxy.get(), self.healthy.endpoint)
+        self.assertEqual(instance.connect().breaker.state, OPEN)
+
+    def test_healthy_breakers_are_dropped(self):
+        self.client.request(self.healthy.endpoint, 'flaky.get', {})
+        self.assertTrue(self.client_container.breakers)
+        for connection in list(self.client_container.connections.values()):
+            self.client_container.reap_connection(connection, 'idle')
+        self.assertEqual(self.client_container.breakers, {})
+
+    def test_retry_idempotent_methods(self):
+        proxy = self.client.proxy('flaky', idempotent=['get'])
+        for i in range(10):
+            self.assertEqual(proxy.get(), self.healthy.endpoint)
+        budget = self.client_container.lookup('flaky').retry_budget
+        self.assertGreater(budget.withdrawn, 0)
+        self.assertLessEqual(budget.withdrawn, 2)
+
+    def test_retry_on_next_node_of_ring(self):
+        ring = self.client_container.lookup('flaky').get_ring()
+        key = next(key for key in range(100) if ring.get(key).endpoint == self.broken.endpoint)
+        self.assertRaises(Nack, self.client.proxy('flaky')._route(key).get)
+        proxy = self.client.proxy('flaky', idempotent=True)._route(key)
+        self.assertEqual(proxy.get(), self.healthy.endpoint)
+
+    def test_retries_share_the_deadline(self):
+        ring = self.client_container.lookup('flaky').get_ring()
+        key = next(key for key in range(100) if ring.get(key).endpoint == self.broken.endpoint)
+        proxy = self.client.proxy('flaky', idempotent=True, retries=3, timeout=.2)._route(key)
+        channels = []
+
+        def send_request(*args, **kwargs):
+            channel = send_request.wrapped(*args, **kwargs)
+            channels.append(channel)
+            return channel
+        send_request.wrapped = self.client_container.send_request
+
+        with mock.patch.object(self.client_container, 'send_request', send_request):
+            start = time.monotonic()
+            self.assertRaises(Timeout, proxy.slow, delay=1)
+            elapsed = time.monotonic() - start
+        self.assertLess(elapsed, .35)
+        channels = [channel for channel in channels if channel.request.subject == 'flaky.slow']
+        self.assertEqual(len(channels), 2)
+        self.assertEqual(channels[1].request.deadline, channels[0].request.deadline)
+
+    def test_retry_budget(self):
+        proxy = self.client.proxy('flaky', idempotent=True)
+        budget = self.client_container.lookup('flaky').retry_budget
+        budget.tokens = 0
+        self.client_container.lookup('flaky').get_instance(self.healthy.endpoint).connect().breaker.open()
+        self.assertRaises(Nack, proxy.get)
+        self.assertEqual(budget.denied, 1)
+
+
+class SingleInstanceBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.network.add_service(Coordinator, 'coordinator')
+        self.flaky = self.network.add_service(Flaky, 'flaky')
+        self.client_container = self.network.add_service(Client, 'client', circuit_breaker_timeout=10)
+        self.network.start()
+        self.proxy = self.client_container.installed_interfaces['client'].proxy('flaky', timeout=1)
+        self.assertEqual(self.proxy.get(), self.flaky.endpoint)
+        self.breaker = self.client_container.connections[self.flaky.endpoint].breaker
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+    def test_open_breaker_fails_fast(self):
+        self.breaker.open()
+        self.flaky.rpc_stats()
+        self.assertRaises(CircuitOpen, self.proxy.get)
+        self.assertRaises(CircuitOpen, self.client_container.send_request, self.flaky.endpoint, 'flaky.get', {})
+        self.assertEqual(self.flaky.stats()['rpc']['requests'], {})
+        self.assertEqual(len(self.client_container.channels), 0)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_probe_closes_breaker(self):
+        self.breaker.open()
+        self.breaker.opened_at -= 10
+        self.assertEqual(self.proxy.get(), self.flaky.endpoint)
+        self.assertEqual(self.breaker.state, CLOSED)
@@ -0,0 +1,159 @@
+import time
+import unittest
+
+import gevent
+
+import lymph
+from lymph.core.cache import RpcCache, make_key
+from lymph.core.interfaces import Interface
+from lymph.exceptions import RemoteError
+from lymph.services.coordinator import Coordinator
+from lymph.testing import MockServiceNetwork
+
+
+class Lookup(Interface):
+    def __init__(self, *args, **kwargs):
+        super(Lookup, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    @lymph.rpc(cache={'maxsize': 2, 'invalidate_on': ['config.changed']})
+    def get(self, key, delay=0):
+        self.calls.append(key)
+        gevent.sleep(delay)
+        return {'key': key, 'call': len(self.calls)}
+
+    @lymph.rpc(raises=(KeyError,), cache=True)
+    def fail(self, delay=0):
+        self.calls.append(None)
+        gevent.sleep(delay)
+        raise KeyError('missing')
+
+
+class Client(Interface):
+    pass
+
+
+class RpcCacheTest(unittest.TestCase):
+    def test_make_key(self):
+        self.assertEqual(make_key({'a': 1, 'b': [1, {'c': 2}]}), make_key({'b': [1, {'c': 2}], 'a': 1}))
+        self.assertNotEqual(make_key({'a': 1}), make_key({'a': 2}))
+        keys = {make_key({'a': 1}), make_key({'a': True}), make_key({'a': 1.0}), make_key({'a': '1'})}
+        self.assertEqual(len(keys), 4)
+        self.assertNotEqual(make_key({'a': [1]}), make_key({'a': {1: 1}}))
+
+    def test_mixed_key_types(self):
+        body = {'a': {1: 'x', 'b': 'y'}}
+        self.assertEqual(make_key(body), make_key({'a': {'b': 'y', 1: 'x'}}))
+        cache = RpcCache(None, 'f')
+        self.assertEqual(cache.call(lambda a: len(a), body), 2)
+        self.assertEqual(cache.call(lambda a: len(a), body), 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_lru(self):
+        cache = RpcCache(None, 'f', maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertRaises(KeyError, cache.get, 'b')
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = RpcCache(None, 'f', ttl=.01)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(.02)
+        self.assertRaises(KeyError, cache.get, 'a')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['expired'], 1)
+
+    def test_unhashable_arguments(self):
+        cache = RpcCache(None, 'f')
+        self.assertEqual(cache.call(lambda key: len(key), {'key': bytearray(b'ab')}), 2)
+        self.assertEqual(cache.call(lambda key: key, {'key': {1, 2}}), {1, 2})
+        self.assertEqual(cache.stats()['hits'] + cache.stats()['misses'], 1)
+
+    def test_waiters_retry_aborted_calls(self):
+        cache = RpcCache(None, 'f')
+        calls = []
+
+        def func(key):
+            calls.append(key)
+            gevent.sleep(.05)
+            return key
+
+        leader = gevent.spawn(cache.call, func, {'key': 'a'})
+        gevent.sleep(.01)
+        waiter = gevent.spawn(cache.call, func, {'key': 'a'})
+        gevent.sleep(.01)
+        leader.kill()
+        self.assertEqual(waiter.get(timeout=1), 'a')
+        self.assertEqual(calls, ['a', 'a'])
+
+
+class CachedRpcTest(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.network.add_service(Coordinator, 'coordinator')
+        self.lookup_container = self.network.add_service(Lookup, 'lookup')
+        self.client_container = self.network.add_service(Client, 'client')
+        self.network.start()
+        self.lookup = self.lookup_container.installed_interfaces['lookup']
+        self.proxy = self.client_container.installed_interfaces['client'].proxy('lookup')
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+    def test_hit(self):
+        first = self.proxy.get(key='a')
+        self.assertEqual(self.proxy.get(key='a'), first)
+        self.assertEqual(self.proxy.get(key='b')['call'], 2)
+        self.assertEqual(self.lookup.calls, ['a', 'b'])
+        stats = self.lookup.stats()['cache']['get']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['size'], 2)
+
+    def test_eviction(self):
+        for key in 'abc':
+            self.proxy.get(key=key)
+        self.proxy.get(key='a')
+        self.assertEqual(self.lookup.calls, ['a', 'b', 'c', 'a'])
+        self.assertEqual(self.lookup.stats()['cache']['get']['evictions'], 2)
+
+    def test_single_flight(self):
+        futures = [self.proxy.get.spawn(key='a', delay=.05) for i in range(5)]
+        results = lymph.gather(*futures)
+        self.assertEqual(results, [{'key': 'a', 'call': 1}] * 5)
+        self.assertEqual(self.lookup.calls, ['a'])
+        self.assertEqual(self.lookup.get_cache('get').stats()['coalesced'], 4)
+
+    def test_errors_are_shared_but_not_cached(self):
+        futures = [self.proxy.fail.spawn(delay=.05) for i in range(3)]
+        results = lymph.gather(*futures, return_exceptions=True)
+        for result in results:
+            self.assertIsInstance(result, RemoteError.KeyError)
+        self.assertEqual(self.lookup.calls, [None])
+        self.assertRaises(RemoteError.KeyError, self.proxy.fail)
+        self.assertEqual(self.lookup.calls, [None, None])
+
+    def test_invalidate(self):
+        self.proxy.get(key='a')
+        self.proxy.get(key='b')
+        self.lookup.get_cache('get').invalidate(key='a')
+        self.proxy.get(key='a')
+        self.proxy.get(key='b')
+        self.assertEqual(self.lookup.calls, ['a', 'b', 'a'])
+
+    def test_invalidate_on_event(self):
+        self.proxy.get(key='a')
+        self.client_container.emit_event('config.changed', {})
+        self.assertEqual(len(self.lookup.get_cache('get')), 0)
+        self.proxy.get(key='a')
+        self.assertEqual(self.lookup.calls, ['a', 'a'])
+        self.assertEqual(self.lookup.stats()['cache']['get']['invalidations'], 1)
+
+    def test_streams_cannot_be_cached(self):
+        self.assertRaises(TypeError, lymph.rpc(stream=True, cache=True), lambda self: iter(()))
@@ -0,0 +1,183 @@
+import unittest
+
+import gevent
+
+import lymph
+from lymph.core.connection import RESPONSIVE, UNRESPONSIVE, IDLE, CLOSED
+from lymph.core.interfaces import Interface
+from lymph.services.coordinator import Coordinator
+from lymph.testing import MockServiceNetwork
+
+
+class Upper(Interface):
+    @lymph.rpc()
+    def upper(self, text=''):
+        return text.upper()
+
+
+class HeartbeatTest(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.network.add_service(Coordinator, 'coordinator')
+        self.upper_container = self.network.add_service(Upper, 'upper')
+        self.client_container = self.network.add_service(Upper, 'client')
+        self.network.start()
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+    def connect(self):
+        return self.client_container.connect(self.upper_container.endpoint)
+
+    def test_connections_share_one_greenlet(self):
+        greenlets = len(self.client_container.pool)
+        for container in self.network.service_containers.values():
+            self.client_container.connect(container.endpoint)
+        self.assertEqual(len(self.client_container.pool), greenlets)
+        self.assertEqual(len(self.client_container.heartbeats), len(self.client_container.connections))
+
+    def test_heartbeat(self):
+        connection = self.connect()
+        gevent.sleep(.2)
+        self.assertEqual(connection.explicit_heartbeat_count, 1)
+        connection.check_status(connection.last_seen)
+        self.assertEqual(connection.status, RESPONSIVE)
+        self.assertEqual(len(self.client_container.channels), 0)
+
+    def test_skip_ping_after_traffic(self):
+        connection = self.connect()
+        gevent.sleep(.2)
+        self.assertEqual(connection.explicit_heartbeat_count, 1)
+        self.client_container.send_request(self.upper_container.endpoint, 'lymph.status', {}).get()
+        connection.heartbeat()
+        self.assertEqual(connection.explicit_heartbeat_count, 1)
+        self.assertEqual(connection.skipped_heartbeat_count, 1)
+        connection.last_received -= connection.heartbeat_interval
+        connection.heartbeat()
+        gevent.sleep(.01)
+        self.assertEqual(connection.explicit_heartbeat_count, 2)
+
+    def test_unresponsive(self):
+        connection = self.connect()
+        gevent.sleep(.2)
+        connection.last_seen -= connection.timeout
+        connection.check_status(connection.last_seen + connection.timeout)
+        self.assertEqual(connection.status, UNRESPONSIVE)
+
+    def test_close(self):
+        connection = self.connect()
+        connection.close()
+        self.assertEqual(len(self.client_container.heartbeats), 0)
+
+
+class ReapingTest(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.coordinator_container = self.network.add_service(Coordinator, 'coordinator')
+        self.upper_container = self.network.add_service(Upper, 'upper')
+        self.client_container = self.network.add_service(Upper, 'client', max_connections=2)
+        self.network.start()
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+    def connect(self):
+        connection = self.client_container.connect(self.upper_container.endpoint)
+        gevent.sleep(.2)
+        return connection
+
+    def test_reap_idle(self):
+        connection = self.connect()
+        connection.last_message -= connection.idle_timeout
+        connection.heartbeat()
+        self.assertEqual(connection.status, IDLE)
+        connection.idle_since -= connection.idle_disconnect
+        connection.heartbeat()
+        self.assertEqual(connection.status, CLOSED)
+        self.assertNotIn(connection.endpoint, self.client_container.connections)
+        self.assertEqual(self.client_container.stats()['reaped_connections'], {'idle': 1})
+
+        # the next message transparently reconnects
+        self.client_container.ping(self.upper_container.endpoint).get(timeout=1)
+        self.assertIsNot(self.client_container.connections[connection.endpoint], connection)
+
+    def test_heartbeats_do_not_keep_connections_busy(self):
+        connection = self.client_container.connect(self.upper_container.endpoint)
+        connection.heartbeat_interval = .05
+        connection.idle_timeout = connection.idle_disconnect = .2
+        self.client_container.heartbeats.add(connection)
+        gevent.sleep(.8)
+        self.assertGreater(connection.explicit_heartbeat_count, 5)
+        self.assertEqual(connection.status, CLOSED)
+        self.assertNotIn(connection.endpoint, self.client_container.connections)
+        self.assertEqual(self.client_container.stats()['reaped_connections'], {'idle': 1})
+
+    def test_peer_pings_do_not_replace_our_pings(self):
+        connection = self.connect()
+        peer_connection = self.upper_container.connections[self.client_container.endpoint]
+        peer_connection.heartbeat_interval = .02
+        connection.heartbeat_interval = .1
+        self.upper_container.heartbeats.add(peer_connection)
+        self.client_container.heartbeats.add(connection)
+        count = connection.explicit_heartbeat_count
+        gevent.sleep(.55)
+        self.assertGreaterEqual(connection.explicit_heartbeat_count - count, 3)
+
+    def test_reap_unresponsive(self):
+        connection = self.connect()
+        connection.last_seen -= connection.unresponsive_disconnect
+        connection.heartbeat()
+        self.assertEqual(connection.status, CLOSED)
+        self.assertEqual(self.client_container.stats()['reaped_connections'], {'unresponsive': 1})
+
+    def test_reaped_unresponsive_instance_is_dead(self):
+        instance = self.client_container.lookup('upper').get_instance(self.upper_container.endpoint)
+        connection = instance.connect()
+        self.client_container.reap_connection(connection, UNRESPONSIVE)
+        self.assertIsNone(instance.connection)
+        self.assertFalse(instance.is_alive())
+        instance.breaker.opened_at -= instance.breaker.reset_timeout
+        self.assertTrue(instance.is_alive())
+        self.client_container.send_request('upper', 'upper.upper', {'text': 'a'}).get(timeout=1)
+        self.assertTrue(instance.is_alive())
+        self.assertEqual(instance.breaker.state, 'closed')
+
+    def test_disabled(self):
+        connection = self.connect()
+        connection.idle_disconnect = None
+        connection.last_message -= connection.idle_timeout
+        connection.heartbeat()
+        connection.idle_since -= 1000
+        connection.heartbeat()
+        self.assertEqual(connection.status, IDLE)
+
+    def test_reaped_instance_is_alive(self):
+        service = self.client_container.lookup('upper')
+        instance = next(iter(service))
+        connection = instance.connect()
+        self.client_container.reap_connection(connection, 'idle')
+        self.assertTrue(instance.is_alive())
+        self.assertIsNot(service.connect(), connection)
+
+    def test_evict_least_recently_used(self):
+        upper = self.client_container.connect(self.upper_container.endpoint)
+        coordinator = self.client_container.connect(self.coordinator_container.endpoint)
+        upper.last_message -= 10
+        self.client_container.connect(self.client_container.endpoint)
+        self.assertEqual(upper.status, CLOSED)
+        self.assertEqual(set(self.client_container.connections), {
+            self.coordinator_container.endpoint,
+            self.client_container.endpoint,
+        })
+        self.assertNotEqual(coordinator.status, CLOSED)
+        self.assertEqual(self.client_container.stats()['reaped_connections'], {'evicted': 1})
+
+    def test_coordinator_keeps_registered_connections(self):
+        self.client_container.send_request(self.coordinator_container.endpoint, 'coordinator.register', {
+            'service_name': 'client',
+            'endpoint': self.client_container.endpoint,
+        }).get(timeout=1)
+        connection = self.coordinator_container.connections[self.client_container.endpoint]
+        self.assertIsNone(connection.idle_disconnect)
@@ -0,0 +1,133 @@
+import unittest
+
+import gevent
+import gevent.event
+
+import lymph
+from lymph.core.interfaces import Interface
+from lymph.services.coordinator import Coordinator
+from lymph.testing import MockServiceNetwork
+from lymph.exceptions import Overloaded, Timeout
+
+
+class Blocking(Interface):
+    def __init__(self, *args, **kwargs):
+        super(Blocking, self).__init__(*args, **kwargs)
+        self.event = gevent.event.Event()
+        self.running = 0
+
+    @lymph.rpc()
+    def wait(self):
+        self.running += 1
+        self.event.wait()
+        return 'done'
+
+
+class LimitedBlocking(Blocking):
+    max_concurrent_requests = 1
+
+
+class Cancellable(Interface):
+    def __init__(self, *args, **kwargs):
+        super(Cancellable, self).__init__(*args, **kwargs)
+        self.cancelled = gevent.event.Event()
+
+    @lymph.raw_rpc()
+    def wait(self, channel):
+        while not channel.is_cancelled():
+            gevent.sleep(.001)
+        self.cancelled.set()
+
+    @lymph.rpc()
+    def poll(self):
+        while not lymph.is_cancelled():
+            gevent.sleep(.001)
+        self.cancelled.set()
+
+
+class ClientInterface(Interface):
+    pass
+
+
+class RequestExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.network.add_service(Coordinator, 'coordinator')
+        self.client_container = self.network.add_service(ClientInterface, 'client')
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+    def add_blocking_service(self, cls=Blocking, **kwargs):
+        container = self.network.add_service(cls, 'blocking', **kwargs)
+        self.network.start()
+        return container, container.installed_interfaces['blocking']
+
+    def send(self, container):
+        channel = self.client_container.send_request(container.endpoint, 'blocking.wait', {})
+        gevent.sleep(0)
+        return channel
+
+    def test_concurrency_limit_and_rejection(self):
+        container, interface = self.add_blocking_service(max_concurrent_requests=2, request_backlog=1)
+        channels = [self.send(container) for i in range(3)]
+        self.assertEqual(interface.running, 2)
+        stats = container.executor.stats()
+        self.assertEqual(stats['active'], 2)
+        self.assertEqual(stats['queued'], 1)
+
+        rejected = self.send(container)
+        self.assertRaises(Overloaded, rejected.get)
+        self.assertGreaterEqual(container.executor.stats()['rejected'], 1)
+
+        interface.event.set()
+        self.assertEqual([c.get().body for c in channels], ['done'] * 3)
+        self.assertEqual(len(container.executor.workers), 2)
+
+    def test_interface_limit(self):
+        container, interface = self.add_blocking_service(cls=LimitedBlocking)
+        channels = [self.send(container) for i in range(3)]
+        self.assertEqual(interface.running, 1)
+        self.assertEqual(container.executor.stats()['interfaces']['blocking']['pending'], 2)
+        interface.event.set()
+        self.assertEqual([c.get().body for c in channels], ['done'] * 3)
+
+    def test_cancel_queued_request(self):
+        container, interface = self.add_blocking_service(cls=LimitedBlocking)
+        running = self.send(container)
+        queued = self.send(container)
+        self.assertRaises(Timeout, queued.get, timeout=.01)
+        interface.event.set()
+        self.assertEqual(running.get().body, 'done')
+        gevent.sleep(.01)
+        self.assertEqual(interface.running, 1)
+        self.assertEqual(container.executor.cancelled_count, 1)
+        self.assertEqual(container.reply_channels, {})
+
+    def test_cancelled_requests_free_the_backlog(self):
+        container, interface = self.add_blocking_service(max_concurrent_requests=1, request_backlog=1)
+        running = self.send(container)
+        queued = self.send(container)
+        self.assertRaises(Timeout, queued.get, timeout=.01)
+        stats = container.executor.stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['cancelled'], 1)
+        self.assertEqual(container.reply_channels.keys(), {running.request.id})
+        # the slot of the cancelled request is free again
+        channel = self.send(container)
+        interface.event.set()
+        self.assertEqual([running.get().body, channel.get().body], ['done', 'done'])
+        self.assertEqual(interface.running, 2)
+
+    def test_cancel_running_rpc_method(self):
+        container, interface = self.add_blocking_service(cls=Cancellable)
+        channel = self.client_container.send_request(container.endpoint, 'blocking.poll', {})
+        self.assertRaises(Timeout, channel.get, timeout=.01)
+        self.assertTrue(interface.cancelled.wait(timeout=1))
+
+    def test_cancel_running_request(self):
+        container, interface = self.add_blocking_service(cls=Cancellable)
+        channel = self.send(container)
+        self.assertRaises(Timeout, channel.get, timeout=.01)
+        self.assertTrue(interface.cancelled.wait(timeout=1))
@@ -0,0 +1,86 @@
+import time
+import unittest
+
+import gevent
+
+import lymph
+from lymph.core.interfaces import Interface
+from lymph.exceptions import RemoteError, Timeout
+from lymph.services.coordinator import Coordinator
+from lymph.testing import MockServiceNetwork
+
+
+class Sleepy(Interface):
+    @lymph.rpc()
+    def sleep(self, delay=0):
+        gevent.sleep(delay)
+        return delay
+
+    @lymph.rpc(raises=(ValueError,))
+    def fail(self):
+        raise ValueError('failed')
+
+
+class Client(Interface):
+    pass
+
+
+class FutureTest(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.network.add_service(Coordinator, 'coordinator')
+        self.sleepy_container = self.network.add_service(Sleepy, 'sleepy')
+        self.client_container = self.network.add_service(Client, 'client')
+        self.network.start()
+        client = self.client_container.installed_interfaces['client']
+        self.proxy = client.proxy('sleepy')
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+    def test_get(self):
+        future = self.proxy.sleep.spawn(delay=.01)
+        self.assertFalse(future.ready())
+        self.assertEqual(future.get(), .01)
+        self.assertEqual(len(self.client_container.channels), 0)
+
+    def test_error_map(self):
+        future = self.proxy.fail.spawn()
+        self.assertRaises(RemoteError.ValueError, future.get)
+        proxy = self.client_container.installed_interfaces['client'].proxy(
+            'sleepy', error_map={str(RemoteError.ValueError): KeyError})
+        self.assertRaises(KeyError, proxy.fail.spawn().get)
+
+    def test_gather(self):
+        start = time.monotonic()
+        futures = [self.proxy.sleep.spawn(delay=.1) for i in range(5)]
+        self.assertEqual(lymph.gather(*futures), [.1] * 5)
+        self.assertLess(time.monotonic() - start, .3)
+
+    def test_gather_shares_timeout(self):
+        futures = [self.proxy.sleep.spawn(delay=delay) for delay in (.01, .2, .2)]
+        start = time.monotonic()
+        self.assertRaises(Timeout, lymph.gather, *futures, timeout=.1)
+        self.assertLess(time.monotonic() - start, .15)
+        # the other pending requests were cancelled
+        self.assertEqual(len(self.client_container.channels), 0)
+
+    def test_gather_return_exceptions(self):
+        futures = [self.proxy.sleep.spawn(delay=.01), self.proxy.fail.spawn(), self.proxy.sleep.spawn(delay=.2)]
+        results = lymph.gather(*futures, timeout=.1, return_exceptions=True)
+        self.assertEqual(results[0], .01)
+        self.assertIsInstance(results[1], RemoteError.ValueError)
+        self.assertIsInstance(results[2], Timeout)
+
+    def test_wait_any(self):
+        slow = self.proxy.sleep.spawn(delay=.2)
+        fast = self.proxy.sleep.spawn(delay=.01)
+        self.assertIs(lymph.wait_any(slow, fast), fast)
+        self.assertEqual(fast.get(timeout=0), .01)
+        slow.cancel()
+        self.assertEqual(len(self.client_container.channels), 0)
+
+    def test_wait_any_timeout(self):
+        futures = [self.proxy.sleep.spawn(delay=.2) for i in range(2)]
+        self.assertRaises(Timeout, lymph.wait_any, *futures, timeout=.05)
@@ -0,0 +1,103 @@
+import unittest
+
+import gevent
+
+import lymph
+from lymph.core.hedging import HedgePolicy, LatencyWindow
+from lymph.core.interfaces import Interface
+from lymph.services.coordinator import Coordinator
+from lymph.testing import MockServiceNetwork
+
+
+class Sleepy(Interface):
+    delay = 0
+
+    @lymph.rpc()
+    def work(self):
+        gevent.sleep(self.delay)
+        return self.container.endpoint
+
+
+class Client(Interface):
+    pass
+
+
+class HedgePolicyTest(unittest.TestCase):
+    def test_latency_window(self):
+        window = LatencyWindow(100)
+        for i in range(100):
+            window.add(i)
+        self.assertEqual(window.percentile(50), 50)
+        self.assertEqual(window.percentile(99), 99)
+        self.assertEqual(window.percentile(100), 99)
+
+    def test_delay(self):
+        policy = HedgePolicy(percentile=90, min_samples=10)
+        for i in range(9):
+            policy.add_sample('foo.bar', i / 100.)
+        self.assertIsNone(policy.get_delay('foo.bar'))
+        policy.add_sample('foo.bar', .09)
+        self.assertEqual(policy.get_delay('foo.bar'), .09)
+        self.assertIsNone(policy.get_delay('foo.baz'))
+
+    def test_budget(self):
+        policy = HedgePolicy(budget=.25, max_tokens=1)
+        self.assertTrue(policy.acquire())
+        self.assertFalse(policy.acquire())
+        for i in range(3):
+            policy.on_request()
+        self.assertFalse(policy.acquire())
+        policy.on_request()
+        self.assertTrue(policy.acquire())
+        self.assertEqual(policy.stats()['hedged'], 2)
+        self.assertEqual(policy.stats()['denied'], 2)
+
+
+class HedgedRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.network.add_service(Coordinator, 'coordinator')
+        self.slow = self.network.add_service(Sleepy, 'sleepy')
+        self.slow.installed_interfaces['sleepy'].delay = .3
+        self.fast = self.network.add_service(Sleepy, 'sleepy')
+        self.client_container = self.network.add_service(Client, 'client')
+        self.network.start()
+        self.policy = HedgePolicy(min_samples=1)
+        self.policy.add_sample('sleepy.work', .01)
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+    def send_to_slow_instance(self):
+        return self.client_container.send_request(
+            'sleepy', 'sleepy.work', {}, timeout=1, hedge=self.policy, exclude=self.fast.endpoint)
+
+    def test_first_reply_wins(self):
+        channel = self.send_to_slow_instance()
+        self.assertEqual(channel.connection.endpoint, self.slow.endpoint)
+        self.assertEqual(channel.get().body, self.fast.endpoint)
+        self.assertEqual(self.policy.budget.withdrawn, 1)
+        self.assertEqual(self.policy.win_count, 1)
+        # the slow request was cancelled
+        self.assertEqual(len(self.client_container.channels), 0)
+        gevent.sleep(.01)
+        reply_channel, = self.slow.reply_channels.values()
+        self.assertTrue(reply_channel.is_cancelled())
+
+    def test_budget_exhausted(self):
+        self.policy.budget.tokens = 0
+        channel = self.send_to_slow_instance()
+        self.assertEqual(channel.get().body, self.slow.endpoint)
+        self.assertEqual(self.policy.budget.withdrawn, 0)
+        self.assertEqual(self.policy.budget.denied, 1)
+
+    def test_proxy(self):
+        proxy = self.client_container.installed_interfaces['client'].proxy('sleepy', hedge={'min_samples': 5})
+        for i in range(10):
+            self.assertIn(proxy.work(), (self.slow.endpoint, self.fast.endpoint))
+        self.assertEqual(proxy._hedge.request_count, 10)
+
+    def test_no_hedge_for_single_instance(self):
+        channel = self.client_container.send_request(self.slow.endpoint, 'sleepy.work', {}, hedge=self.policy)
+        self.assertIsNone(getattr(channel, 'policy', None))
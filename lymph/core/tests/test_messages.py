@@ -0,0 +1,177 @@
+import unittest
+
+import mock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from lymph.core import compression
+from lymph.core.messages import Message, WIRE_VERSION, hash_subject
+from lymph.serializers import msgpack_serializer
+from lymph.utils import make_id
+
+
+def roundtrip(msg, version, subjects=None, compress=None, hashed_subjects=()):
+    frames = msg.pack_frames(version, compress=compress, hashed_subjects=hashed_subjects, identity=b'tcp://127.0.0.1:1234')
+    return Message.unpack_frames(frames, subjects=subjects), frames
+
+
+class WireFormatTests(unittest.TestCase):
+    def test_v1_advertises_wire_version(self):
+        msg = Message(Message.REQ, 'upper.upper', body={'text': 'foo'}, headers={'trace_id': make_id()})
+        received, frames = roundtrip(msg, 1)
+        self.assertEqual(len(frames), 6)
+        self.assertEqual(received.version, 1)
+        self.assertEqual(received.headers['wire'], WIRE_VERSION)
+        self.assertEqual(received.headers['trace_id'], msg.headers['trace_id'])
+        self.assertNotIn('wire', msg.headers)
+
+    def test_v2_request(self):
+        headers = {'trace_id': make_id(), 'deadline': 1234567890.5, 'stream_window': 16}
+        msg = Message(Message.REQ, 'upper.upper', body={'text': 'foo'}, headers=headers)
+        received, frames = roundtrip(msg, 2, subjects={hash_subject('upper.upper'): 'upper.upper'}, hashed_subjects={'upper.upper'})
+        self.assertEqual(len(frames), 4)
+        self.assertTrue(received.subject_hashed)
+        self.assertEqual(received.version, 2)
+        self.assertEqual(received.id, msg.id)
+        self.assertEqual(received.type, Message.REQ)
+        self.assertEqual(received.subject, 'upper.upper')
+        self.assertEqual(received.source, 'tcp://127.0.0.1:1234')
+        self.assertEqual(received.headers, headers)
+        self.assertEqual(received.body, {'text': 'foo'})
+
+    def test_v2_reply_without_headers(self):
+        request = Message(Message.REQ, 'upper.upper', body=None)
+        msg = Message(Message.REP, request.id, body='FOO')
+        received, frames = roundtrip(msg, 2)
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(received.subject, request.id)
+        self.assertEqual(received.headers, {})
+        self.assertEqual(received.body, 'FOO')
+
+    def test_v2_is_smaller(self):
+        msg = Message(Message.REQ, 'upper.upper', body={'text': 'foo'}, headers={'trace_id': make_id(), 'deadline': 1234567890.5})
+        v1_size = sum(len(frame) for frame in msg.pack_frames(1))
+        v2_size = sum(len(frame) for frame in msg.pack_frames(2))
+        self.assertLess(v2_size, v1_size)
+
+    def test_v2_unconfirmed_subject(self):
+        msg = Message(Message.REQ, 'upper.upper', body=None)
+        received, frames = roundtrip(msg, 2, subjects={})
+        self.assertEqual(received.subject, 'upper.upper')
+        self.assertFalse(received.subject_hashed)
+
+    def test_v2_unknown_subject_hash(self):
+        msg = Message(Message.REQ, 'upper.upper', body=None)
+        received, frames = roundtrip(msg, 2, subjects={}, hashed_subjects={'upper.upper'})
+        self.assertEqual(received.subject, '#%08x' % hash_subject('upper.upper'))
+
+    def test_v2_falls_back_to_v1(self):
+        msg = Message(Message.REP, 'upper.upper', body=None, msg_id='f' * 32, headers={'trace_id': 'legacy'})
+        received, frames = roundtrip(msg, 2)
+        self.assertEqual(len(frames), 6)
+        self.assertEqual(received.id, 'f' * 32)
+
+    def test_v2_legacy_trace_id(self):
+        msg = Message(Message.REQ, 'upper.upper', body=None, headers={'trace_id': 'a' * 32})
+        received, frames = roundtrip(msg, 2)
+        self.assertEqual(len(frames), 4)
+        self.assertEqual(received.headers['trace_id'], 'a' * 32)
+
+    def test_v2_bad_preamble(self):
+        self.assertRaises(ValueError, Message.unpack_frames, [b'src', b'\x02\x01', b''])
+        self.assertRaises(ValueError, Message.unpack_frames, [b'src', b'\x02\x00\x00' + b'x' * 12, b''])
+
+
+class LazyDecodingTests(unittest.TestCase):
+    def test_received_messages_are_decoded_lazily(self):
+        msg = Message(Message.REQ, 'upper.upper', body={'text': 'foo'}, headers={'trace_id': make_id()})
+        for version in (1, 2):
+            received, frames = roundtrip(msg, version)
+            self.assertIsNotNone(received._packed_body)
+            self.assertEqual(received.body, {'text': 'foo'})
+            self.assertIsNone(received._packed_body)
+            self.assertEqual(received.packed_body, msg.packed_body)
+
+    def test_body_errors_are_raised_on_access(self):
+        frames = [b'src', b'id', Message.REP, b'subject', b'\x80', b'\xc1']
+        msg = Message.unpack_frames(frames)
+        self.assertEqual(msg.headers, {})
+        self.assertRaises(Exception, lambda: msg.body)
+
+    def test_slots(self):
+        msg = Message(Message.REQ, 'upper.upper', body=None)
+        self.assertRaises(AttributeError, setattr, msg, 'foo', 42)
+
+
+class OutOfBandBufferTests(unittest.TestCase):
+    def test_large_bytes(self):
+        data = b'x' * (1024 * 1024)
+        msg = Message(Message.REP, make_id(), body={'data': data, 'small': b'y'})
+        received, frames = roundtrip(msg, 2)
+        self.assertEqual(len(frames), 4)
+        self.assertIs(frames[-1], data)
+        self.assertLess(len(frames[-2]), 100)
+        self.assertIs(received.body['data'], data)
+        self.assertEqual(received.body['small'], b'y')
+
+    def test_memoryview(self):
+        data = bytearray(b'x' * (1024 * 1024))
+        msg = Message(Message.REP, make_id(), body=[memoryview(data)])
+        received, frames = roundtrip(msg, 2)
+        self.assertIsInstance(received.body[0], memoryview)
+        self.assertEqual(received.body[0].tobytes(), bytes(data))
+
+    def test_inline_for_v1(self):
+        data = b'x' * (1024 * 1024)
+        msg = Message(Message.REP, make_id(), body={'data': data})
+        with mock.patch.object(msgpack_serializer, 'extract_buffers') as extract_buffers:
+            received, frames = roundtrip(msg, 1)
+        self.assertFalse(extract_buffers.called)
+        self.assertEqual(len(frames), 6)
+        self.assertEqual(received.body, {'data': data})
+        # the message can still be sent as v2
+        received, frames = roundtrip(msg, 2)
+        self.assertIs(frames[-1], data)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_ndarray(self):
+        small = numpy.arange(12, dtype='int16').reshape(3, 4)
+        large = numpy.ones((512, 256), dtype='float64')
+        msg = Message(Message.REP, make_id(), body={'small': small, 'large': large, 'transposed': small.T})
+        for version in (1, 2):
+            received, frames = roundtrip(msg, version)
+            body = received.body
+            for key, value in (('small', small), ('large', large), ('transposed', small.T)):
+                self.assertEqual(body[key].dtype, value.dtype)
+                self.assertTrue((body[key] == value).all())
+        self.assertEqual(len(frames), 4)
+        self.assertEqual(len(frames[-1]), large.nbytes)
+
+
+class CompressionTests(unittest.TestCase):
+    def test_codecs(self):
+        data = b'foo bar baz ' * 1000
+        for name, codec in compression.codecs.items():
+            compressed = codec.compress(data)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(compression.decompress(compressed), data)
+        self.assertIn('zlib', compression.get_codecs(True))
+        self.assertEqual(compression.get_codecs(), [])
+        self.assertEqual(compression.get_codecs(['unknown', 'zlib']), ['zlib'])
+        self.assertEqual(compression.get_codecs(False), [])
+
+    def test_compressed_body(self):
+        body = {'text': 'foo bar baz ' * 1000}
+        msg = Message(Message.REP, make_id(), body=body)
+        received, frames = roundtrip(msg, 2, compress=compression.codecs['zlib'].compress)
+        self.assertTrue(received.compressed)
+        self.assertLess(len(frames[-1]), len(msg.packed_body))
+        self.assertEqual(received.decompress(), (len(frames[-1]), len(msg.packed_body)))
+        self.assertEqual(received.body, body)
+
+    def test_bad_compressed_body(self):
+        self.assertRaises(ValueError, compression.decompress, b'\x01foo')
+        self.assertRaises(ValueError, compression.decompress, b'\xfffoo')
@@ -1,8 +1,9 @@
 import gevent
 import gevent.pool
-import uuid
 import logging
 
+from lymph.utils import make_id
+
 
 def get_trace(greenlet=None):
     greenlet = greenlet or gevent.getcurrent()
@@ -32,7 +33,7 @@ def trace(**kwargs):
 
 
 def set_id(trace_id=None):
-    trace_id = trace_id or uuid.uuid4().hex
+    trace_id = trace_id or make_id()
     trace(lymph_trace_id=trace_id)
     return trace_id
 
@@ -41,6 +42,27 @@ def get_id():
     return get_trace().get('lymph_trace_id')
 
 
+def set_deadline(deadline=None):
+    trace(lymph_deadline=deadline)
+
+
+def get_deadline():
+    return get_trace().get('lymph_deadline')
+
+
+def set_channel(channel=None):
+    trace(lymph_channel=channel)
+
+
+def is_cancelled():
+    """
+    Returns True if the caller has given up on the request that is being
+    handled. Long running rpc methods should check this and stop early.
+    """
+    channel = get_trace().get('lymph_channel')
+    return channel is not None and channel.is_cancelled()
+
+
 class TraceFormatter(logging.Formatter):
     def format(self, record):
         record.trace_id = get_id()
@@ -87,7 +87,9 @@ class KombuEventSystem(BaseEventSystem):
     def setup_consumer(self, handler):
         with self._get_connection() as conn:
             self.exchange(conn).declare()
-            queue = kombu.Queue(handler.queue_name, self.exchange, durable=True)
+            # broadcast queues belong to a single instance and go away with it
+            broadcast = getattr(handler, 'broadcast', False)
+            queue = kombu.Queue(handler.queue_name, self.exchange, durable=not broadcast, auto_delete=broadcast)
             queue(conn).declare()
             for event_type in handler.event_types:
                 queue(conn).bind_to(exchange=self.exchange, routing_key=event_type)
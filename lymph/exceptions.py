@@ -21,6 +21,21 @@ class Nack(RpcError):
     pass
 
 
+class Overloaded(Nack):
+    pass
+
+
+class CircuitOpen(Nack):
+    """
+    The request was not sent because the circuit breaker of the instance it
+    was routed to is open.
+    """
+
+
+class Cancelled(RpcError):
+    pass
+
+
 class LookupFailure(RpcError):
     pass
 
@@ -24,8 +24,10 @@ def _export():
     from lymph.core.decorators import rpc, raw_rpc, event
     from lymph.core.interfaces import Interface
     from lymph.core.declarations import proxy
+    from lymph.core.futures import gather, wait_any
+    from lymph.core.trace import is_cancelled
 
-    for obj in (RpcError, LookupFailure, Timeout, rpc, raw_rpc, event, Interface, proxy):
+    for obj in (RpcError, LookupFailure, Timeout, rpc, raw_rpc, event, Interface, proxy, gather, wait_any, is_cancelled):
         setattr(lymph, obj.__name__, obj)
 
 
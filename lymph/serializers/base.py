@@ -62,15 +62,65 @@ class SetSerializer(ExtensionTypeSerializer):
         return set(obj)
 
 
+class NdarraySerializer(ExtensionTypeSerializer):
+    def serialize(self, obj):
+        if obj.dtype.hasobject:
+            raise TypeError('cannot serialize arrays of python objects')
+        if not obj.flags.c_contiguous:
+            obj = obj.copy(order='C')
+        return [obj.dtype.str, list(obj.shape), memoryview(obj.reshape(-1).view('u1'))]
+
+    def deserialize(self, obj):
+        import numpy
+        dtype, shape, data = obj
+        return numpy.frombuffer(data, dtype=dtype).reshape(shape)
+
+
 _extension_type_serializers = {
     'datetime': DatetimeSerializer(),
     'date': DateSerializer(),
     'time': TimeSerializer(),
     'Decimal': StrSerializer(decimal.Decimal),
     'UUID': StrSerializer(uuid.UUID),
-    'set': SetSerializer()
+    'set': SetSerializer(),
+    'ndarray': NdarraySerializer(),
 }
 
+#: binary values of at least this many bytes are sent out-of-band
+BUFFER_THRESHOLD = 64 * 1024
+
+_buffer_types = (bytes, bytearray, memoryview)
+_scalar_types = frozenset(six.string_types + six.integer_types + (six.text_type, float, bool, type(None)))
+
+
+def _nbytes(obj):
+    if isinstance(obj, memoryview):
+        return obj.nbytes
+    return len(obj)
+
+
+def _as_flat_buffer(obj):
+    view = memoryview(obj)
+    if view.ndim != 1 or view.itemsize != 1:
+        if not view.c_contiguous:
+            view = memoryview(view.tobytes())
+        view = view.cast('B')
+    return view
+
+
+def _has_binary_values(obj):
+    """
+    Returns True if `obj` is a dict with binary values or numpy arrays at the
+    top level, which is the usual way to send them.
+    """
+    if type(obj) is not dict:
+        return False
+    for value in six.itervalues(obj):
+        value_type = type(value)
+        if value_type in _buffer_types or value_type.__name__ == 'ndarray':
+            return True
+    return False
+
 
 class BaseSerializer(object):
     def __init__(self, dumps=None, loads=None, load=None, dump=None):
@@ -89,18 +139,90 @@ class BaseSerializer(object):
             }
         return obj
 
-    def load_object(self, obj):
+    def load_object(self, obj, buffers=None):
         obj_type = obj.get('__type__')
+        if obj_type == 'buffer':
+            return self.load_buffer(obj, buffers)
         if obj_type:
             serializer = _extension_type_serializers.get(obj_type)
             return serializer.deserialize(obj['_'])
         return obj
 
-    def dumps(self, obj):
-        return self._dumps(obj, default=self.dump_object)
+    def extract_buffers(self, obj, buffers, threshold=BUFFER_THRESHOLD):
+        """
+        Returns `obj` with every binary value of at least `threshold` bytes,
+        including the data of numpy arrays, replaced by a reference to its
+        index in `buffers`. Containers are copied only if they change.
+        """
+        obj_type = type(obj)
+        if obj_type is dict:
+            result = None
+            for key, value in six.iteritems(obj):
+                if type(value) in _scalar_types:
+                    continue
+                extracted = self.extract_buffers(value, buffers, threshold)
+                if extracted is not value:
+                    if result is None:
+                        result = dict(obj)
+                    result[key] = extracted
+            return obj if result is None else result
+        elif obj_type is list or obj_type is tuple:
+            result = None
+            for i, value in enumerate(obj):
+                if type(value) in _scalar_types:
+                    continue
+                extracted = self.extract_buffers(value, buffers, threshold)
+                if extracted is not value:
+                    if result is None:
+                        result = list(obj)
+                    result[i] = extracted
+            return obj if result is None else result
+        elif obj_type in _buffer_types:
+            if _nbytes(obj) < threshold:
+                return obj
+            kind = 'bytes' if obj_type is bytes else 'memoryview'
+            buffers.append(obj if obj_type is bytes else _as_flat_buffer(obj))
+            return {'__type__': 'buffer', '_': [len(buffers) - 1, kind]}
+        elif obj_type.__name__ == 'ndarray':
+            return self.extract_buffers(self.dump_object(obj), buffers, threshold)
+        return obj
 
-    def loads(self, s):
-        return self._loads(s, object_hook=self.load_object)
+    def load_buffer(self, obj, buffers):
+        if buffers is None:
+            raise ValueError('reference to an out-of-band buffer without buffers')
+        index, kind = obj['_']
+        buf = buffers[index]
+        if kind == 'bytes':
+            return buf if isinstance(buf, bytes) else bytes(buf)
+        return memoryview(buf)
+
+    def dumps(self, obj, buffers=None, buffer_threshold=BUFFER_THRESHOLD):
+        """
+        Serializes `obj`. If a `buffers` list is given, large binary values
+        are appended to it instead of being serialized inline (see
+        :meth:`extract_buffers`).
+        """
+        if buffers is not None and _has_binary_values(obj):
+            obj = self.extract_buffers(obj, buffers, buffer_threshold)
+            return self._dumps(obj, default=self.dump_object)
+        packed = self._dumps(obj, default=self.dump_object)
+        # a body that is smaller than the threshold cannot contain a buffer
+        # that is as large, which saves the walk for most messages
+        if buffers is None or len(packed) < buffer_threshold:
+            return packed
+        extracted = self.extract_buffers(obj, buffers, buffer_threshold)
+        if extracted is obj:
+            return packed
+        return self._dumps(extracted, default=self.dump_object)
+
+    def loads(self, s, buffers=None):
+        """
+        Deserializes `s`. `buffers` are the out-of-band buffers that were
+        collected by :meth:`dumps`.
+        """
+        if buffers is None:
+            return self._loads(s, object_hook=self.load_object)
+        return self._loads(s, object_hook=functools.partial(self.load_object, buffers=buffers))
 
     def dump(self, obj, f):
         return self._dump(obj, f, default=self.dump_object)
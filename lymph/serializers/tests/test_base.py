@@ -4,6 +4,8 @@ import json
 import unittest
 import uuid
 
+import mock
+
 from lymph.serializers import base
 
 
@@ -157,4 +159,35 @@ class SerializerBaseTest(unittest.TestCase):
                          '{"__type__": "datetime", "_": "2014-09-12T08:33:12Z"}, '
                          '{"__type__": "datetime", "_": "2015-09-12T08:33:12Z"}'
                          ']}'), set([datetime.datetime(2014, 9, 12, 8, 33, 12),
-                                     datetime.datetime(2015, 9, 12, 8, 33, 12)]))
\ No newline at end of file
+                                     datetime.datetime(2015, 9, 12, 8, 33, 12)]))
+
+    def test_BaseSerializer_extract_buffers(self):
+        serializer = base.msgpack_serializer
+        body = {'a': [1, 'b', {'c': b'small'}], 'd': None}
+        buffers = []
+        self.assertIs(serializer.extract_buffers(body, buffers, threshold=10), body)
+        self.assertEqual(buffers, [])
+
+        data = b'x' * 10
+        body = {'a': [1, data], 'b': 'c'}
+        extracted = serializer.extract_buffers(body, buffers, threshold=10)
+        self.assertEqual(extracted, {'a': [1, {'__type__': 'buffer', '_': [0, 'bytes']}], 'b': 'c'})
+        self.assertEqual(body, {'a': [1, data], 'b': 'c'})
+        self.assertEqual(buffers, [data])
+        packed = serializer.dumps(body, buffers=[], buffer_threshold=10)
+        self.assertEqual(serializer.loads(packed, buffers=buffers), body)
+        self.assertRaises(ValueError, serializer.loads, packed)
+
+    def test_BaseSerializer_dumps_skips_small_bodies(self):
+        serializer = base.msgpack_serializer
+        with mock.patch.object(serializer, 'extract_buffers', wraps=serializer.extract_buffers) as extract:
+            body = {'a': [1, {'b': b'x' * 32}]}
+            buffers = []
+            self.assertEqual(serializer.loads(serializer.dumps(body, buffers=buffers, buffer_threshold=64)), body)
+            self.assertFalse(extract.called)
+
+            body = {'a': [1, {'b': b'x' * 64}]}
+            packed = serializer.dumps(body, buffers=buffers, buffer_threshold=64)
+            self.assertTrue(extract.called)
+            self.assertEqual(len(buffers), 1)
+            self.assertEqual(serializer.loads(packed, buffers=buffers), body)
@@ -30,6 +30,8 @@ class Coordinator(Interface):
         services = self.service_map.setdefault(service_name, [])
         msg = channel.request
         self.endpoint_map[endpoint] = service_name
+        # registrations end with the connection, so don't reap it when idle
+        self.container.connect(msg.source).idle_disconnect = None
         info = msg.body.copy()
         info['endpoint'] = msg.source
         services.append({
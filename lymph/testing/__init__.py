@@ -5,7 +5,6 @@ from kazoo.handlers.gevent import SequentialGeventHandler
 from kazoo.testing.harness import KazooTestHarness
 
 from lymph.core.container import ServiceContainer
-from lymph.core.connection import Connection
 from lymph.core.interfaces import Interface
 from lymph.core.messages import Message
 from lymph.discovery.static import StaticServiceRegistryHub
@@ -56,17 +55,19 @@ class MockServiceContainer(ServiceContainer):
 
     def connect(self, endpoint):
         if endpoint not in self.connections:
-            self.connections[endpoint] = Connection(self, endpoint)
+            self.evict_connections()
+            self.connections[endpoint] = self.create_connection(endpoint)
         return self.connections[endpoint]
 
-    def send_message(self, address, msg):
-        dst = self.lookup(address).connect().endpoint
-        dst = self._mock_network.service_containers[dst]
+    def disconnect_socket(self, transport_endpoint):
+        pass
+
+    def send_frames(self, connection, frames):
+        dst = self._mock_network.service_containers[connection.endpoint]
 
         # Exercise the msgpack packing and unpacking.
-        frames = msg.pack_frames()
-        frames.insert(0, self.endpoint.encode('utf-8'))
-        msg = Message.unpack_frames(frames)
+        frames = [self.endpoint.encode('utf-8')] + [bytes(frame) for frame in frames[1:]]
+        msg = Message.unpack_frames(frames, subjects=dst.subjects)
 
         dst.recv_message(msg)
 
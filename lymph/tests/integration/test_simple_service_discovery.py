@@ -1,9 +1,14 @@
+import gevent
+import mock
+
 from lymph.testing import LymphIntegrationTestCase
+from lymph.core.container import _inproc_endpoints
 from lymph.core.decorators import rpc
 from lymph.core.interfaces import Interface
 from lymph.services.coordinator import Coordinator
 from lymph.discovery.static import StaticServiceRegistry
 from lymph.events.null import NullEventSystem
+from lymph.exceptions import Timeout
 
 
 class Upper(Interface):
@@ -48,3 +53,64 @@ class BasicIntegrationTest(LymphIntegrationTestCase):
         reply = self.client.request(self.upper_container.endpoint, 'lymph.status', {})
         self.assertEqual(reply.body['endpoint'], self.upper_container.endpoint)
         self.assertEqual(reply.body['config'], {})
+
+    def test_batched_replies(self):
+        container = self.client.container
+        batch_sizes = []
+
+        def unpack_batch(batch):
+            batch_sizes.append(len(batch))
+            return unpack_batch.wrapped(batch)
+        unpack_batch.wrapped = container.unpack_batch
+
+        with mock.patch.object(container, 'unpack_batch', unpack_batch):
+            channels = [
+                container.send_request(self.upper_container.endpoint, 'upper.upper', {'text': 'foo%s' % i})
+                for i in range(50)
+            ]
+            replies = [channel.get().body for channel in channels]
+        self.assertEqual(replies, ['FOO%s' % i for i in range(50)])
+        # the recv loop drained several replies per iteration
+        self.assertGreater(max(batch_sizes), 1)
+        self.assertLess(len(batch_sizes), 50)
+
+    def test_zero_copy_tracker(self):
+        container = self.client.container
+        channel = container.send_request(self.upper_container.endpoint, 'upper.upper', {'text': 'foo'})
+        self.assertIsNone(channel.tracker)
+        channel.get()
+        channel = container.send_request(self.upper_container.endpoint, 'upper.upper', {'text': 'x' * container.zero_copy_threshold})
+        self.assertIsNotNone(channel.tracker)
+        self.assertEqual(channel.get().body, 'X' * container.zero_copy_threshold)
+        channel.tracker.wait(timeout=1)
+        self.assertTrue(channel.tracker.done)
+
+    def test_unreachable_peer(self):
+        endpoint = 'tcp://127.0.0.1:1'
+        self.client.container.connect_timeout = .05
+        channel = self.client.container.send_request(endpoint, 'upper.upper', {'text': 'foo'})
+        connection = self.client.container.connections[endpoint]
+        self.assertEqual(len(connection.send_queue), 1)
+        self.assertRaises(Timeout, channel.get, timeout=.01)
+        gevent.sleep(.1)
+        self.assertEqual(len(connection.send_queue), 0)
+
+    def test_inproc_transport(self):
+        reply = self.client.request(self.upper_container.endpoint, 'upper.upper', {'text': 'foo'})
+        self.assertEqual(reply.body, 'FOO')
+        connection = self.client.container.connections[self.upper_container.endpoint]
+        self.assertEqual(connection.transport_endpoint, self.upper_container.inproc_endpoint)
+
+    def test_ipc_transport(self):
+        container = self.client.container
+        endpoint = self.upper_container.endpoint
+        self.assertEqual(self.upper_container.ipc_endpoint, 'ipc://%s' % container.get_ipc_path(endpoint))
+        inproc_endpoint = _inproc_endpoints.pop(endpoint)
+        try:
+            self.assertEqual(container.get_transport_endpoint(endpoint), self.upper_container.ipc_endpoint)
+            reply = self.client.request(endpoint, 'upper.upper', {'text': 'foo'})
+            self.assertEqual(reply.body, 'FOO')
+        finally:
+            _inproc_endpoints[endpoint] = inproc_endpoint
+        self.assertEqual(container.get_transport_endpoint('tcp://127.0.0.1:1'), 'tcp://127.0.0.1:1')
+        self.assertEqual(container.get_transport_endpoint('tcp://10.1.2.3:4567'), 'tcp://10.1.2.3:4567')
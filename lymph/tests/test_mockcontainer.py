@@ -1,11 +1,18 @@
+import os
+import time
 import unittest
 
+import gevent
+import mock
+
 import lymph
+from lymph.core import compression
 from lymph.core.interfaces import Interface
 from lymph.core.messages import Message
 from lymph.services.coordinator import Coordinator
 from lymph.testing import MockServiceNetwork
-from lymph.exceptions import RemoteError, Nack
+from lymph.core import trace
+from lymph.exceptions import RemoteError, Nack, Timeout
 
 
 class Upper(Interface):
@@ -29,10 +36,30 @@ class Upper(Interface):
     def fail(self):
         raise ValueError('foobar')
 
+    @lymph.rpc(stream=True, raises=(ValueError,))
+    def count(self, n=0, fail_at=None):
+        for i in range(n):
+            if i == fail_at:
+                raise ValueError('failed at %s' % i)
+            yield i
+
+    @lymph.rpc()
+    def deadline(self):
+        return trace.get_deadline()
+
+    @lymph.rpc()
+    def nested_deadline(self):
+        channel = self.container.send_request('upper', 'upper.deadline', {}, timeout=10)
+        return channel.request.deadline, channel.get().body
+
     @lymph.raw_rpc()
     def just_ack(self, channel):
         channel.ack()
 
+    @lymph.raw_rpc()
+    def headers(self, channel):
+        channel.reply(channel.request.headers)
+
     @lymph.rpc()
     def auto_nack(self):
         raise ValueError('auto nack requested')
@@ -67,6 +94,23 @@ class BasicMockTest(unittest.TestCase):
         reply = self.client.request('upper', 'upper.indirect_upper', {'text': 'foo'})
         self.assertEqual(reply.body, 'FOO')
 
+    def test_route_reply_through_connection_table(self):
+        self.client.request('upper', 'upper.upper', {'text': 'foo'})
+        connection = self.upper_container.connections[self.client_container.endpoint]
+        with mock.patch('lymph.core.container.ServiceInstance') as instance_cls:
+            self.assertIs(self.upper_container.route(self.client_container.endpoint), connection)
+            reply = self.client.request('upper', 'upper.upper', {'text': 'foo'})
+        self.assertEqual(reply.body, 'FOO')
+        self.assertFalse(instance_cls.called)
+        self.assertEqual(connection.identity, self.client_container.endpoint.encode('utf-8'))
+
+    def test_reply_fast_path(self):
+        self.client.request('upper', 'upper.upper', {'text': 'foo'})
+        with mock.patch.object(self.upper_container, 'route') as route:
+            reply = self.client.request('upper', 'upper.upper', {'text': 'foo'})
+        self.assertEqual(reply.body, 'FOO')
+        self.assertFalse(route.called)
+
     def test_ping(self):
         reply = self.client.request('upper', 'lymph.ping', {'payload': 42})
         self.assertEqual(reply.body, 42)
@@ -111,6 +155,272 @@ class BasicMockTest(unittest.TestCase):
         proxy = self.client.proxy('upper', namespace='lymph')
         methods = proxy.inspect()['methods']
         self.assertEqual(set(m['name'] for m in methods), set([
-            'upper.fail', 'upper.upper', 'upper.auto_nack', 'upper.just_ack',
+            'upper.fail', 'upper.upper', 'upper.auto_nack', 'upper.just_ack', 'upper.count',
+            'upper.deadline', 'upper.nested_deadline', 'upper.headers',
             'lymph.status', 'lymph.inspect', 'lymph.ping', 'upper.indirect_upper'
         ]))
+
+    def test_batch(self):
+        channel = self.client_container.send_batch('upper', [
+            ('upper.upper', {'text': 'foo'}),
+            ('upper.fail', {}),
+            ('upper.auto_nack', {}),
+            ('upper.just_ack', {}),
+            ('unknown.method', {}),
+        ])
+        upper, fail, auto_nack, just_ack, unknown = channel.get()
+        self.assertEqual(upper.body, 'FOO')
+        self.assertIsInstance(fail, RemoteError.ValueError)
+        self.assertIsInstance(auto_nack, Nack)
+        self.assertEqual(just_ack.type, Message.ACK)
+        self.assertIsInstance(unknown, Nack)
+
+    def test_proxy_batch(self):
+        proxy = self.client.proxy('upper')
+        results = proxy.call_batch([
+            ('upper', {'text': 'foo'}),
+            ('fail', {}),
+            ('indirect_upper', {'text': 'bar'}),
+        ])
+        self.assertEqual(results[0], 'FOO')
+        self.assertIsInstance(results[1], RemoteError.ValueError)
+        self.assertEqual(results[2], 'BAR')
+        self.assertEqual(proxy.call_batch([]), [])
+
+    def test_stream(self):
+        proxy = self.client.proxy('upper')
+        self.assertEqual(list(proxy.count.stream(n=50)), list(range(50)))
+        self.assertEqual(list(proxy.count.stream()), [])
+
+    def test_stream_error(self):
+        proxy = self.client.proxy('upper')
+        chunks = proxy.count.stream(n=10, fail_at=5)
+        self.assertEqual([next(chunks) for i in range(5)], list(range(5)))
+        self.assertRaises(RemoteError.ValueError, next, chunks)
+
+    def test_stream_flow_control(self):
+        channel = self.client_container.send_request('upper', 'upper.count', {'n': 20}, stream_window=4)
+        chunks = channel.stream()
+        self.assertEqual(next(chunks), 0)
+        gevent.sleep(.01)
+        self.assertEqual(channel.queue.qsize(), 3)
+        self.assertEqual(list(chunks), list(range(1, 20)))
+        self.assertEqual(self.upper_container.reply_channels, {})
+
+    def test_stream_without_window(self):
+        proxy = self.client.proxy('upper')
+        self.assertEqual(proxy.count(n=3), [0, 1, 2])
+
+    def test_deadline_propagation(self):
+        proxy = self.client.proxy('upper', timeout=2)
+        now = time.time()
+        self.assertAlmostEqual(proxy.deadline(), now + 2, delta=.5)
+        sent, received = proxy.nested_deadline()
+        self.assertEqual(sent, received)
+        self.assertAlmostEqual(received, now + 2, delta=.5)
+
+    def test_expired_request(self):
+        channel = self.client_container.send_request('upper', 'upper.upper', {'text': 'foo'}, headers={'deadline': time.time() - 1})
+        self.assertRaises(Timeout, channel.get)
+        self.assertEqual(self.upper_container.executor.expired_count, 1)
+
+    def test_expired_batch(self):
+        channel = self.client_container.send_batch('upper', [
+            ('upper.upper', {'text': 'foo'}),
+            ('upper.upper', {'text': 'bar'}),
+        ], headers={'deadline': time.time() - 1})
+        for result in channel.get():
+            self.assertIsInstance(result, Nack)
+        self.assertEqual(self.upper_container.executor.expired_count, 2)
+        self.assertEqual(self.upper_container.reply_channels, {})
+
+    def test_unknown_interface(self):
+        self.assertRaises(Nack, self.client.request, self.upper_container.endpoint, 'unknown.method', {})
+        self.assertEqual(self.upper_container.reply_channels, {})
+
+    def test_abandoned_requests_expire(self):
+        self.client_container.channels.ttl = .05
+        self.client_container.send_request('upper', 'upper.upper', {'text': 'foo'})
+        self.client_container.send_request('upper', 'upper.upper', {'text': 'foo'}, timeout=.05)
+        self.assertEqual(len(self.client_container.channels), 2)
+        gevent.sleep(.3)
+        self.assertEqual(len(self.client_container.channels), 0)
+        self.assertEqual(self.client_container.channels.expired_count, 2)
+
+    def test_wire_version_negotiation(self):
+        self.client.request('upper', 'upper.upper', {'text': 'foo'})
+        reply = self.client.request('upper', 'upper.upper', {'text': 'foo'})
+        self.assertEqual(reply.version, 2)
+        self.assertEqual(reply.body, 'FOO')
+        self.assertEqual(self.client_container.connect(self.upper_container.endpoint).wire_version, 2)
+
+    def test_subject_hash_confirmation(self):
+        connection = self.client_container.connect(self.upper_container.endpoint)
+        with mock.patch.object(self.upper_container, 'recv_message', wraps=self.upper_container.recv_message) as recv:
+            for i in range(3):
+                reply = self.client.request('upper', 'upper.upper', {'text': 'foo'})
+                self.assertNotIn('subject_hash', reply.headers)
+        # v1, full subject, confirmed hash
+        self.assertEqual([call[0][0].version for call in recv.call_args_list], [1, 2, 2])
+        self.assertEqual([call[0][0].subject_hashed for call in recv.call_args_list], [False, False, True])
+        self.assertIn('upper.upper', connection.hashed_subjects)
+
+    def test_unknown_subject_hash(self):
+        self.client.request('upper', 'upper.upper', {'text': 'foo'})
+        connection = self.client_container.connect(self.upper_container.endpoint)
+        connection.hashed_subjects.add('upper.unknown')
+        self.assertRaises(Nack, self.client.request, 'upper', 'upper.unknown', {})
+        self.assertNotIn('upper.unknown', connection.hashed_subjects)
+        self.assertEqual(self.upper_container.reply_channels, {})
+
+    def test_wire_header_is_internal(self):
+        reply = self.client.request('upper', 'upper.headers', {})
+        self.assertEqual(reply.version, 2)
+        self.assertNotIn('wire', reply.body)
+
+    def test_v1_peer(self):
+        legacy_container = self.network.add_service(ClientInterface, 'legacy', wire_version=1)
+        legacy_container.start()
+        legacy = legacy_container.installed_interfaces['legacy']
+        for i in range(2):
+            reply = legacy.request('upper', 'upper.upper', {'text': 'foo'})
+            self.assertEqual(reply.body, 'FOO')
+        # replies to a container that only sends v1 may still use v2
+        self.assertEqual(reply.version, 2)
+        upper_connection = self.upper_container.connect(legacy_container.endpoint)
+        self.assertEqual(upper_connection.wire_version, 2)
+
+    def test_legacy_peer(self):
+        self.client.request('upper', 'upper.upper', {'text': 'foo'})
+        connection = self.upper_container.connect(self.client_container.endpoint)
+        self.assertEqual(connection.wire_version, 2)
+        # messages of older lymph versions don't advertise a wire version
+        self.upper_container.recv_message(Message(
+            Message.REQ, 'lymph.ping', body={'payload': ''}, source=self.client_container.endpoint))
+        self.assertEqual(connection.wire_version, 1)
+
+    def enable_compression(self):
+        for container in (self.client_container, self.upper_container):
+            container.compression_codecs = compression.get_codecs(True)
+
+    def test_compression(self):
+        self.enable_compression()
+        self.client_container.ping('upper').get()
+        connection = self.upper_container.connect(self.client_container.endpoint)
+        self.assertEqual(connection.codec.name, self.client_container.compression_codecs[0])
+        text = 'foo bar baz ' * 10000
+        reply = self.client.request('upper', 'upper.upper', {'text': text})
+        self.assertEqual(reply.body, text.upper())
+        stats = connection.stats()['compression']['sent']
+        self.assertEqual(stats['messages'], 1)
+        self.assertGreater(stats['ratio'], 10)
+        client_connection = self.client_container.connect(self.upper_container.endpoint)
+        self.assertEqual(client_connection.stats()['compression']['received']['messages'], 1)
+
+    def test_incompressible(self):
+        self.enable_compression()
+        self.client_container.ping('upper').get()
+        connection = self.upper_container.connect(self.client_container.endpoint)
+        self.assertIsNone(connection.compress(os.urandom(100000)))
+        self.assertEqual(connection.stats()['compression']['sent']['messages'], 0)
+
+    def test_compression_disabled(self):
+        self.upper_container.compression_codecs = compression.get_codecs(True)
+        self.client_container.ping('upper').get()
+        connection = self.upper_container.connect(self.client_container.endpoint)
+        self.assertIsNone(connection.codec)
+        self.assertIsNone(connection.compress(b'x' * 100000))
+
+
+class Mutator(Interface):
+    @lymph.rpc()
+    def append(self, items=None):
+        items.append(len(items))
+        return items
+
+
+class LocalDispatchTest(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.coordinator = self.network.add_service(Coordinator, 'coordinator')
+        self.container = self.network.add_service(Upper, 'upper', local_dispatch=True)
+        self.container.install(Mutator, interface_name='mutator')
+        self.network.start()
+        self.upper = self.container.installed_interfaces['upper']
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+    def test_local_request(self):
+        reply = self.upper.request('upper', 'upper.upper', {'text': 'foo'})
+        self.assertEqual(reply.body, 'FOO')
+        self.assertEqual(self.container.loopback.sent_message_count, 2)
+        self.assertEqual(self.container.connections, {})
+
+    def test_local_error(self):
+        proxy = self.upper.proxy('upper')
+        self.assertRaises(RemoteError.ValueError, proxy.fail)
+        self.assertRaises(Nack, proxy.auto_nack)
+
+    def test_local_deadline(self):
+        proxy = self.upper.proxy('upper', timeout=2)
+        sent, received = proxy.nested_deadline()
+        self.assertEqual(sent, received)
+
+    def test_local_stream(self):
+        proxy = self.upper.proxy('upper')
+        self.assertEqual(list(proxy.count.stream(n=40)), list(range(40)))
+
+    def test_copy_on_call(self):
+        items = [0]
+        proxy = self.upper.proxy('mutator')
+        self.assertEqual(proxy.append(items=items), [0, 1])
+        self.assertEqual(items, [0])
+        self.container.local_dispatch_copy = False
+        self.assertEqual(proxy.append(items=items), [0, 1])
+        self.assertEqual(items, [0, 1])
+
+
+class Shard(Interface):
+    @lymph.rpc()
+    def whoami(self, key=None):
+        return self.container.endpoint
+
+
+class RoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.network = MockServiceNetwork()
+        self.coordinator = self.network.add_service(Coordinator, 'coordinator')
+        self.shards = [self.network.add_service(Shard, 'shard') for i in range(3)]
+        self.client_container = self.network.add_service(ClientInterface, 'client')
+        self.network.start()
+        self.client = self.client_container.installed_interfaces['client']
+
+    def tearDown(self):
+        self.network.stop()
+        self.network.join()
+
+    def test_route_key(self):
+        proxy = self.client.proxy('shard', route_key='key')
+        owners = {}
+        for key in range(30):
+            owners[key] = proxy.whoami(key=key)
+        self.assertEqual(len(set(owners.values())), 3)
+        for key in range(30):
+            self.assertEqual(proxy.whoami(key=key), owners[key])
+            self.assertEqual(self.client.proxy('shard')._route(key).whoami(), owners[key])
+
+    def test_route_key_function(self):
+        proxy = self.client.proxy('shard', route_key=lambda kwargs: kwargs['key'] % 2)
+        self.assertEqual(len(set(proxy.whoami(key=key) for key in range(30))), 2)
+
+    def test_unhealthy_owner(self):
+        proxy = self.client.proxy('shard', route_key='key')
+        owner = proxy.whoami(key='foo')
+        connection = self.client_container.connections[owner]
+        connection.last_seen = 1
+        connection.check_status(time.monotonic())
+        fallback = proxy.whoami(key='foo')
+        self.assertNotEqual(fallback, owner)
+        self.assertEqual(proxy.whoami(key='foo'), fallback)
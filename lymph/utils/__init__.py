@@ -1,10 +1,13 @@
 from __future__ import absolute_import, division
 
 
+import base64
 import collections
 import importlib
+import itertools
 import math
-import uuid
+import os
+import struct
 
 
 class Undefined(object):
@@ -33,8 +36,27 @@ def import_object(module_name, object_path=None):
     return obj
 
 
+_id_counter = itertools.count()
+_id_prefix = None
+
+
+def _reset_id_prefix():
+    global _id_prefix
+    _id_prefix = base64.urlsafe_b64encode(os.urandom(6)).decode('ascii')
+
+
+_reset_id_prefix()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_id_prefix)
+
+
 def make_id():
-    return uuid.uuid4().hex
+    """
+    Returns a unique id of 16 URL-safe base64 characters: a random prefix
+    that is chosen once per process followed by a 48-bit counter.
+    """
+    n = next(_id_counter) & 0xffffffffffff
+    return _id_prefix + base64.urlsafe_b64encode(struct.pack('>Q', n)[2:]).decode('ascii')
 
 
 _sqrt2 = math.sqrt(2)
@@ -83,6 +105,53 @@ class Accumulator(object):
         return {'mean': self.mean, 'stddev': self.stddev, 'n': self.n}
 
 
+class TokenBucket(object):
+    """
+    Each call to :meth:`deposit` adds `ratio` tokens up to `max_tokens`, and
+    :meth:`withdraw` takes a token if there is one. This limits withdrawals
+    to `ratio` times the number of deposits, plus a burst of `max_tokens`.
+    """
+    def __init__(self, ratio=.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.withdrawn = 0
+        self.denied = 0
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            self.denied += 1
+            return False
+        self.tokens -= 1
+        self.withdrawn += 1
+        return True
+
+    @property
+    def stats(self):
+        return {'tokens': self.tokens, 'withdrawn': self.withdrawn, 'denied': self.denied}
+
+
+class EWMA(object):
+    """
+    An exponentially weighted moving average. Each new sample contributes
+    `alpha` to the average, the first sample initializes it.
+    """
+    def __init__(self, alpha=.3, factor=1):
+        self.alpha = alpha
+        self.factor = factor
+        self.value = None
+
+    def add(self, value):
+        value = value * self.factor
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+
+
 class SampleWindow(Accumulator):
     def __init__(self, n=100, factor=1):
         super(SampleWindow, self).__init__()
@@ -29,6 +29,22 @@ def bind_zmq_socket(sock, address, port=None):
     return endpoint, port
 
 
+ZERO_COPY_THRESHOLD = 64 * 1024
+
+
+def send_zmq_frames(sock, frames, copy_threshold=ZERO_COPY_THRESHOLD):
+    """
+    Sends `frames` as a single multipart message with one call. If any frame
+    is at least `copy_threshold` bytes long, the frames are passed to libzmq
+    without copying and a tracker is returned that tells when libzmq is done
+    with the buffers. Returns None otherwise.
+    """
+    for frame in frames:
+        if len(frame) >= copy_threshold:
+            return sock.send_multipart(frames, copy=False, track=True)
+    sock.send_multipart(frames)
+
+
 # adapted from https://github.com/mozilla-services/chaussette/
 def create_socket(host, family=socket.AF_INET, type=socket.SOCK_STREAM,
                   backlog=2048, blocking=True, inheritable=False):
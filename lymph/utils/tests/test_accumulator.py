@@ -3,7 +3,7 @@ from __future__ import division
 from six.moves import range
 from unittest import TestCase
 
-from lymph.utils import Accumulator
+from lymph.utils import Accumulator, EWMA
 
 
 class AccumulatorTests(TestCase):
@@ -15,3 +15,15 @@ class AccumulatorTests(TestCase):
         self.assertEqual(acc.sum, 1)
         self.assertEqual(acc.mean, 0.2)
         self.assertEqual(acc.stddev, 0.09428090415820631)
+
+
+class EWMATests(TestCase):
+    def test_ewma(self):
+        ewma = EWMA(alpha=.5, factor=10)
+        self.assertIsNone(ewma.value)
+        ewma.add(1)
+        self.assertEqual(ewma.value, 10)
+        ewma.add(3)
+        self.assertEqual(ewma.value, 20)
+        ewma.add(2)
+        self.assertEqual(ewma.value, 20)
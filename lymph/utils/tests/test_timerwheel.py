@@ -0,0 +1,44 @@
+import unittest
+
+from lymph.utils.timerwheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(tick=1, size=4)
+
+    def advance(self, n):
+        expired = []
+        for i in range(n):
+            expired.extend(self.wheel.advance())
+        return expired
+
+    def test_expiry(self):
+        self.wheel.add('a', 1, 1)
+        self.wheel.add('b', 2, 2.5)
+        self.assertEqual(len(self.wheel), 2)
+        self.assertEqual(self.advance(1), [('a', 1)])
+        self.assertEqual(self.advance(1), [])
+        self.assertEqual(self.advance(1), [('b', 2)])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_multiple_rotations(self):
+        self.wheel.add('a', 1, 9)
+        self.assertEqual(self.advance(8), [])
+        self.assertEqual(self.advance(1), [('a', 1)])
+
+    def test_remove(self):
+        self.wheel.add('a', 1, 1)
+        self.assertIn('a', self.wheel)
+        self.assertEqual(self.wheel.get('a'), 1)
+        self.assertEqual(self.wheel.remove('a'), 1)
+        self.assertIsNone(self.wheel.remove('a'))
+        self.assertNotIn('a', self.wheel)
+        self.assertEqual(self.advance(4), [])
+
+    def test_readd(self):
+        self.wheel.add('a', 1, 1)
+        self.wheel.add('a', 2, 3)
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.advance(2), [])
+        self.assertEqual(self.advance(1), [('a', 2)])
@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from lymph.utils import import_object, Undefined
+from lymph.utils import import_object, make_id, Undefined, TokenBucket
 
 
 class ImportTests(TestCase):
@@ -21,3 +21,29 @@ class UndefinedTests(TestCase):
         self.assertNotEqual(Undefined, False)
         self.assertFalse(bool(Undefined))
         self.assertEqual(str(Undefined), 'Undefined')
+
+
+class MakeIdTests(TestCase):
+    def test_ids(self):
+        ids = [make_id() for i in range(1000)]
+        self.assertEqual(len(set(ids)), 1000)
+        self.assertEqual(set(len(i) for i in ids), set([16]))
+        self.assertEqual(set(i[:8] for i in ids), set([ids[0][:8]]))
+        for i in ids:
+            i.encode('ascii')
+
+
+class TokenBucketTests(TestCase):
+    def test_ratio(self):
+        bucket = TokenBucket(ratio=.5, max_tokens=2)
+        self.assertTrue(bucket.withdraw())
+        self.assertTrue(bucket.withdraw())
+        self.assertFalse(bucket.withdraw())
+        bucket.deposit()
+        self.assertFalse(bucket.withdraw())
+        bucket.deposit()
+        self.assertTrue(bucket.withdraw())
+        for i in range(10):
+            bucket.deposit()
+        self.assertEqual(bucket.tokens, 2)
+        self.assertEqual(bucket.stats, {'tokens': 2, 'withdrawn': 3, 'denied': 2})
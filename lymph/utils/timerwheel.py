@@ -0,0 +1,62 @@
+from __future__ import division
+
+import math
+
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel. Entries are stored in one of `size` slots according
+    to the tick they expire at, so adding and removing entries is O(1) and
+    each call to :meth:`advance` only looks at a single slot.
+    """
+    def __init__(self, tick=.1, size=512):
+        self.tick = tick
+        self.size = size
+        self.slots = [{} for i in range(size)]
+        self.index = {}
+        self.current_tick = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def add(self, key, value, timeout):
+        """
+        Adds `value` under `key`. It will be returned by :meth:`advance` once
+        `timeout` seconds worth of ticks have passed.
+        """
+        self.remove(key)
+        expires_at = self.current_tick + max(int(math.ceil(timeout / self.tick)), 1)
+        slot = expires_at % self.size
+        self.slots[slot][key] = (expires_at, value)
+        self.index[key] = slot
+
+    def get(self, key, default=None):
+        try:
+            slot = self.index[key]
+        except KeyError:
+            return default
+        return self.slots[slot][key][1]
+
+    def remove(self, key, default=None):
+        try:
+            slot = self.index.pop(key)
+        except KeyError:
+            return default
+        return self.slots[slot].pop(key)[1]
+
+    def advance(self):
+        """
+        Moves the wheel forward by one tick and returns a list of the
+        `(key, value)` pairs that expired.
+        """
+        self.current_tick += 1
+        slot = self.slots[self.current_tick % self.size]
+        expired = [key for key, (expires_at, value) in slot.items() if expires_at <= self.current_tick]
+        result = []
+        for key in expired:
+            del self.index[key]
+            result.append((key, slot.pop(key)[1]))
+        return result